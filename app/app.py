@@ -1,79 +1,368 @@
+import atexit
+from collections import Counter
+import json
+import os
 import re
-
-import fasttext
-from flask import Flask, request, jsonify, render_template
-import mwapi
-
-app = Flask(__name__)
-app.config["DEBUG"] = True
+import threading
+import time
+
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, render_template
+import numpy as np
+
+from cache import LRUCache, SQLiteCache, TieredCache
+from claims import ClaimEncoder, ids_to_str, ids_to_tuples
+from explain import explain, explanation_str
+from inference import TopicModel
+from rules import DEFAULT_RULES
+from timing import TIMER, SamplingProfiler, StageTimer, prometheus_metric, stage
+from title_index import TitleIndex, normalize_title
+from topic_store import ReloadingTopicStore
+from wiki_client import WikiClient
+
+# defaults for create_app -- each can be overridden by passing a config dict or with a FLASK_-prefixed environment
+# variable (e.g., FLASK_CACHE_DB=/tmp/cache.db or FLASK_WIKIDATA_API=http://127.0.0.1:8000/w/api.php)
 CUSTOM_UA = 'wikidata topic app -- isaac@wikimedia.org'
-SESSION = mwapi.Session('https://www.wikidata.org',
-                        user_agent=CUSTOM_UA)
-FT_MODEL = fasttext.load_model('models/model.bin')
+# use the memory-mapped NumPy export of the model if it exists (see numpy_fasttext.py)
+MODEL_PATH = 'models/model_npy' if os.path.isdir('models/model_npy') else 'models/model.bin'
+WIKIDATA_API = 'https://www.wikidata.org/w/api.php'
+WIKIPEDIA_API = 'https://{0}.wikipedia.org/w/api.php'
+
+# Wikidata / Wikipedia API calls: seconds to connect and to wait for a response, max calls in flight per process,
+# and how long a request waits for a free slot before failing
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 10
+UPSTREAM_MAX_CONCURRENCY = 16
+UPSTREAM_QUEUE_TIMEOUT = 1
+
+# explanations (&explain=1): number of random subsets of claims scored in addition to leaving out each claim
+# 0 explains with leave-one-claim-out alone, which is fastest
+EXPLAIN_NUM_SAMPLES = 0
+
+# batch endpoint: max QIDs + titles per request and max IDs / titles per Wikidata / Wikipedia API call
+MAX_BATCH_ITEMS = 1000
+API_BATCH_SIZE = 50
+
+# claims and predictions for recently-requested items, by QID
+# set CACHE_DB to a file path to also share them between processes via SQLite
+CACHE_SIZE = 10000
+CACHE_TTL = 3600  # seconds
+CACHE_DB = None
+
+# predictions for every item from the last dump run (see bulk/build_topic_store.py)
+# items that are not in the store, or all items once the store is older than TOPIC_STORE_MAX_AGE, are predicted live
+TOPIC_STORE_ROOT = 'models/topic_store'
+TOPIC_STORE_MAX_AGE = 14 * 86400  # seconds
+
+# Wikipedia article titles -> QIDs from the last dump run (see app/title_index.py), used if the directory exists
+# titles that are not in the index are resolved with the Wikipedia API and the QIDs found are cached
+TITLE_INDEX = 'models/title_index'
+TITLE_CACHE_SIZE = 100000
+TITLE_CACHE_TTL = 86400  # seconds
+
+# print the name and topics of each item that is predicted live (mostly useful when running locally)
+LOG_ITEMS = False
+# if set, each process samples its stacks while serving requests and writes them to <PROFILE_FILE>.<pid> when it exits
+# (see timing.SamplingProfiler)
+PROFILE_FILE = None
+
+DEFAULT_CONFIG = {
+    'USER_AGENT': CUSTOM_UA,
+    'MODEL_PATH': MODEL_PATH,
+    'WIKIDATA_API': WIKIDATA_API,
+    'WIKIPEDIA_API': WIKIPEDIA_API,
+    'UPSTREAM_CONNECT_TIMEOUT': UPSTREAM_CONNECT_TIMEOUT,
+    'UPSTREAM_READ_TIMEOUT': UPSTREAM_READ_TIMEOUT,
+    'UPSTREAM_MAX_CONCURRENCY': UPSTREAM_MAX_CONCURRENCY,
+    'UPSTREAM_QUEUE_TIMEOUT': UPSTREAM_QUEUE_TIMEOUT,
+    'EXPLAIN_NUM_SAMPLES': EXPLAIN_NUM_SAMPLES,
+    'MAX_BATCH_ITEMS': MAX_BATCH_ITEMS,
+    'API_BATCH_SIZE': API_BATCH_SIZE,
+    'CACHE_SIZE': CACHE_SIZE,
+    'CACHE_TTL': CACHE_TTL,
+    'CACHE_DB': CACHE_DB,
+    'TOPIC_STORE_ROOT': TOPIC_STORE_ROOT,
+    'TOPIC_STORE_MAX_AGE': TOPIC_STORE_MAX_AGE,
+    'TITLE_INDEX': TITLE_INDEX,
+    'TITLE_CACHE_SIZE': TITLE_CACHE_SIZE,
+    'TITLE_CACHE_TTL': TITLE_CACHE_TTL,
+    'LOG_ITEMS': LOG_ITEMS,
+    'PROFILE_FILE': PROFILE_FILE,
+}
+
+bp = Blueprint('topics', __name__)
+
+
+class AppState:
+    """Everything a worker needs to answer requests: loaded once by create_app and shared by all request threads."""
+
+    def __init__(self, config):
+        self.config = config
+        self.model = TopicModel.load(config['MODEL_PATH'])
+        self.client = WikiClient(config['USER_AGENT'],
+                                 timeout=(config['UPSTREAM_CONNECT_TIMEOUT'], config['UPSTREAM_READ_TIMEOUT']),
+                                 max_concurrency=config['UPSTREAM_MAX_CONCURRENCY'],
+                                 queue_timeout=config['UPSTREAM_QUEUE_TIMEOUT'])
+        self.wikidata = self.client.api(config['WIKIDATA_API'])
+        self.cache = TieredCache(LRUCache(max_size=config['CACHE_SIZE'], ttl=config['CACHE_TTL']),
+                                 SQLiteCache(config['CACHE_DB'], ttl=config['CACHE_TTL']) if config['CACHE_DB'] else None)
+        self.topic_store = ReloadingTopicStore(config['TOPIC_STORE_ROOT'], max_age=config['TOPIC_STORE_MAX_AGE'])
+        self.title_index = TitleIndex(config['TITLE_INDEX']) if os.path.isdir(config['TITLE_INDEX'] or '') else None
+        self.title_cache = LRUCache(max_size=config['TITLE_CACHE_SIZE'], ttl=config['TITLE_CACHE_TTL'])
+        self.draining = False
+        # time to answer requests by endpoint and number of responses by (endpoint, status code)
+        self.request_timer = StageTimer()
+        self.responses = Counter()
+        # titles resolved to QIDs by where the QID came from (index, cache, api)
+        self.title_lookups = Counter()
+        self._lock = threading.Lock()
+        self._profiler_pid = None
+
+    def record_response(self, endpoint, status, seconds):
+        self.request_timer.add(endpoint, seconds)
+        with self._lock:
+            self.responses[(endpoint, status)] += 1
+
+    def start_profiler(self):
+        """Start sampling this process if PROFILE_FILE is set. Worker processes are forked after the app is created,
+        so this is done on their first request."""
+        if not self.config['PROFILE_FILE'] or self._profiler_pid == os.getpid():
+            return
+        with self._lock:
+            if self._profiler_pid != os.getpid():
+                self._profiler_pid = os.getpid()
+                profiler = SamplingProfiler().start()
+                atexit.register(profiler.write, '{0}.{1}'.format(self.config['PROFILE_FILE'], os.getpid()))
+
+    def wiki_session(self, lang):
+        return self.client.api(self.config['WIKIPEDIA_API'].format(lang))
+
+    def count_title_lookups(self, source, count=1):
+        with self._lock:
+            self.title_lookups[source] += count
+
+    def shutdown(self):
+        """Stop reporting ready (so load balancers stop sending requests) and close upstream connections."""
+        self.draining = True
+        self.client.close()
+
+
+def create_app(config=None):
+    """Flask app with the model loaded and upstream connections set up.
+
+    Load it once in the parent process before forking workers (see gunicorn.conf.py) so that they share the model's memory.
+    """
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+    app.extensions['topics'] = AppState(app.config)
+    app.register_blueprint(bp)
+    return app
+
+
+def state():
+    return current_app.extensions['topics']
+
+@bp.route('/')
+def index():
+    return 'Server Works!'
 
-PROVIDE_EXPLANATIONS = False
 
-print("Try: http://127.0.0.1:5000/api/v1/wikidata/topic?qid=Q72334&debug")
+def entry_topics(entry, model, threshold):
+    """(topic, score, explanation) for each topic of a cached entry at or above threshold.
 
-if PROVIDE_EXPLANATIONS:
-    from lime.lime_text import LimeTextExplainer
-    import numpy as np
+    Scores have already been adjusted by the claim-based rules (see rules.py); the explanation says which rule changed them.
+    """
+    explanations = DEFAULT_RULES.explanations(model, entry.get('rules', []))
+    return [(l, s, explanations.get(l, "None")) for l, s in entry['scores'] if s >= threshold]
 
-    lbls_to_idx = {l.replace('__label__', ''):i for i,l in enumerate(FT_MODEL.get_labels())}
-    EXPLAINER = LimeTextExplainer(class_names=[l.replace('__label__', '') for l in FT_MODEL.get_labels()])
 
-@app.route('/')
-def index():
-    return 'Server Works!'
-
-
-def adjust_topics_based_on_claims(topics, claims):
-    joined_claims = [":".join(c) for c in claims]
-    properties = [c[0] for c in claims]
-    # list / disambiguation pages
-    if 'P31:Q4167410' in joined_claims:
-        topics = [('Compilation.List_Disambig', 1, 'P31:Q4167410 -- Disambiguation')] + topics
-    elif 'P31:Q13406463' in joined_claims:
-        topics = [('Compilation.List_Disambig', 1, 'P31:Q13406463 -- List')] + topics
-    elif 'P360' in properties:
-        topics = [('Compilation.List_Disambig', 1, 'P360 -- List')] + topics
-    # geography only should apply to items with coordinates
-    if 'P625' not in joined_claims:
-        for idx in range(len(topics)):
-            if topics[idx][0].startswith('Geography'):
-                topics[idx] = (topics[idx][0], max(0, topics[idx][1] - 0.501), ' -- '.join([topics[idx][2], "downgraded bc no coords"]))
-    # Culture.Biography.Women should not include men (at 0.5 threshold):
-    if ('P21:Q6581097' in joined_claims or  # male
-            'P21:Q2449503' in joined_claims or  # transgender male
-            'P21:Q44148' in joined_claims or  # male organisms
-            'P21:Q27679766' in joined_claims or  # transmasculine
-            'P21:Q15145778' in joined_claims):  # cisgender male
-        for idx in range(len(topics)):
-            if topics[idx][0] == 'Culture.Biography.Women':
-                topics[idx] = (topics[idx][0], min(0.49, topics[idx][1]), ' -- '.join([topics[idx][2], " downgraded bc male"]))
-    topics = sorted(topics, key=lambda tup: tup[1], reverse=True)
-    return topics, claims
-
-
-@app.route('/api/v1/wikidata/topic', methods=['GET'])
+@bp.route('/api/v1/wikidata/topic', methods=['GET'])
 def get_topics():
     qid, threshold, debug = validate_api_args()
+    explain_topics = request.args.get('explain', '0') not in ('0', 'false')
     if validate_qid(qid):
-        name, topics, claims = label_qid(qid, SESSION, FT_MODEL, threshold)
-        topics, claims = adjust_topics_based_on_claims(topics, claims)
+        app_state = state()
+        # the store has no claims or per-claim explanations and cannot tell whether it is up-to-date with a specific
+        # revision -- it does keep which rules applied, so rule explanations are the same as for live predictions
+        if not debug and not explain_topics and 'revid' not in request.args and isinstance(threshold, float):
+            found = app_state.topic_store.lookup(qid, threshold)
+            if found is not None:
+                topics, rules = found
+                with stage('serialize'):
+                    explanations = DEFAULT_RULES.explanations(app_state.model, rules)
+                    return jsonify([{'topic':t, 'score':s, 'explanation':explanations.get(t, "None")} for t, s in topics])
+        name, topics, claims = label_qid(qid, app_state.wikidata, app_state.model, threshold, cache=app_state.cache,
+                                         revid=request.args.get('revid', None, type=int), explain_topics=explain_topics,
+                                         explain_num_samples=app_state.config['EXPLAIN_NUM_SAMPLES'],
+                                         verbose=app_state.config['LOG_ITEMS'])
         if debug:
             return render_template('wikidata_topics.html',
                                    qid=qid, claims=claims, topics=topics, name=name)
         else:
-            topics = [{'topic':t[0], 'score':t[1], 'explanation':t[2]} for t in topics]
-            return jsonify(topics)
+            with stage('serialize'):
+                topics = [{'topic':t[0], 'score':t[1], 'explanation':t[2]} for t in topics]
+                return jsonify(topics)
     return jsonify({'Error':qid})
 
 
-def get_qid(title, lang, session=None):
-    if session is None:
-        session = mwapi.Session('https://{0}.wikipedia.org'.format(lang), user_agent=CUSTOM_UA)
-
+@bp.route('/api/v1/wikidata/topics', methods=['POST'])
+def get_topics_batch():
+    """Topics for many items at once. Expects a JSON body like:
+        {"qids": ["Q42", ...], "titles": [{"lang": "en", "title": "Douglas Adams"}, ...], "threshold": 0.5}
+    and streams back one JSON object per line for each QID and then each title, in the order given.
+    """
+    qids, titles, threshold = validate_batch_args()
+    if isinstance(qids, str):
+        return jsonify({'Error': qids}), 400
+
+    app_state = state()
+    # resolve titles to QIDs with the title index / cache and one pageprops call per language per API_BATCH_SIZE
+    # remaining titles
+    titles_by_lang = {}
+    for lang, title in titles:
+        titles_by_lang.setdefault(lang, []).append(title)
+    title_qids = {}
+    for lang in titles_by_lang:
+        title_qids[lang] = resolve_titles(titles_by_lang[lang], lang, app_state)
+
+    # claims + predictions for all QIDs with one wbgetentities call per API_BATCH_SIZE items and one batched prediction
+    resolved = [(lang, title, title_qids[lang][title]) for lang, title in titles]
+    all_qids = [q for q in qids if validate_qid(q)] + [q for _, _, q in resolved if q and validate_qid(q)]
+    entries = get_entities_predictions_cached(all_qids, app_state.wikidata, app_state.model, app_state.cache,
+                                              batch_size=app_state.config['API_BATCH_SIZE'])
+
+    def generate():
+        for qid in qids:
+            with stage('serialize'):
+                line = json.dumps(batch_result(qid, entries, app_state.model, threshold)) + '\n'
+            yield line
+        for lang, title, qid in resolved:
+            with stage('serialize'):
+                if qid is None:
+                    result = {'qid': None, 'Error': "Title does not exist in {0}: {1}".format(lang, title)}
+                elif not validate_qid(qid):
+                    # the Wikipedia API call failed (see get_qids)
+                    result = {'qid': None, 'Error': qid}
+                else:
+                    result = batch_result(qid, entries, app_state.model, threshold)
+                result.update({'lang': lang, 'title': title})
+                line = json.dumps(result) + '\n'
+            yield line
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def batch_result(qid, entries, model, threshold):
+    """JSON output for one item of a batch request."""
+    if qid is None or not validate_qid(qid):
+        return {'qid': qid, 'Error': "No valid QID for item: {0}".format(qid)}
+    entry = entries.get(qid)
+    if entry is None:
+        return {'qid': qid, 'Error': "API call failed for {0}".format(qid)}
+    if entry['missing']:
+        return {'qid': qid, 'Error': "Item does not exist: {0}".format(qid)}
+    topics = entry_topics(entry, model, threshold)
+    return {'qid': qid, 'topics': [{'topic':t[0], 'score':t[1], 'explanation':t[2]} for t in topics]}
+
+
+def validate_batch_args():
+    """Parse the JSON body of a batch request -> (qids, [(lang, title), ...], threshold) or (error message, None, None)."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return "Error: request body must be a JSON object with 'qids' and/or 'titles' fields.", None, None
+    qids = body.get('qids', [])
+    titles = body.get('titles', [])
+    if not isinstance(qids, list) or not isinstance(titles, list):
+        return "Error: 'qids' and 'titles' must be lists.", None, None
+    max_items = state().config['MAX_BATCH_ITEMS']
+    if len(qids) + len(titles) > max_items:
+        return "Error: at most {0} QIDs + titles per request.".format(max_items), None, None
+    qids = [str(q).upper() for q in qids]
+    parsed_titles = []
+    for t in titles:
+        if (not isinstance(t, dict) or not isinstance(t.get('title'), str) or not isinstance(t.get('lang', 'en'), str)
+                or not validate_lang(t.get('lang', 'en'))):
+            return "Error: titles must look like {'lang': 'en', 'title': 'Douglas Adams'}: " + str(t), None, None
+        parsed_titles.append((t.get('lang', 'en'), t['title']))
+    try:
+        threshold = float(body.get('threshold', 0.5))
+    except (TypeError, ValueError):
+        return "Error: threshold value provided not a float: {0}".format(body['threshold']), None, None
+    return qids, parsed_titles, threshold
+
+
+@bp.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check for load balancers: 503 once the app is shutting down."""
+    app_state = state()
+    if app_state.draining:
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'model': app_state.config['MODEL_PATH'], 'labels': len(app_state.model.labels),
+                    'topic_store': app_state.topic_store.current() is not None,
+                    'title_index': len(app_state.title_index) if app_state.title_index is not None else None})
+
+
+@bp.route('/api/v1/upstream/stats', methods=['GET'])
+def get_upstream_stats():
+    return jsonify(state().client.stats())
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for this process. With several workers, each scrape is answered by one of them."""
+    app_state = state()
+    lines = TIMER.prometheus('wikidata_topics_stage_seconds', 'Time spent in each stage of answering requests.')
+    lines += app_state.request_timer.prometheus('wikidata_topics_request_seconds',
+                                                'Time to answer requests, until the response starts.', label='endpoint')
+    with app_state._lock:
+        responses = dict(app_state.responses)
+    lines += prometheus_metric('wikidata_topics_responses_total', 'Responses by endpoint and status code.', 'counter',
+                               responses, label=('endpoint', 'status'))
+    upstream = app_state.client.stats()
+    for key in ('requests', 'failures', 'rejected'):
+        lines += prometheus_metric('wikidata_topics_upstream_{0}_total'.format(key),
+                                   'Wikidata / Wikipedia API calls: {0}.'.format(key), 'counter', upstream[key])
+    lines += prometheus_metric('wikidata_topics_upstream_in_flight', 'Wikidata / Wikipedia API calls in flight.',
+                               'gauge', upstream['in_flight'])
+    caches = app_state.cache.stats()
+    for key in ('hits', 'misses'):
+        lines += prometheus_metric('wikidata_topics_cache_{0}_total'.format(key), 'Cache {0}.'.format(key), 'counter',
+                                   {name: caches[name][key] for name in caches}, label=('cache',))
+    store = app_state.topic_store
+    lines += prometheus_metric('wikidata_topics_store_lookups_total', 'Topic store lookups.', 'counter',
+                               {'hit': store.hits, 'miss': store.misses}, label=('result',))
+    with app_state._lock:
+        title_lookups = dict(app_state.title_lookups)
+    lines += prometheus_metric('wikidata_topics_title_lookups_total', 'Titles resolved to QIDs by source.', 'counter',
+                               title_lookups, label=('source',))
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    state().start_profiler()
+
+
+@bp.after_app_request
+def record_response(response):
+    state().record_response(request.endpoint or 'unknown', response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+
+@bp.route('/api/v1/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(state().cache.stats())
+
+
+@bp.route('/api/v1/topic_store/stats', methods=['GET'])
+def get_topic_store_stats():
+    return jsonify(state().topic_store.stats())
+
+
+def get_qid(title, lang, session):
     try:
         result = session.get(
             action="query",
@@ -93,6 +382,83 @@ def get_qid(title, lang, session=None):
         print("No results returned:", title)
         return "Title does not exist in {0}: {1}".format(lang, title)
 
+
+def resolve_title(title, lang, app_state):
+    """QID for a Wikipedia article title -> QID or error message. See resolve_titles."""
+    qid = resolve_titles([title], lang, app_state, single=True)[title]
+    if qid is None:
+        return "Title does not exist in {0}: {1}".format(lang, title)
+    return qid
+
+
+def resolve_titles(titles, lang, app_state, single=False):
+    """Map Wikipedia article titles to QIDs -> {title: QID, None, or error message if the API call failed}.
+
+    Titles are looked up in the title index (if loaded), then in the cache of earlier API results, and only the rest
+    are resolved with the Wikipedia API. Titles without a QID are not cached so that new articles are picked up.
+    With single, the one title's API error message is returned instead of None.
+    """
+    title_qids = {}
+    to_fetch = []
+    for title in titles:
+        qid = None
+        if app_state.title_index is not None:
+            qid = app_state.title_index.lookup(lang, title)
+            if qid is not None:
+                app_state.count_title_lookups('index')
+        if qid is None:
+            qid = app_state.title_cache.get((lang, normalize_title(title)))
+            if qid is not None:
+                app_state.count_title_lookups('cache')
+        if qid is None:
+            to_fetch.append(title)
+        title_qids[title] = qid
+    to_fetch = list(dict.fromkeys(to_fetch))
+    if to_fetch:
+        app_state.count_title_lookups('api', len(to_fetch))
+        if single:
+            fetched = {to_fetch[0]: get_qid(to_fetch[0], lang, app_state.wiki_session(lang))}
+        else:
+            fetched = get_qids(to_fetch, lang, app_state.wiki_session(lang), batch_size=app_state.config['API_BATCH_SIZE'])
+        for title, qid in fetched.items():
+            if qid is not None and validate_qid(qid):
+                app_state.title_cache.set((lang, normalize_title(title)), qid)
+            title_qids[title] = qid
+    return title_qids
+
+
+def get_qids(titles, lang, session, batch_size=API_BATCH_SIZE):
+    """Map many Wikipedia article titles to QIDs (batch_size titles per API call) -> {title: QID or None}.
+
+    As with get_qid, titles whose API call failed map to an error message instead.
+    """
+    title_to_qid = {}
+    for i in range(0, len(titles), batch_size):
+        batch = titles[i:i + batch_size]
+        try:
+            result = session.get(
+                action="query",
+                prop="pageprops",
+                ppprop='wikibase_item',
+                titles='|'.join(batch),
+                format='json',
+                formatversion=2
+            )
+        except Exception:
+            print("Failed:", batch)
+            for title in batch:
+                title_to_qid[title] = "API call failed for {0}.wikipedia: {1}".format(lang, title)
+            continue
+        normalized = {n['to']:n['from'] for n in result.get('query', {}).get('normalized', [])}
+        for page in result.get('query', {}).get('pages', []):
+            title = normalized.get(page.get('title'), page.get('title'))
+            title_to_qid[title] = page.get('pageprops', {}).get('wikibase_item', None)
+    return {t:title_to_qid.get(t) for t in titles}
+
+
+def validate_lang(lang):
+    return re.match('^[a-z][a-z0-9-]*$', lang)
+
 def validate_qid(qid):
     return re.match('^Q[0-9]+$', qid)
 
@@ -101,10 +467,16 @@ def validate_api_args():
         qid = request.args['qid'].upper()
         if not validate_qid(qid):
             qid = "Error: poorly formatted 'qid' field. {0} does not match 'Q#...'".format(qid)
-    elif 'en_title' in request.args:
-        qid = get_qid(request.args['en_title'], lang='en')
+    elif 'title' in request.args or 'en_title' in request.args:
+        # en_title is the older form of title with lang=en
+        title = request.args['title'] if 'title' in request.args else request.args['en_title']
+        lang = request.args.get('lang', 'en') if 'title' in request.args else 'en'
+        if not validate_lang(lang):
+            qid = "Error: poorly formatted 'lang' field: {0}".format(lang)
+        else:
+            qid = resolve_title(title, lang, state())
     else:
-        qid = "Error: no 'qid' or 'en_title' field provided. Please specify."
+        qid = "Error: no 'qid' or 'title' field provided. Please specify."
 
     threshold = 0.5
     if 'threshold' in request.args:
@@ -121,92 +493,155 @@ def validate_api_args():
     return qid, threshold, debug
 
 
-def predict_proba_lime(datapoints):
-    lbl_to_idx = {l:i for i,l in enumerate(FT_MODEL.get_labels())}
-    probabilities = np.zeros((len(datapoints), len(lbl_to_idx)))
-    for i, dp in enumerate(datapoints):
-        lbls, probs = FT_MODEL.predict(dp, k=-1)
-        for lbl_idx, lbl in enumerate(lbls):
-            probabilities[i][lbl_to_idx[lbl]] = probs[lbl_idx]
-    return probabilities
-
-
-def label_qid(qid, session, model, threshold=0.5, debug=False):
+def label_qid(qid, session, model, threshold=0.5, debug=False, cache=None, revid=None, explain_topics=False,
+              explain_num_samples=EXPLAIN_NUM_SAMPLES, verbose=False):
     # default results
     name = ""
     above_threshold = []
     claims_tuples = []
 
-    # get claims for wikidata item
-    result = {}
-    try:
-        result = session.get(
-            action="wbgetentities",
-            props='claims|labels',
-            languages='en',
-            languagefallback='',
-            format='json',
-            ids=qid
-        )
-    except Exception:
+    # claims and predictions don't depend on the threshold so they can be reused across requests
+    entry = None
+    if cache is not None:
+        entry = cache.get(qid)
+        if entry is not None and revid is not None and entry['lastrevid'] != revid:
+            entry = None
+    if entry is None:
+        entry = get_entity_predictions(qid, session, model, debug)
+        if entry is not None and cache is not None:
+            cache.set(qid, entry)
+
+    if entry is None:
         print("Failed:", qid)
-    if debug:
-        print(result)
-
-    if 'missing' in result['entities'][qid]:
-        print("No results:", qid)
+    elif entry['missing']:
+        if verbose:
+            print("No results:", qid)
     else:
-        # get best label
-        for lbl in result['entities'][qid]['labels']:
-            name = result['entities'][qid]['labels'][lbl]['value']
+        name = entry['name']
+        if name and verbose:
             print('{0}: {1}'.format(qid, name))
-            break
-
-        # convert claims to fastText bag-of-words format
-        claims = result['entities'][qid]['claims']
-        for prop in claims:  # each property, such as P31 instance-of
-            included = False
-            for statement in claims[prop]:  # each value under that property -- e.g., instance-of might have three different values
-                try:
-                    if statement['type'] == 'statement' and statement['mainsnak']['datatype'] == 'wikibase-item':
-                        claims_tuples.append((prop, statement['mainsnak']['datavalue']['value']['id']))
-                        included = True
-                except Exception:
-                    continue
-            if not included:
-                claims_tuples.append((prop, ))
-        if not len(claims_tuples):
-            claims_tuples = [('<NOCLAIM>', )]
-        if debug:
-            print(claims_tuples)
-        claims_str = ' '.join([' '.join(c) for c in claims_tuples])
-
-        # make prediction
-        lbls, scores = model.predict(claims_str, k=-1)
-        results = {l:s for l,s in zip(lbls, scores)}
-        if debug:
-            print(results)
-        sorted_res = [(l.replace("__label__", ""), results[l], "None") for l in sorted(results, key=results.get, reverse=True)]
+        claims_tuples = [tuple(c) for c in entry['claims']]
+        sorted_res = entry_topics(entry, model, -np.inf)
         above_threshold = [r for r in sorted_res if r[1] >= threshold]
         lbls_above_threshold = []
         if above_threshold:
             for res in above_threshold:
-                print('{0}: {1:.3f} -- {2}'.format(*res))
+                if verbose:
+                    print('{0}: {1:.3f} -- {2}'.format(*res))
                 if res[1] > 0.5:
                     lbls_above_threshold.append(res[0])
-        else:
+        elif verbose:
             print("No label above {0} threshold.".format(threshold))
             print("Top result: {0} ({1:.3f}) -- {2}".format(sorted_res[0][0], sorted_res[0][1], sorted_res[0][2]))
 
-        if PROVIDE_EXPLANATIONS and lbls_above_threshold:
-            exp = EXPLAINER.explain_instance(claims_str, predict_proba_lime, num_features=5,
-                                             labels=[lbls_to_idx[l] for l in lbls_above_threshold])
+        if explain_topics and lbls_above_threshold:
+            with stage('explain'):
+                exp = explain(model, claims_tuples, lbls_above_threshold, num_samples=explain_num_samples)
             for i,lbl in enumerate(lbls_above_threshold):
-                above_threshold[i] = (above_threshold[i][0], above_threshold[i][1],
-                                      '; '.join(['{0} ({1:.3f})'.format(ft[0], ft[1]) for ft in exp.as_list(label=lbls_to_idx[lbl])]))
-                print(above_threshold[i])
+                # after the explanation of any rule that changed the score
+                label, score, rule_explanation = above_threshold[i]
+                parts = [e for e in (rule_explanation, explanation_str(exp[lbl])) if e and e != "None"]
+                above_threshold[i] = (label, score, ' -- '.join(parts))
+                if verbose:
+                    print(above_threshold[i])
 
     return name, above_threshold, claims_tuples
 
 
-app.run()
\ No newline at end of file
+def get_entity_predictions(qid, session, model, debug=False):
+    """Get the label and claims for a Wikidata item and predict its topics.
+
+    Returns None if the API call fails, otherwise a JSON-serializable dict (so that it can be cached) with the label,
+    claims, all topics sorted by score, the claim-based rules that adjusted the scores, and the revision ID the claims came from.
+    """
+    return get_entities_predictions([qid], session, model, debug).get(qid)
+
+
+def get_entities_predictions_cached(qids, session, model, cache=None, batch_size=API_BATCH_SIZE):
+    """get_entities_predictions but only for the QIDs that are not already cached."""
+    entries = {}
+    to_fetch = []
+    for qid in qids:
+        entry = cache.get(qid) if cache is not None else None
+        if entry is None:
+            to_fetch.append(qid)
+        else:
+            entries[qid] = entry
+    fetched = get_entities_predictions(list(dict.fromkeys(to_fetch)), session, model, batch_size=batch_size)
+    if cache is not None:
+        for qid, entry in fetched.items():
+            cache.set(qid, entry)
+    entries.update(fetched)
+    return entries
+
+
+def get_entities_predictions(qids, session, model, debug=False, batch_size=API_BATCH_SIZE):
+    """get_entity_predictions for many items: batch_size items per API call and one batched prediction -> {QID: entry}.
+
+    Items whose API call failed are left out.
+    """
+    entries = {}
+    claims_ids = []
+    # request threads each use their own encoder
+    encoder = ClaimEncoder()
+    for i in range(0, len(qids), batch_size):
+        batch = qids[i:i + batch_size]
+        # get claims for wikidata items
+        try:
+            result = session.get(
+                action="wbgetentities",
+                props='claims|labels|info',
+                languages='en',
+                languagefallback='',
+                format='json',
+                ids='|'.join(batch)
+            )
+        except Exception:
+            print("Failed:", batch)
+            continue
+        if debug:
+            print(result)
+
+        for key, entity in result['entities'].items():
+            qid = entity.get('id', key)
+            if 'redirects' in entity:
+                qid = entity['redirects']['from']
+            if 'missing' in entity:
+                entries[qid] = {'missing': True, 'lastrevid': None}
+                continue
+            with stage('extract'):
+                entries[qid], ids = entity_to_entry(entity, encoder)
+            claims_ids.append((qid, ids))
+    if debug:
+        print([(qid, ids_to_str(ids)) for qid, ids in claims_ids])
+
+    # make predictions and adjust them based on claims for the whole batch at once
+    if claims_ids:
+        with stage('predict'):
+            scores = model.predict_ids([ids for _, ids in claims_ids])
+        with stage('rules'):
+            fired = DEFAULT_RULES.apply(model, scores, [DEFAULT_RULES.mask_ids(ids) for _, ids in claims_ids])
+        for (qid, _), sorted_res, fired_row in zip(claims_ids, model.rank(scores, threshold=-np.inf), fired):
+            entries[qid]['scores'] = sorted_res
+            entries[qid]['rules'] = DEFAULT_RULES.names(fired_row)
+    if debug:
+        print(entries)
+    return entries
+
+
+def entity_to_entry(entity, encoder):
+    """Label and claims (in fastText bag-of-words format) for a wbgetentities result -> (entry, claims as token IDs)."""
+    # get best label
+    name = ""
+    for lbl in entity.get('labels', {}):
+        name = entity['labels'][lbl]['value']
+        break
+
+    # convert claims to fastText bag-of-words format (see claims.py)
+    ids, _ = encoder.encode(entity.get('claims', {}))
+    return {'missing': False, 'name': name, 'claims': ids_to_tuples(ids), 'lastrevid': entity.get('lastrevid')}, ids
+
+
+if __name__ == "__main__":
+    print("Try: http://127.0.0.1:5000/api/v1/wikidata/topic?qid=Q72334&debug")
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""Caches for Wikidata entities and their predictions so that popular items do not need an API call on every request.
+
+Entries are JSON-serializable dicts keyed by QID. An in-process LRU cache can optionally be backed by a SQLite
+cache that is shared by all processes on a machine. Both support a maximum size and a time-to-live,
+and keep hit / miss counters.
+"""
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LRUCache:
+    """In-process cache that evicts the least-recently-used entry once max_size is reached."""
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'type': 'lru', 'size': len(self), 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0}
+
+
+class SQLiteCache:
+    """On-disk cache that can be shared between processes. Entries are evicted oldest-first once max_size is reached."""
+
+    def __init__(self, db_fn, max_size=1000000, ttl=86400):
+        self.db_fn = db_fn
+        self.max_size = max_size
+        self.ttl = ttl
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._sets = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @property
+    def conn(self):
+        # connections must not be shared with a parent / child process (e.g., gunicorn workers forked after the app
+        # is created), so each process opens its own on first use -- callers hold self._lock
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_fn, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute('SELECT expires, value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[0] < time.time():
+                self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[1])
+
+    def set(self, key, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)',
+                               (key, time.time() + self.ttl, json.dumps(value)))
+            self._sets += 1
+            # checking the size is relatively expensive so only do it every so often
+            if self._sets % max(1, min(1000, self.max_size // 10)) == 0:
+                self._evict()
+
+    def _evict(self):
+        excess = len(self) - self.max_size
+        if excess > 0:
+            self.conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires LIMIT ?)', (excess,))
+            self.evictions += excess
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = len(self)
+        return {'type': 'sqlite', 'db': self.db_fn, 'size': size, 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'expired': self.expired, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0}
+
+
+class TieredCache:
+    """In-process LRU cache in front of an optional shared cache. Hits in the shared cache are copied to the LRU cache."""
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def stats(self):
+        stats = {'local': self.local.stats()}
+        if self.shared is not None:
+            stats['shared'] = self.shared.stats()
+        return stats
@@ -0,0 +1,128 @@
+"""Compact claims: an item's claim tokens as an array of integers instead of tuples and strings.
+
+The model reads an item as a bag of claim tokens -- 'P31 Q5 P31 Q6 P625 ...': each claim is a property followed by its
+item value, or the property alone if it has no item values. Properties and items are already numbered by Wikidata,
+so each token is interned to an integer that every process agrees on without sharing a table:
+    Qn -> 2n, Pn -> 2n + 1, and '<NOCLAIM>' (items without claims) -> 1, where P0 would be
+An item's claims are then an array('I') of token IDs in that order (4 bytes per token). A token is a property
+if its lowest bit is set and a value always follows its property, so the (property, value) pairs that the rules
+need (see rules.py) can be read back from the array.
+
+ClaimEncoder converts the claims of a wbgetentities result / dump line into such an array with a reusable buffer,
+and NumpyFastText models score the arrays directly (see TopicModel.predict_ids) without building and re-tokenizing
+strings. The other helpers convert back to tokens for fastText models, explanations, and debug output.
+"""
+from array import array
+import hashlib
+
+NOCLAIM = '<NOCLAIM>'
+NOCLAIM_ID = 1
+TYPECODE = 'I'
+# bounded so that a long-running process does not keep every token it has seen
+TOKEN_CACHE_SIZE = 1000000
+# token for each ID that has been converted back (see id_token)
+_TOKENS = {}
+
+
+def token_id(token):
+    """Example: 'Q5' -> 10, 'P31' -> 63. Raises ValueError for anything other than a property, an item, or NOCLAIM."""
+    if token[:1] == 'Q' and token[1:].isdigit():
+        return int(token[1:]) << 1
+    if token[:1] == 'P' and token[1:].isdigit() and int(token[1:]):
+        return int(token[1:]) << 1 | 1
+    if token == NOCLAIM:
+        return NOCLAIM_ID
+    raise ValueError("Not a claim token: {0}".format(token))
+
+
+def id_token(tid):
+    """Example: 63 -> 'P31'"""
+    token = _TOKENS.get(tid)
+    if token is None:
+        token = NOCLAIM if tid == NOCLAIM_ID else '{0}{1}'.format('P' if tid & 1 else 'Q', tid >> 1)
+        if len(_TOKENS) >= TOKEN_CACHE_SIZE:
+            _TOKENS.clear()
+        _TOKENS[tid] = token
+    return token
+
+
+def ids_to_str(ids):
+    """Example: array('I', [63, 10, 1251]) -> 'P31 Q5 P625' -- the claims string that fastText models read."""
+    tokens = _TOKENS
+    return ' '.join([tokens.get(tid) or id_token(tid) for tid in ids])
+
+
+def ids_to_tuples(ids):
+    """Example: array('I', [63, 10, 1251]) -> [('P31', 'Q5'), ('P625',)]"""
+    tuples = []
+    for tid in ids:
+        if tid & 1:
+            tuples.append((id_token(tid),))
+        else:
+            tuples[-1] = (tuples[-1][0], id_token(tid))
+    return tuples
+
+
+def tuples_to_ids(claims_tuples):
+    """Inverse of ids_to_tuples."""
+    return array(TYPECODE, [token_id(token) for claim in claims_tuples for token in claim])
+
+
+def fingerprint(ids):
+    """Hash of the set of claims that does not depend on their order -- equal fingerprints mean equal predictions."""
+    # each claim as one 64-bit key: property in the high half, value (or 0) in the low half
+    keys = []
+    for tid in ids:
+        if tid & 1:
+            keys.append(tid << 32)
+        else:
+            keys[-1] |= tid
+    keys.sort()
+    return hashlib.blake2b(array('Q', keys).tobytes(), digest_size=8).hexdigest()
+
+
+class ClaimEncoder:
+    """Converts the claims of wbgetentities results / dump items into arrays of token IDs.
+
+    Claims are collected in one buffer that is reused for every item, and token strings are interned so that a
+    repeated property or value is converted to its ID with one dictionary lookup. Not safe to share between threads.
+    """
+
+    def __init__(self):
+        self.buffer = array(TYPECODE)
+        self._ids = {}
+
+    def intern(self, token):
+        tid = self._ids.get(token)
+        if tid is None:
+            tid = token_id(token)
+            if len(self._ids) >= TOKEN_CACHE_SIZE:
+                self._ids.clear()
+            self._ids[token] = tid
+        return tid
+
+    def encode(self, claims):
+        """Token IDs for an entity's claims ({property: [statement, ...]}) -> (array of IDs, number of malformed statements).
+
+        Only statements with item values are kept; a property without any is kept on its own.
+        """
+        buffer = self.buffer
+        del buffer[:]
+        malformed = 0
+        for prop in claims:  # each property, such as P31 instance-of
+            pid = self.intern(prop)
+            included = False
+            for statement in claims[prop]:  # each value under that property -- e.g., instance-of might have three different values
+                try:
+                    if statement['type'] == 'statement' and statement['mainsnak']['datatype'] == 'wikibase-item':
+                        vid = self.intern(statement['mainsnak']['datavalue']['value']['id'])
+                        buffer.append(pid)
+                        buffer.append(vid)
+                        included = True
+                except Exception:
+                    malformed += 1
+            if not included:
+                buffer.append(pid)
+        if not buffer:
+            buffer.append(NOCLAIM_ID)
+        return buffer[:], malformed
@@ -0,0 +1,46 @@
+"""gunicorn settings for serving the app: gunicorn -c gunicorn.conf.py wsgi:application
+
+The app (and so the model) is loaded once in the parent process before the workers are forked. The workers share its
+memory copy-on-write, and freezing the garbage collector first keeps them from writing to (and so copying) those pages.
+Each worker answers requests with a pool of threads that share one set of upstream connections.
+
+On SIGTERM, each worker stops reporting ready at /ready, keeps serving for DRAIN_SECONDS so that load balancers
+notice, and then finishes its in-flight requests (up to graceful_timeout) before exiting.
+Any setting can be overridden on the command line -- e.g., gunicorn -c gunicorn.conf.py -w 8 wsgi:application
+"""
+import gc
+import os
+import signal
+import threading
+
+DRAIN_SECONDS = float(os.environ.get('DRAIN_SECONDS', 5))
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+preload_app = True
+timeout = 60
+graceful_timeout = int(DRAIN_SECONDS) + 30
+keepalive = 5
+
+
+def when_ready(server):
+    # runs in the parent after the app has been loaded and before any workers are forked
+    gc.collect()
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    handle_exit = worker.handle_exit
+
+    def drain_then_exit(sig, frame):
+        worker.wsgi.extensions['topics'].draining = True
+        threading.Timer(DRAIN_SECONDS, handle_exit, (sig, frame)).start()
+
+    signal.signal(signal.SIGTERM, drain_then_exit)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):
+    worker.wsgi.extensions['topics'].shutdown()
@@ -0,0 +1,117 @@
+"""Batched topic predictions shared by the Flask app and the bulk scripts.
+
+Items are scored in batches into a NumPy matrix (items x labels) with a fixed label order,
+so thresholding, sorting, and high-level topic aggregation can be done as array operations over the whole batch.
+"""
+import os
+
+import numpy as np
+
+from claims import id_token, ids_to_str
+from numpy_fasttext import NumpyFastText
+
+FT_LABEL_PREFIX = '__label__'
+# assigned by rules about claims (lists / disambiguation pages) even if the model does not predict it
+LIST_DISAMBIG_LABEL = 'Compilation.List_Disambig'
+
+
+def ft_to_toplevel(lbl):
+    """Example: '__label__STEM.Technology' -> 'STEM'"""
+    return lbl.replace(FT_LABEL_PREFIX, '').split('.')[0]
+
+
+class TopicModel:
+    """Wrapper around a fastText model that scores batches of claims strings."""
+
+    def __init__(self, model):
+        self.model = model
+        self.labels = [l.replace(FT_LABEL_PREFIX, '') for l in model.get_labels()]
+        self.num_model_labels = len(self.labels)
+        if LIST_DISAMBIG_LABEL not in self.labels:
+            self.labels.append(LIST_DISAMBIG_LABEL)
+        self.label_to_idx = {l:i for i,l in enumerate(self.labels)}
+        self._ft_label_to_idx = {FT_LABEL_PREFIX + l:i for l,i in self.label_to_idx.items()}
+        # high-level topics (e.g., STEM, Geography, Culture) and the columns that belong to each
+        self.toplevel_labels = sorted(set(ft_to_toplevel(l) for l in self.labels))
+        self._toplevel_cols = [np.array([i for i,l in enumerate(self.labels) if ft_to_toplevel(l) == hlc])
+                               for hlc in self.toplevel_labels]
+
+    @classmethod
+    def load(cls, model_fn):
+        """Load either a fastText .bin model or a model exported for NumPy scoring (a directory; see numpy_fasttext.py)."""
+        if os.path.isdir(model_fn):
+            return cls(NumpyFastText(model_fn))
+        import fasttext
+        return cls(fasttext.load_model(model_fn))
+
+    def label_columns(self, prefix):
+        """Column indices of all labels that start with prefix -- e.g., 'Geography'."""
+        return np.array([i for i,l in enumerate(self.labels) if l.startswith(prefix)], dtype=np.intp)
+
+    def predict(self, claims_strs):
+        """Score a list of claims strings -> (len(claims_strs), len(self.labels)) array of probabilities."""
+        scores = np.zeros((len(claims_strs), len(self.labels)), dtype=np.float64)
+        if not claims_strs:
+            return scores
+        if isinstance(self.model, NumpyFastText):
+            scores[:, :self.num_model_labels] = self.model.predict_proba(list(claims_strs))
+            return scores
+        lbls, probs = self.model.predict(list(claims_strs), k=-1)
+        for row, (item_lbls, item_probs) in enumerate(zip(lbls, probs)):
+            scores[row, [self._ft_label_to_idx[l] for l in item_lbls]] = item_probs
+        return scores
+
+    def predict_ids(self, claims_ids):
+        """predict for claims given as arrays of token IDs (see claims.py).
+
+        Models exported for NumPy scoring go straight from token IDs to input rows; fastText models get claims strings.
+        """
+        if not isinstance(self.model, NumpyFastText):
+            return self.predict([ids_to_str(ids) for ids in claims_ids])
+        scores = np.zeros((len(claims_ids), len(self.labels)), dtype=np.float64)
+        if len(claims_ids):
+            scores[:, :self.num_model_labels] = self.model.predict_proba_ids(claims_ids, id_token)
+        return scores
+
+    def toplevel(self, scores):
+        """Aggregate mid-level scores into high-level topic scores -> (len(scores), len(self.toplevel_labels)).
+
+        This depends on the assumption that predicted labels are independent, which is clearly wrong
+        (the model likely has correlated errors for things like STEM.Technology and STEM.Engineering),
+        but in practice the high-level results tend to make sense.
+        """
+        hlc_scores = np.empty((scores.shape[0], len(self.toplevel_labels)), dtype=np.float64)
+        for j, cols in enumerate(self._toplevel_cols):
+            hlc_scores[:, j] = 1 - np.prod(1 - scores[:, cols], axis=1)
+        return hlc_scores
+
+    def rank(self, scores, threshold=0.5, inclusive=True, decimals=None):
+        """Sorted (label, score) lists for each row of scores, keeping only labels at or above threshold.
+
+        With inclusive=False, only labels strictly above the threshold are kept. Labels that the model does not
+        predict (see LIST_DISAMBIG_LABEL) are only included when a rule has given them a score.
+        """
+        return rank(self.labels, scores, threshold, inclusive, decimals, num_model_labels=self.num_model_labels)
+
+    def rank_toplevel(self, hlc_scores, threshold=0.5, inclusive=True, decimals=None):
+        return rank(self.toplevel_labels, hlc_scores, threshold, inclusive, decimals)
+
+
+def rank(labels, scores, threshold=0.5, inclusive=True, decimals=None, num_model_labels=None):
+    """Sort each row of scores in descending order and filter to those above threshold -> list of [(label, score), ...].
+
+    With decimals, scores are rounded for the output but compared with threshold before rounding, so that the same
+    labels are kept as without it.
+    """
+    order = np.argsort(-scores, axis=1, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+    keep = sorted_scores >= threshold if inclusive else sorted_scores > threshold
+    if decimals is not None:
+        sorted_scores = np.round(sorted_scores, decimals)
+    if num_model_labels is not None and num_model_labels < len(labels):
+        # drop extra rule-based labels that were never assigned
+        keep &= (order < num_model_labels) | (sorted_scores > 0)
+    ranked = []
+    for row_order, row_scores, row_keep in zip(order.tolist(), sorted_scores.tolist(), keep):
+        ranked.append([(labels[i], s) for i, s, k in zip(row_order, row_scores, row_keep.tolist()) if k])
+    return ranked
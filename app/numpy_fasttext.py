@@ -0,0 +1,303 @@
+"""Pure-NumPy scorer for supervised fastText models backed by memory-mapped weights.
+
+The fastText library loads a private copy of the model into every process. Exporting the model to flat .npy files
+lets any number of processes share one page-cached copy (np.load with mmap_mode='r'), start almost instantly,
+and score batches of items as matrix multiplications.
+
+Export a model (requires the fasttext module; scoring afterwards only requires NumPy):
+    python3 numpy_fasttext.py models/model.bin models/model_npy
+
+The exported directory contains:
+    meta.json         -- labels and the training arguments needed for scoring (dim, bucket, minn, maxn, wordNgrams, loss)
+    vocab_keys.npy    -- sorted 64-bit hashes of the vocabulary words (the lookup table from token to word ID)
+    vocab_ids.npy     -- word ID for each entry in vocab_keys
+    input.npy         -- input matrix (words + hashed n-gram buckets) x dim
+    output.npy        -- output matrix labels x dim
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+EOS = '</s>'
+BOW = '<'
+EOW = '>'
+SUPPORTED_LOSSES = ('softmax', 'ova', 'ns')
+TOKEN_CACHE_SIZE = 1000000
+# fastText approximates the sigmoid (one-vs-all and negative sampling losses) with a lookup table
+MAX_SIGMOID = 8
+SIGMOID_TABLE_SIZE = 512
+SIGMOID_TABLE = (1 / (1 + np.exp(-(np.arange(SIGMOID_TABLE_SIZE + 1) * 2 * MAX_SIGMOID / SIGMOID_TABLE_SIZE
+                                   - MAX_SIGMOID)))).astype(np.float32)
+
+
+def fasttext_hash(token):
+    """32-bit FNV-1a hash as computed by fastText (bytes are treated as signed chars)."""
+    h = 2166136261
+    for b in token.encode('utf-8'):
+        if b > 127:
+            b |= 0xffffff00
+        h = ((h ^ b) * 16777619) & 0xffffffff
+    return h
+
+
+def table_sigmoid(x):
+    """Sigmoid as computed by fastText's Loss::sigmoid."""
+    idx = ((np.clip(x, -MAX_SIGMOID, MAX_SIGMOID) + np.float32(MAX_SIGMOID))
+           * np.float32(SIGMOID_TABLE_SIZE / MAX_SIGMOID / 2)).astype(np.int64)
+    probs = SIGMOID_TABLE[idx]
+    probs[x < -MAX_SIGMOID] = 0
+    probs[x > MAX_SIGMOID] = 1
+    return probs
+
+
+def vocab_key(token):
+    """64-bit hash used as the key into the vocabulary table."""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class NumpyFastText:
+    """Supervised fastText model scored with NumPy. Matches fastText predictions within float tolerance."""
+
+    def __init__(self, model_dir, mmap_mode='r'):
+        with open(os.path.join(model_dir, 'meta.json'), 'r') as fin:
+            meta = json.load(fin)
+        self.labels = meta['labels']
+        self.loss = meta['loss']
+        self.bucket = meta['bucket']
+        self.minn = meta['minn']
+        self.maxn = meta['maxn']
+        self.word_ngrams = meta['wordNgrams']
+        self.nwords = meta['nwords']
+        if self.loss not in SUPPORTED_LOSSES:
+            raise ValueError("Loss {0} is not supported. Supported: {1}".format(self.loss, SUPPORTED_LOSSES))
+        self.vocab_keys = np.load(os.path.join(model_dir, 'vocab_keys.npy'), mmap_mode=mmap_mode)
+        self.vocab_ids = np.load(os.path.join(model_dir, 'vocab_ids.npy'), mmap_mode=mmap_mode)
+        self.input = np.load(os.path.join(model_dir, 'input.npy'), mmap_mode=mmap_mode)
+        self.output = np.load(os.path.join(model_dir, 'output.npy'), mmap_mode=mmap_mode)
+        self._token_cache = {}
+        self._id_cache = {}
+
+    def get_labels(self):
+        return list(self.labels)
+
+    def word_id(self, token):
+        """Vocabulary ID of a token or -1 if it is out-of-vocabulary."""
+        if not len(self.vocab_keys):
+            return -1
+        key = np.uint64(vocab_key(token))
+        pos = min(int(np.searchsorted(self.vocab_keys, key)), len(self.vocab_keys) - 1)
+        return int(self.vocab_ids[pos]) if self.vocab_keys[pos] == key else -1
+
+    def _subwords(self, token):
+        """Hashed character n-gram rows for a token -- see Dictionary::computeSubwords in fastText."""
+        word = (BOW + token + EOW).encode('utf-8')
+        rows = []
+        for i in range(len(word)):
+            if (word[i] & 0xC0) == 0x80:
+                continue
+            j = i
+            n = 1
+            while j < len(word) and n <= self.maxn:
+                j += 1
+                while j < len(word) and (word[j] & 0xC0) == 0x80:
+                    j += 1
+                if n >= self.minn and not (n == 1 and (i == 0 or j == len(word))):
+                    rows.append(self.nwords + fasttext_hash(word[i:j].decode('utf-8')) % self.bucket)
+                n += 1
+        return rows
+
+    def _token_entry(self, token):
+        """Input matrix rows and word n-gram hash for a token, cached because claims tokens repeat heavily."""
+        entry = self._token_cache.get(token)
+        if entry is None:
+            rows = []
+            wid = int(self.word_id(token))
+            if wid >= 0:
+                rows.append(wid)
+            if self.maxn > 0 and token != EOS:
+                rows.extend(self._subwords(token))
+            # fastText keeps these as int32, which are sign-extended when combined into 64-bit n-gram hashes
+            h = fasttext_hash(token)
+            entry = (rows, h | 0xffffffff00000000 if h & 0x80000000 else h)
+            if len(self._token_cache) >= TOKEN_CACHE_SIZE:
+                self._token_cache.clear()
+            self._token_cache[token] = entry
+        return entry
+
+    def _id_entry(self, tid, id_token):
+        """_token_entry for a token given as an integer ID, cached by ID so the token string is only built once."""
+        entry = self._id_cache.get(tid)
+        if entry is None:
+            entry = self._token_entry(id_token(tid))
+            if len(self._id_cache) >= TOKEN_CACHE_SIZE:
+                self._id_cache.clear()
+            self._id_cache[tid] = entry
+        return entry
+
+    def _line_rows(self, tokens):
+        """Input matrix rows for one line of text -- see Dictionary::getLine in fastText."""
+        entries = []
+        for token in tokens:
+            if token.startswith('__label__'):
+                continue
+            entries.append(self._token_entry(token))
+            if token == EOS:
+                break
+        return self._entry_rows(entries)
+
+    def _entry_rows(self, entries):
+        """Input matrix rows for a line given as the _token_entry of each token."""
+        rows = []
+        if self.word_ngrams <= 1 or self.bucket <= 0:
+            for token_rows, _ in entries:
+                rows.extend(token_rows)
+            return rows
+        hashes = []
+        for token_rows, h in entries:
+            rows.extend(token_rows)
+            hashes.append(h)
+        for i in range(len(hashes)):
+            h = hashes[i]
+            for j in range(i + 1, min(len(hashes), i + self.word_ngrams)):
+                h = (h * 116049371 + hashes[j]) & 0xffffffffffffffff
+                rows.append(self.nwords + h % self.bucket)
+        return rows
+
+    def predict_proba(self, texts):
+        """Score a list of texts -> (len(texts), len(labels)) float32 array in the order of get_labels().
+
+        Like fastText, each text has an end-of-sentence token appended, and texts without any known tokens get all zeros.
+        """
+        rows = []
+        counts = np.zeros(len(texts), dtype=np.int64)
+        for i, text in enumerate(texts):
+            line_rows = self._line_rows(text.split() + [EOS])
+            rows.extend(line_rows)
+            counts[i] = len(line_rows)
+        return self._score_rows(rows, counts)
+
+    def predict_proba_ids(self, id_lists, id_token):
+        """predict_proba for texts given as sequences of integer token IDs, where id_token(ID) is the token.
+
+        Input rows are looked up by ID, so repeated tokens are neither rebuilt as strings nor split and hashed again.
+        """
+        eos = self._token_entry(EOS)
+        rows = []
+        counts = np.zeros(len(id_lists), dtype=np.int64)
+        id_cache = self._id_cache
+        for i, ids in enumerate(id_lists):
+            entries = [id_cache.get(tid) or self._id_entry(tid, id_token) for tid in ids]
+            entries.append(eos)
+            line_rows = self._entry_rows(entries)
+            rows.extend(line_rows)
+            counts[i] = len(line_rows)
+        return self._score_rows(rows, counts)
+
+    def _score_rows(self, rows, counts):
+        """Scores for lines given as their input matrix rows (all lines concatenated) and the number of rows in each."""
+        scores = np.zeros((len(counts), len(self.labels)), dtype=np.float32)
+        nonempty = np.flatnonzero(counts)
+        if not len(nonempty):
+            return scores
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        hidden = np.add.reduceat(self.input[np.array(rows, dtype=np.int64)], offsets[nonempty], axis=0, dtype=np.float32)
+        hidden /= counts[nonempty, None].astype(np.float32)
+        logits = hidden @ self.output.T
+        if self.loss == 'softmax':
+            logits -= logits.max(axis=1, keepdims=True)
+            probs = np.exp(logits)
+            probs /= probs.sum(axis=1, keepdims=True)
+        else:
+            probs = table_sigmoid(logits)
+        # fastText reports exp(log(p + 1e-5)) for each label
+        scores[nonempty] = np.exp(np.log(probs + np.float32(1e-5)))
+        return scores
+
+    def predict(self, text, k=-1, threshold=0.0):
+        """Same interface as fastText's predict: labels and probabilities sorted by probability."""
+        texts = text if isinstance(text, list) else [text]
+        scores = self.predict_proba(texts)
+        all_labels = []
+        all_probs = []
+        for row in scores:
+            if not row.any():
+                all_labels.append(())
+                all_probs.append(np.array([], dtype=np.float32))
+                continue
+            order = np.argsort(-row, kind='stable')
+            order = order[row[order] >= threshold]
+            if k > 0:
+                order = order[:k]
+            all_labels.append(tuple(self.labels[i] for i in order))
+            all_probs.append(row[order])
+        if isinstance(text, list):
+            return all_labels, all_probs
+        return all_labels[0], all_probs[0]
+
+
+def export_model(model_fn, model_dir):
+    """Write a fastText .bin model as flat NumPy arrays that can be loaded by NumpyFastText."""
+    import fasttext
+
+    model = fasttext.load_model(model_fn)
+    if model.is_quantized():
+        raise ValueError("Quantized models (.ftz) cannot be exported.")
+    args = model.f.getArgs()
+    loss = str(args.loss).split('.')[-1]
+    if loss not in SUPPORTED_LOSSES:
+        raise ValueError("Loss {0} is not supported. Supported: {1}".format(loss, SUPPORTED_LOSSES))
+    words = model.get_words()
+    keys = np.array([vocab_key(w) for w in words], dtype=np.uint64)
+    if len(np.unique(keys)) != len(keys):
+        raise ValueError("Vocabulary hash collision -- cannot export.")
+    order = np.argsort(keys)
+    meta = {'labels': model.get_labels(), 'loss': loss, 'bucket': args.bucket, 'minn': args.minn, 'maxn': args.maxn,
+            'wordNgrams': args.wordNgrams, 'dim': args.dim, 'nwords': len(words)}
+
+    os.makedirs(model_dir, exist_ok=True)
+    np.save(os.path.join(model_dir, 'vocab_keys.npy'), keys[order])
+    np.save(os.path.join(model_dir, 'vocab_ids.npy'), order.astype(np.int32))
+    np.save(os.path.join(model_dir, 'input.npy'), model.get_input_matrix().astype(np.float32))
+    np.save(os.path.join(model_dir, 'output.npy'), model.get_output_matrix().astype(np.float32))
+    with open(os.path.join(model_dir, 'meta.json'), 'w') as fout:
+        json.dump(meta, fout)
+    return model
+
+
+def check_export(model, model_dir, num_texts=1000, seed=0):
+    """Compare predictions from fastText and the exported model on random texts -> max absolute difference."""
+    rng = np.random.default_rng(seed)
+    words = model.get_words()
+    texts = [' '.join(rng.choice(words, size=rng.integers(1, 20))) for _ in range(num_texts)]
+    texts.append('<OOV-ONLY>')
+    lbl_to_idx = {l:i for i,l in enumerate(model.get_labels())}
+    expected = np.zeros((len(texts), len(lbl_to_idx)), dtype=np.float32)
+    lbls, probs = model.predict(texts, k=-1)
+    for i, (item_lbls, item_probs) in enumerate(zip(lbls, probs)):
+        expected[i, [lbl_to_idx[l] for l in item_lbls]] = item_probs
+    actual = NumpyFastText(model_dir).predict_proba(texts)
+    return float(np.abs(expected - actual).max())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fasttext_model",
+                        help="Location of pretrained fastText model (.bin file)")
+    parser.add_argument("output_dir",
+                        help="Directory to write the exported model to -- e.g., models/model_npy")
+    parser.add_argument("--skip_check",
+                        action="store_true",
+                        help="Do not compare predictions from the exported model against fastText.")
+    args = parser.parse_args()
+
+    model = export_model(args.fasttext_model, args.output_dir)
+    print("Exported {0} to {1}".format(args.fasttext_model, args.output_dir))
+    if not args.skip_check:
+        print("Max difference from fastText predictions: {0:.2e}".format(check_export(model, args.output_dir)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Rules that adjust model predictions based on an item's claims, shared by the Flask app and the bulk scripts.
+
+Rules are declared as data. Each rule has a condition on the claims and an operation on some label columns:
+    when        -- 'any': applies if the item has any of the claims; 'none': applies if it has none of them
+    claims      -- (property, value) pairs, or (property,) to match the property with any value
+    labels      -- exact labels the operation applies to
+    label_prefix -- alternatively, all labels starting with this prefix (e.g., 'Geography')
+    op          -- 'set' the score to value, 'subtract' value (with a floor of 0), or 'cap' the score at value
+    explanation -- why the score was changed, for the app's debug output
+
+The conditions are compiled into one dictionary lookup per claim that returns a bitmask of the rules it matches,
+so an item's claims reduce to a single integer. The operations are then applied to a whole batch of scores at once.
+Claims can be given either as (property, value) tuples or as arrays of token IDs (see claims.py).
+"""
+import numpy as np
+
+from claims import token_id
+from inference import LIST_DISAMBIG_LABEL
+
+# male; transgender male; male organisms; transmasculine; cisgender male
+SEX_OR_GENDER_MALE = ('Q6581097', 'Q2449503', 'Q44148', 'Q27679766', 'Q15145778')
+
+CLAIM_RULES = [
+    # identify disambiguation pages and lists explicitly
+    {'name': 'list_disambig', 'when': 'any',
+     'claims': [('P31', 'Q4167410'), ('P31', 'Q13406463'), ('P360',)],
+     'labels': [LIST_DISAMBIG_LABEL], 'op': 'set', 'value': 1,
+     'explanation': 'P31:Q4167410 / P31:Q13406463 / P360 -- List / Disambiguation'},
+    # geography should only be applied to topics w/ actual physical locations
+    {'name': 'geography_without_coordinates', 'when': 'none',
+     'claims': [('P625',)],
+     'label_prefix': 'Geography', 'op': 'subtract', 'value': 0.501,
+     'explanation': 'downgraded bc no coords'},
+    # women's biographies should not have any biographies of men (per Wikidata) at default threshold (0.5)
+    {'name': 'biography_women_not_male', 'when': 'any',
+     'claims': [('P21', v) for v in SEX_OR_GENDER_MALE],
+     'labels': ['Culture.Biography.Women'], 'op': 'cap', 'value': 0.49,
+     'explanation': 'downgraded bc male'},
+]
+OPS = ('set', 'subtract', 'cap')
+
+
+class ClaimRules:
+    """Compiled version of a list of rules (see CLAIM_RULES)."""
+
+    def __init__(self, rules=CLAIM_RULES):
+        self.rules = rules
+        self._property_masks = {}
+        self._claim_masks = {}
+        for bit, rule in enumerate(rules):
+            if rule['when'] not in ('any', 'none'):
+                raise ValueError("Unknown condition for rule {0}: {1}".format(rule['name'], rule['when']))
+            if rule['op'] not in OPS:
+                raise ValueError("Unknown operation for rule {0}: {1}".format(rule['name'], rule['op']))
+            for claim in rule['claims']:
+                masks = self._claim_masks if len(claim) > 1 else self._property_masks
+                key = tuple(claim) if len(claim) > 1 else claim[0]
+                masks[key] = masks.get(key, 0) | (1 << bit)
+        # the same lookups keyed by token IDs: a property's ID, or property ID << 32 | value ID for a claim
+        self._property_id_masks = {token_id(p): m for p, m in self._property_masks.items()}
+        self._claim_id_masks = {token_id(p) << 32 | token_id(v): m for (p, v), m in self._claim_masks.items()}
+        # bits of the rules that apply when their claims are absent
+        self._negated = sum(1 << bit for bit, rule in enumerate(rules) if rule['when'] == 'none')
+
+    def mask(self, claims):
+        """Bitmask of the rules that apply to an item given its claims as (property, value) / (property,) tuples."""
+        matched = 0
+        for claim in claims:
+            matched |= self._property_masks.get(claim[0], 0) | self._claim_masks.get(claim, 0)
+        return matched ^ self._negated
+
+    def masks(self, claims_lists):
+        return np.array([self.mask(claims) for claims in claims_lists], dtype=np.int64)
+
+    def mask_ids(self, ids):
+        """mask for claims given as an array of token IDs."""
+        matched = 0
+        prop = 0
+        for tid in ids:
+            if tid & 1:
+                prop = tid
+                matched |= self._property_id_masks.get(tid, 0)
+            else:
+                matched |= self._claim_id_masks.get(prop << 32 | tid, 0)
+        return matched ^ self._negated
+
+    def fired(self, masks):
+        """(len(masks), len(rules)) boolean array of which rules apply to each item."""
+        bits = np.left_shift(1, np.arange(len(self.rules), dtype=np.int64))
+        return (np.asarray(masks, dtype=np.int64)[:, None] & bits) != 0
+
+    def _columns(self, model, rule):
+        if 'label_prefix' in rule:
+            return model.label_columns(rule['label_prefix'])
+        return np.array([model.label_to_idx[l] for l in rule['labels'] if l in model.label_to_idx], dtype=np.intp)
+
+    def apply(self, model, scores, masks):
+        """Adjust a batch of scores from model.predict in place -> boolean array of which rules applied (see fired)."""
+        fired = self.fired(masks)
+        for j, rule in enumerate(self.rules):
+            rows = np.flatnonzero(fired[:, j])
+            cols = self._columns(model, rule)
+            if not len(rows) or not len(cols):
+                continue
+            idx = np.ix_(rows, cols)
+            if rule['op'] == 'set':
+                scores[idx] = rule['value']
+            elif rule['op'] == 'subtract':
+                scores[idx] = np.maximum(0, scores[idx] - rule['value'])
+            else:
+                scores[idx] = np.minimum(rule['value'], scores[idx])
+        return fired
+
+    def names(self, fired_row):
+        """Names of the rules that applied to an item given its row of fired."""
+        return [rule['name'] for rule, f in zip(self.rules, fired_row) if f]
+
+    def explanations(self, model, names):
+        """{label: explanation} for the labels whose scores were changed by the named rules."""
+        explanations = {}
+        for rule in self.rules:
+            if rule['name'] in names:
+                for col in self._columns(model, rule):
+                    label = model.labels[col]
+                    explanations[label] = ' -- '.join(filter(None, [explanations.get(label), rule['explanation']]))
+        return explanations
+
+
+DEFAULT_RULES = ClaimRules()
@@ -0,0 +1,241 @@
+"""Memoized model scores by claim set, so that items with identical claims are only scored once.
+
+Many Wikidata items have exactly the same claims (e.g., scholarly articles, taxa, or asteroids with the same properties
+and values). The model reads claims as a bag of tokens, so items with the same claims fingerprint (a hash of the
+claims that does not depend on their order, see claims.fingerprint) get the same scores. ScoreCache keeps the raw
+model scores -- before the claim-based rules, which are still applied to each item -- for the most recently seen
+claim sets. It can be saved at the end of a run and loaded by the next one with the same model.
+
+Besides hits and misses, it estimates the time saved (hits times the average time to score an item that missed) and
+the number of unique claim sets seen (with a HyperLogLog sketch, so it stays small however many items there are),
+which together with the share of lookups served by the most-hit entries helps to choose the cache size.
+"""
+from collections import OrderedDict
+import io
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+# HyperLogLog registers for counting unique claim sets: 2 ** 14 registers give a standard error of ~0.8%
+HLL_BITS = 14
+# for stats(): share of lookups that caches of these sizes would have served (from the entries currently cached)
+COVERAGE_SIZES = (1000, 10000, 100000, 1000000)
+
+
+def model_id(model_path):
+    """Identifies a model (a .bin file or an exported directory) by its path and when it was last written."""
+    mtime = os.path.getmtime(model_path)
+    if os.path.isdir(model_path):
+        mtime = max([mtime] + [e.stat().st_mtime for e in os.scandir(model_path)])
+    return '{0}@{1}'.format(os.path.abspath(model_path), int(mtime))
+
+
+class ScoreCache:
+    """Bounded LRU cache from claims fingerprint to the model's raw scores. Safe to share between threads.
+
+    model_id identifies the model (e.g., its path) so that a saved cache is not loaded for a different one.
+    """
+
+    def __init__(self, max_size=100000, model_id=None):
+        self.max_size = max_size
+        self.model_id = model_id
+        # score vectors are rows of one preallocated matrix (allocated on first use, when the number of labels is known)
+        self._scores = None
+        self._rows = OrderedDict()
+        self._free = []
+        self._hit_counts = None
+        # hit counts of entries merged without their scores (see merge): in stats(), but never used for lookups
+        self._counted = {}
+        self._registers = bytearray(1 << HLL_BITS)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.predicted = 0
+        self.predict_seconds = 0.
+        # seconds to score an item in the run that saved the cache, for time saved when nothing has been scored yet
+        self.saved_seconds_per_item = 0.
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _allocate(self, num_labels, dtype):
+        self._scores = np.empty((self.max_size, num_labels), dtype=dtype)
+        self._hit_counts = np.zeros(self.max_size, dtype=np.int64)
+        self._free = list(range(self.max_size - 1, -1, -1))
+
+    def _count_unique(self, key):
+        # the fingerprint is already a uniformly distributed hash: the first bits pick a register,
+        # which keeps the longest run of leading zeros seen in the rest
+        register = key >> (64 - HLL_BITS)
+        rank = (64 - HLL_BITS) - (key & ((1 << (64 - HLL_BITS)) - 1)).bit_length() + 1
+        if rank > self._registers[register]:
+            self._registers[register] = rank
+
+    def _put(self, key, scores):
+        if key in self._rows:
+            return
+        if not self._free:
+            _, row = self._rows.popitem(last=False)
+            self._free.append(row)
+            self.evictions += 1
+        row = self._free.pop()
+        self._scores[row] = scores
+        self._hit_counts[row] = 0
+        self._rows[key] = row
+
+    def predict_ids(self, model, claims_ids, fingerprints):
+        """model.predict_ids(claims_ids) for items with these claims fingerprints, only scoring claim sets not in the cache.
+
+        Items in the same batch with the same claims are also only scored once.
+        """
+        if not self.max_size:
+            return model.predict_ids(claims_ids)
+        keys = [int(fp, 16) for fp in fingerprints]
+        scores = None
+        to_score = OrderedDict()
+        with self._lock:
+            for key in keys:
+                self._count_unique(key)
+            if self._scores is not None:
+                scores = np.empty((len(keys), self._scores.shape[1]), dtype=self._scores.dtype)
+            for i, key in enumerate(keys):
+                row = self._rows.get(key)
+                if row is None:
+                    to_score.setdefault(key, []).append(i)
+                    continue
+                self._rows.move_to_end(key)
+                self._hit_counts[row] += 1
+                scores[i] = self._scores[row]
+            # repeats within the batch are hits too: only the first of them is scored
+            self.hits += len(keys) - len(to_score)
+            self.misses += len(to_score)
+        if not to_score:
+            # an empty batch before anything was cached (e.g., every item in an API batch was missing) has no score
+            # matrix to take its shape from, so the model returns the empty result
+            return scores if scores is not None else model.predict_ids(claims_ids)
+        start = time.perf_counter()
+        predicted = model.predict_ids([claims_ids[idx[0]] for idx in to_score.values()])
+        elapsed = time.perf_counter() - start
+        if scores is None:
+            scores = np.empty((len(keys), predicted.shape[1]), dtype=predicted.dtype)
+        with self._lock:
+            self.predicted += len(to_score)
+            self.predict_seconds += elapsed
+            if self._scores is None:
+                self._allocate(predicted.shape[1], predicted.dtype)
+            for (key, idx), row_scores in zip(to_score.items(), predicted):
+                scores[idx] = row_scores
+                self._put(key, row_scores)
+                self._hit_counts[self._rows[key]] += len(idx) - 1
+        return scores
+
+    def unique_estimate(self):
+        """Estimated number of unique claim sets seen (HyperLogLog)."""
+        m = len(self._registers)
+        zeros = self._registers.count(0)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2. ** -r for r in self._registers)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            per_item = self.predict_seconds / self.predicted if self.predicted else self.saved_seconds_per_item
+            hit_counts = np.zeros(0, dtype=np.int64)
+            if self._rows:
+                hit_counts = self._hit_counts[list(self._rows.values())]
+            if self._counted:
+                hit_counts = np.concatenate([hit_counts, np.fromiter(self._counted.values(), dtype=np.int64)])
+            hit_counts = np.sort(hit_counts)[::-1]
+            cumulative = np.cumsum(hit_counts)
+            return {'size': len(self), 'max_size': self.max_size, 'lookups': lookups, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0,
+                    'predict_seconds': self.predict_seconds, 'seconds_saved': self.hits * per_item,
+                    'unique_claim_sets': self.unique_estimate(),
+                    'repeated_claim_sets': int((hit_counts > 0).sum()),
+                    'top_coverage': {n: int(cumulative[min(n, len(cumulative)) - 1]) / lookups if lookups and len(cumulative) else 0
+                                     for n in COVERAGE_SIZES if n <= self.max_size}}
+
+    def summary(self):
+        """Example: 'Score cache: 73.1% hits (731 of 1000), 2.1s saved, ~240 unique claim sets.'"""
+        s = self.stats()
+        return "Score cache: {0:.1%} hits ({1} of {2}), {3:.1f}s saved, ~{4} unique claim sets.".format(
+            s['hit_rate'], s['hits'], s['lookups'], s['seconds_saved'], s['unique_claim_sets'])
+
+    def export(self, with_scores=True):
+        """Plain dict of the cache's counters, entries, and (optionally) their scores -- e.g., to send to another process."""
+        with self._lock:
+            keys = list(self._rows)
+            rows = list(self._rows.values())
+            state = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'predicted': self.predicted,
+                     'predict_seconds': self.predict_seconds, 'registers': bytes(self._registers),
+                     'keys': np.array(keys, dtype=np.uint64),
+                     'hit_counts': self._hit_counts[rows] if rows else np.zeros(0, dtype=np.int64)}
+            if with_scores:
+                state['scores'] = self._scores[rows] if rows else None
+            return state
+
+    def merge(self, state):
+        """Add the counters and entries of another cache's export (e.g., from a worker process).
+
+        Entries exported without their scores are only counted for stats(), so that they are never looked up.
+        """
+        with self._lock:
+            for counter in ('hits', 'misses', 'evictions', 'predicted', 'predict_seconds'):
+                setattr(self, counter, getattr(self, counter) + state[counter])
+            self._registers = bytearray(max(a, b) for a, b in zip(self._registers, state['registers']))
+            if not len(state['keys']):
+                return
+            scores = state.get('scores')
+            if scores is not None and self._scores is None:
+                self._allocate(scores.shape[1], scores.dtype)
+            for i, key in enumerate(state['keys'].tolist()):
+                row = self._rows.get(key)
+                if row is None and scores is None:
+                    self._counted[key] = self._counted.get(key, 0) + int(state['hit_counts'][i])
+                    continue
+                if row is None:
+                    self._put(key, scores[i])
+                    row = self._rows[key]
+                self._hit_counts[row] += state['hit_counts'][i]
+
+    def save(self, cache_fn):
+        """Save the entries (with their scores) to a .npz file, replacing it in one step."""
+        state = self.export()
+        meta = {'model_id': self.model_id, 'saved': time.time(),
+                'seconds_per_item': self.predict_seconds / self.predicted if self.predicted else self.saved_seconds_per_item}
+        buf = io.BytesIO()
+        np.savez(buf, keys=state['keys'], hit_counts=state['hit_counts'],
+                 scores=state['scores'] if state['scores'] is not None else np.zeros((0, 0)),
+                 meta=np.array(json.dumps(meta)))
+        with open(cache_fn + '.partial', 'wb') as fout:
+            fout.write(buf.getvalue())
+        os.replace(cache_fn + '.partial', cache_fn)
+
+    @classmethod
+    def load(cls, cache_fn, max_size=100000, model_id=None):
+        """Cache with the entries saved in cache_fn, if it exists and is for the same model -- otherwise an empty cache."""
+        cache = cls(max_size=max_size, model_id=model_id)
+        if not max_size or not os.path.exists(cache_fn):
+            return cache
+        with np.load(cache_fn) as saved:
+            meta = json.loads(str(saved['meta']))
+            if meta['model_id'] != model_id:
+                print("Not using score cache {0}: it is for model {1}".format(cache_fn, meta['model_id']))
+                return cache
+            keys, hit_counts, scores = saved['keys'], saved['hit_counts'], saved['scores']
+        cache.saved_seconds_per_item = meta.get('seconds_per_item', 0.)
+        if len(keys):
+            # most-hit entries last, so that they are the last to be evicted
+            order = np.argsort(hit_counts, kind='stable')[-max_size:]
+            cache._allocate(scores.shape[1], scores.dtype)
+            for i in order.tolist():
+                cache._put(int(keys[i]), scores[i])
+        print("Loaded {0} claim sets from score cache {1}".format(len(cache), cache_fn))
+        return cache
@@ -0,0 +1,249 @@
+"""Per-stage timers for the app and the bulk scripts, and an optional sampling profiler.
+
+Work is timed in named stages so that it is clear where the time goes:
+    fetch     -- Wikidata / Wikipedia API calls (app and bulk API script)
+    read      -- reading and decompressing the dump (dump script)
+    prefilter -- skipping dump lines that cannot pass the filters without parsing them (dump script)
+    decode    -- parsing JSON
+    extract   -- converting claims to the model's bag-of-words format
+    predict   -- the model
+    rules     -- adjusting scores with the claim-based rules (see rules.py)
+    explain   -- explaining predictions (app, see explain.py)
+    serialize -- ranking scores and building the output
+    compress  -- compressing and writing the output (bulk scripts)
+The app exposes the timers at /metrics in the Prometheus text format. The bulk scripts print them as a breakdown
+with items/sec and an ETA every so often (see ProgressReporter).
+"""
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class StageTimer:
+    """Total seconds, number of observations, and a histogram of durations for each stage. Safe to share between threads."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.seconds = {}
+            self.counts = {}
+            self.histograms = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds, count=1):
+        """Record count observations that took seconds in total (e.g., a batch of lines timed as a whole)."""
+        with self._lock:
+            if name not in self.seconds:
+                self.seconds[name] = 0.
+                self.counts[name] = 0
+                self.histograms[name] = [0] * (len(self.buckets) + 1)
+            self.seconds[name] += seconds
+            self.counts[name] += count
+            self.histograms[name][bisect_left(self.buckets, seconds / count if count else 0)] += count
+
+    def snapshot(self, reset=False):
+        """Plain dict of the timers (e.g., to send from a worker process to merge into the parent's timer)."""
+        with self._lock:
+            snapshot = {name: (self.seconds[name], self.counts[name], list(self.histograms[name])) for name in self.seconds}
+        if reset:
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, (seconds, count, histogram) in snapshot.items():
+                if name not in self.seconds:
+                    self.seconds[name] = 0.
+                    self.counts[name] = 0
+                    self.histograms[name] = [0] * (len(self.buckets) + 1)
+                self.seconds[name] += seconds
+                self.counts[name] += count
+                self.histograms[name] = [a + b for a, b in zip(self.histograms[name], histogram)]
+
+    def breakdown(self):
+        """Example: 'decode 41% (12.1s), predict 33% (9.7s), ...' -- stages by decreasing total time."""
+        with self._lock:
+            seconds = dict(self.seconds)
+        total = sum(seconds.values())
+        return ', '.join(['{0} {1:.0%} ({2:.1f}s)'.format(name, s / total if total else 0, s)
+                          for name, s in sorted(seconds.items(), key=lambda x: -x[1])])
+
+    def prometheus(self, metric, help_text, label='stage'):
+        """Lines of a Prometheus histogram with one series per stage."""
+        lines = ['# HELP {0} {1}'.format(metric, help_text), '# TYPE {0} histogram'.format(metric)]
+        with self._lock:
+            for name in sorted(self.seconds):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), self.histograms[name]):
+                    cumulative += count
+                    lines.append('{0}_bucket{{{1}="{2}",le="{3}"}} {4}'.format(metric, label, name, bound, cumulative))
+                lines.append('{0}_sum{{{1}="{2}"}} {3}'.format(metric, label, name, self.seconds[name]))
+                lines.append('{0}_count{{{1}="{2}"}} {3}'.format(metric, label, name, self.counts[name]))
+        return lines
+
+
+# timers for the current process -- each app worker / bulk script process has its own
+TIMER = StageTimer()
+
+
+def stage(name):
+    """Time a block of code as a stage of the process-wide timer: with stage('predict'): ..."""
+    return TIMER.stage(name)
+
+
+class LapTimer:
+    """Times consecutive stages of a tight loop (e.g., read -> decode -> extract for each dump line) with one clock
+    reading per stage. Totals are kept locally and only added to the shared timer on flush(), which keeps the
+    overhead per item to well under a microsecond."""
+
+    def __init__(self, timer=TIMER):
+        self.timer = timer
+        self.seconds = {}
+        self.counts = {}
+        self.last = time.perf_counter()
+
+    def restart(self):
+        """Do not count the time since the last lap (e.g., time spent by the consumer of a generator)."""
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.seconds[name] = self.seconds.get(name, 0.) + now - self.last
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.last = now
+
+    def flush(self):
+        for name in self.seconds:
+            self.timer.add(name, self.seconds[name], self.counts[name])
+        self.seconds = {}
+        self.counts = {}
+
+
+def prometheus_metric(metric, help_text, metric_type, values, label=None):
+    """Lines of a Prometheus counter or gauge. values: a number, or {label value: number} with label."""
+    lines = ['# HELP {0} {1}'.format(metric, help_text), '# TYPE {0} {1}'.format(metric, metric_type)]
+    if label is None:
+        lines.append('{0} {1}'.format(metric, values))
+    else:
+        for key in sorted(values):
+            lines.append('{0}{{{1}}} {2}'.format(metric, ','.join('{0}="{1}"'.format(l, v) for l, v in
+                                                               zip(label, key if isinstance(key, tuple) else (key,))),
+                                                 values[key]))
+    return lines
+
+
+class ProgressReporter:
+    """Prints items/sec, the breakdown of time by stage, and an ETA at most every interval seconds.
+
+    The ETA comes from the fraction of the input done if the caller knows it, otherwise from total items if given.
+    """
+
+    def __init__(self, timer=TIMER, interval=30, total=None, done=0):
+        self.timer = timer
+        self.interval = interval
+        self.total = total
+        self.start = time.time()
+        self.start_done = done
+        self._last = self.start
+
+    def update(self, done, fraction=None, extra=None, force=False):
+        now = time.time()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        elapsed = now - self.start
+        rate = (done - self.start_done) / elapsed if elapsed else 0
+        if fraction is None and self.total:
+            fraction = done / self.total
+        eta = ''
+        if fraction:
+            # the fraction of the input that was done before this run (e.g., when resuming) does not count
+            start_fraction = self.start_done / done * fraction if done else 0
+            if fraction > start_fraction:
+                eta = ' {0:.1%} done, ETA {1}.'.format(
+                    fraction, format_seconds(elapsed * (1 - fraction) / (fraction - start_fraction)))
+        print("{0} items ({1:.1f} items/sec){2}.{3} Time by stage: {4}".format(
+            done, rate, ' ' + extra if extra else '', eta, self.timer.breakdown()))
+
+
+def write_run_stats(output_fn, seconds, counts, timer=TIMER):
+    """Write a JSON summary of a bulk run: counts (e.g., {'items': ...}), seconds, items/sec, and seconds per stage."""
+    stats = dict(counts)
+    stats['seconds'] = seconds
+    if 'items' in counts:
+        stats['items_per_second'] = counts['items'] / seconds if seconds else 0
+    stats['stages'] = {name: s for name, (s, _, _) in timer.snapshot().items()}
+    with open(output_fn, 'w') as fout:
+        json.dump(stats, fout, indent=2)
+
+
+def format_seconds(seconds):
+    """Example: 3725 -> '1h02m05s'"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '{0}h{1:02d}m{2:02d}s'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    if seconds >= 60:
+        return '{0}m{1:02d}s'.format(seconds // 60, seconds % 60)
+    return '{0}s'.format(seconds)
+
+
+class SamplingProfiler:
+    """Samples the stacks of all other threads every interval seconds from a background thread.
+
+    Stacks are written in the collapsed format ('outer;inner;innermost count' per line) that flame graph tools such as
+    flamegraph.pl or speedscope read. Sampling only sees Python frames and costs a few percent of one core.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self.samples[tuple(stack)] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, output_fn):
+        with open(output_fn, 'w') as fout:
+            for stack, count in self.samples.most_common():
+                fout.write('{0} {1}\n'.format(';'.join('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+                                                       for code in reversed(stack)), count))
+        print("Wrote {0} profile samples to {1}".format(sum(self.samples.values()), output_fn))
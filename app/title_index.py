@@ -0,0 +1,186 @@
+"""Local lookup from Wikipedia article title to QID, so that requests by title need no Wikipedia API call.
+
+The dump script can write an index of the sitelinks of every item in its output (see --title_index in
+bulk/wikidata_ids_to_topics_dumps.py). An index is a directory with:
+    meta.json -- when and from what the index was built and how many titles it has
+    keys.npy  -- sorted 64-bit hashes of '<wiki>|<normalized title>' -- e.g., 'en|Douglas Adams'
+    qids.npy  -- QIDs as integers (Q42 -> 42) in the same order as keys.npy
+Both arrays are memory-mapped, so a lookup in any language is one hash and a binary search.
+Titles are not stored: if two titles ever hash to the same key, both are left out so that they fall back to the API.
+
+Indexes of separate dump shards can be merged into one:
+    python3 title_index.py models/title_index shard_00_titles shard_01_titles ...
+"""
+from array import array
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+# titles are appended to the partial index in chunks of this many
+FLUSH_SIZE = 1000000
+
+
+def normalize_title(title):
+    """Titles as MediaWiki stores them: 'douglas_adams ' -> 'Douglas adams'"""
+    title = ' '.join(title.replace('_', ' ').split())
+    return title[:1].upper() + title[1:]
+
+
+def title_key(wiki, title):
+    """Key of a title on a wiki. wiki is the language / site prefix -- e.g., 'en' (enwiki) or 'zh-min-nan' (zh_min_nanwiki)."""
+    text = '{0}|{1}'.format(wiki.replace('-', '_'), normalize_title(title))
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class TitleIndex:
+    """Memory-mapped lookup from (wiki, title) to QID."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as fin:
+            self.meta = json.load(fin)
+        self.built = self.meta['built']
+        self.keys = np.load(os.path.join(index_dir, 'keys.npy'), mmap_mode='r')
+        self.qids = np.load(os.path.join(index_dir, 'qids.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, wiki, title):
+        """QID of the item with this title on wiki (e.g., 'en') -- None if the title is not in the index."""
+        if not len(self.keys):
+            return None
+        key = np.uint64(title_key(wiki, title))
+        row = int(np.searchsorted(self.keys, key))
+        if row < len(self.keys) and self.keys[row] == key:
+            return 'Q{0}'.format(self.qids[row])
+        return None
+
+
+def write_index(index_dir, keys, qids, source=None):
+    """Write an index from keys and QIDs in any order. Keys that map to more than one QID are left out."""
+    keys = np.asarray(keys, dtype=np.uint64)
+    qids = np.asarray(qids, dtype=np.uint32)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    qids = qids[order]
+    # a key repeated with the same QID is kept once; a key with different QIDs is a hash collision and dropped
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    conflicted = np.zeros(len(keys), dtype=bool)
+    conflicted[1:] = ~first[1:] & (qids[1:] != qids[:-1])
+    bad_groups = np.zeros(len(starts), dtype=bool)
+    np.logical_or.at(bad_groups, np.cumsum(first) - 1, conflicted)
+    keep = starts[~bad_groups]
+
+    os.makedirs(index_dir, exist_ok=True)
+    np.save(os.path.join(index_dir, 'keys.npy'), keys[keep])
+    np.save(os.path.join(index_dir, 'qids.npy'), qids[keep])
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as fout:
+        json.dump({'built': time.time(), 'source': source, 'titles': len(keep),
+                   'dropped_collisions': int(bad_groups.sum())}, fout)
+    return len(keep)
+
+
+def item_title_keys(items):
+    """Keys and QIDs for the titles of dump items (qid, {wiki: title}, ...) -> (array of keys, array of QIDs)."""
+    keys = array('Q')
+    qids = array('I')
+    for item in items:
+        qid = int(item[0][1:])
+        for wiki, title in item[1].items():
+            if title:
+                keys.append(title_key(wiki, title))
+                qids.append(qid)
+    return keys, qids
+
+
+class TitleIndexWriter:
+    """Collects titles while the dump is processed and writes the index at the end.
+
+    Keys and QIDs are appended to files in <index_dir>.partial so memory stays flat while the dump is processed.
+    sync() returns the number of titles written, which a resumed run passes back as entries to drop anything after it.
+    """
+
+    def __init__(self, index_dir, entries=None):
+        self.index_dir = index_dir
+        self.partial_dir = index_dir + '.partial'
+        keys_fn = os.path.join(self.partial_dir, 'keys.bin')
+        qids_fn = os.path.join(self.partial_dir, 'qids.bin')
+        if entries is None:
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
+            os.makedirs(self.partial_dir)
+            entries = 0
+        self._keys_file = open(keys_fn, 'ab')
+        self._qids_file = open(qids_fn, 'ab')
+        self._keys_file.truncate(entries * 8)
+        self._qids_file.truncate(entries * 4)
+        self.entries = entries
+        self._keys = array('Q')
+        self._qids = array('I')
+
+    def add_items(self, items):
+        keys, qids = item_title_keys(items)
+        self.add(keys, qids)
+
+    def add(self, keys, qids):
+        self._keys.extend(keys)
+        self._qids.extend(qids)
+        if len(self._keys) >= FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        self._keys.tofile(self._keys_file)
+        self._qids.tofile(self._qids_file)
+        self.entries += len(self._keys)
+        del self._keys[:]
+        del self._qids[:]
+
+    def sync(self):
+        """Write out everything added so far -> number of titles in the partial index."""
+        self._flush()
+        for f in (self._keys_file, self._qids_file):
+            f.flush()
+            os.fsync(f.fileno())
+        return self.entries
+
+    def finish(self, source=None):
+        """Sort the titles into the index at index_dir (replacing any index there) -> number of titles."""
+        self.sync()
+        self._keys_file.close()
+        self._qids_file.close()
+        keys = np.fromfile(os.path.join(self.partial_dir, 'keys.bin'), dtype=np.uint64)
+        qids = np.fromfile(os.path.join(self.partial_dir, 'qids.bin'), dtype=np.uint32)
+        new_dir = self.index_dir + '.new'
+        shutil.rmtree(new_dir, ignore_errors=True)
+        num_titles = write_index(new_dir, keys, qids, source=source)
+        del keys, qids
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+        os.replace(new_dir, self.index_dir)
+        shutil.rmtree(self.partial_dir)
+        return num_titles
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir",
+                        help="Where to write the merged index.")
+    parser.add_argument("index_dirs",
+                        nargs='+',
+                        help="Indexes to merge -- e.g., from dump shards.")
+    args = parser.parse_args()
+
+    indexes = [TitleIndex(d) for d in args.index_dirs]
+    num_titles = write_index(args.output_dir, np.concatenate([i.keys for i in indexes]),
+                             np.concatenate([i.qids for i in indexes]), source=args.index_dirs)
+    print("Wrote {0} titles to {1}".format(num_titles, args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
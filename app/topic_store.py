@@ -0,0 +1,206 @@
+"""Precomputed topic predictions for every item, looked up by QID without calling Wikidata or running the model.
+
+A store is a directory built from the output of the dump script (see bulk/build_topic_store.py):
+    meta.json   -- labels, claim-based rules, the minimum score that was kept, the threshold of the dump run and how
+                   precisely scores are stored, when and from what the store was built
+    keys.npy    -- sorted QIDs as integers (Q42 -> 42)
+    offsets.npy -- start of each item's labels in labels.npy / scores.npy (plus the end)
+    labels.npy  -- label IDs (indices into meta['labels']), highest-scoring first for each item
+    scores.npy  -- scores that go with labels.npy
+    rules.npy   -- bitmask of the claim-based rules that applied to each item (bit i: meta['rules'][i])
+All arrays are memory-mapped so a lookup is a binary search over keys plus a slice of the other arrays.
+
+Labels are kept if their score is at or above the threshold, the same comparison as for live predictions. The dump
+made that comparison before its scores were rounded (JSON lines) or stored as float16 / float32 (columnar), so the
+store only answers for the dump's own threshold, or for higher thresholds when none of the item's stored scores is
+within meta['score_precision'] of it -- otherwise rounding could change which labels are kept and it is predicted live.
+
+New stores are published by building them in a new directory under a store root and then atomically pointing the
+root's 'current' symlink at it. ReloadingTopicStore notices the new target and switches to it between requests.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+CURRENT = 'current'
+LABEL_DTYPE = np.uint16
+RULES_DTYPE = np.uint16
+SCORE_DTYPE = np.float32
+
+
+class TopicStore:
+    """Memory-mapped lookup from QID to (label, score) lists and the names of the rules that applied to the item."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as fin:
+            self.meta = json.load(fin)
+        self.labels = self.meta['labels']
+        self.min_score = self.meta['min_score']
+        self.built = self.meta['built']
+        self.keys = np.load(os.path.join(store_dir, 'keys.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'), mmap_mode='r')
+        self.label_ids = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(store_dir, 'scores.npy'), mmap_mode='r')
+        self.threshold = self.meta.get('threshold')
+        self.score_precision = self.meta.get('score_precision')
+        # stores built from outputs without rules cannot explain their scores, so they do not answer lookups
+        self.rule_names = self.meta.get('rules')
+        self.rules = None
+        if self.rule_names is not None:
+            self.rules = np.load(os.path.join(store_dir, 'rules.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _row(self, qid):
+        if not qid.startswith('Q') or not qid[1:].isdigit():
+            return None
+        key = int(qid[1:])
+        row = int(np.searchsorted(self.keys, key))
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return None
+
+    def __contains__(self, qid):
+        return self._row(qid) is not None
+
+    def usable(self):
+        """Whether the store was built with everything needed to answer the same as live predictions."""
+        return self.rules is not None and self.score_precision is not None
+
+    def lookup(self, qid, threshold=0.5):
+        """([(label, score), ...] at or above threshold, highest first; [rule name, ...]) -- None if the QID is not
+        in the store, the threshold is below the lowest score that was kept when the store was built, or a stored
+        score is too close to the threshold to tell whether the label would be kept."""
+        if threshold < self.min_score or not self.usable():
+            return None
+        row = self._row(qid)
+        if row is None:
+            return None
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        # the dump already compared the unrounded scores with its own threshold
+        exact = threshold == self.threshold
+        topics = []
+        for label_id, score in zip(self.label_ids[start:end].tolist(), self.scores[start:end].tolist()):
+            if not exact:
+                if abs(score - threshold) <= self.score_precision:
+                    return None
+                if score < threshold:
+                    break
+            topics.append((self.labels[label_id], score))
+        mask = int(self.rules[row])
+        return topics, [name for bit, name in enumerate(self.rule_names) if mask >> bit & 1]
+
+
+def write_store(store_dir, labels, keys, counts, label_ids, scores, rules, rule_names, threshold, score_precision,
+                min_score=None, source=None):
+    """Write a store from CSR arrays in any QID order: for each item (keys[i]), counts[i] of label_ids / scores.
+
+    rules[i] is the bitmask of the rules that applied to the item, with the names of the bits in rule_names.
+    threshold is the one the dump run compared its scores with and score_precision the largest difference between
+    those scores and the ones given here (e.g., from rounding them).
+
+    Items are sorted by QID (the last row wins if a QID is repeated) and each item's labels by descending score.
+    Only scores that may be at or above min_score (by default, the threshold) are kept.
+    """
+    if min_score is None:
+        min_score = threshold
+    keys = np.asarray(keys, dtype=np.uint32)
+    counts = np.asarray(counts, dtype=np.int64)
+    label_ids = np.asarray(label_ids, dtype=LABEL_DTYPE)
+    scores = np.asarray(scores, dtype=SCORE_DTYPE)
+    rows = np.repeat(np.arange(len(keys)), counts)
+    # scores just below min_score are kept so that lookups can tell they are too close to a threshold to answer
+    keep = scores >= min_score - score_precision
+    if min_score == threshold:
+        # everything in the dump output is at or above its threshold
+        keep[:] = True
+    # one entry per QID: the last row for each
+    order = np.argsort(keys, kind='stable')
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = keys[order][1:] != keys[order][:-1]
+    order = order[last]
+    rank = np.full(len(keys), -1, dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    # sort entries by their item's position in the store and then by descending score
+    entry_rank = rank[rows]
+    keep &= entry_rank >= 0
+    entry_order = np.lexsort((-scores[keep].astype(np.float64), entry_rank[keep]))
+    new_counts = np.bincount(entry_rank[keep], minlength=len(order))
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(new_counts, out=offsets[1:])
+
+    os.makedirs(store_dir, exist_ok=True)
+    np.save(os.path.join(store_dir, 'keys.npy'), keys[order])
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(store_dir, 'labels.npy'), label_ids[keep][entry_order])
+    np.save(os.path.join(store_dir, 'scores.npy'), scores[keep][entry_order])
+    np.save(os.path.join(store_dir, 'rules.npy'), np.asarray(rules, dtype=RULES_DTYPE)[order])
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as fout:
+        json.dump({'labels': list(labels), 'rules': list(rule_names), 'min_score': float(min_score),
+                   'threshold': float(threshold), 'score_precision': float(score_precision), 'built': time.time(), 'source': source,
+                   'items': len(order)}, fout)
+
+
+def publish(store_root, store_dir):
+    """Atomically make store_dir the current store under store_root."""
+    tmp_link = os.path.join(store_root, CURRENT + '.tmp')
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(os.path.abspath(store_dir), os.path.abspath(store_root)), tmp_link)
+    os.replace(tmp_link, os.path.join(store_root, CURRENT))
+
+
+class ReloadingTopicStore:
+    """The current store under a store root, reloaded when a new store has been published.
+
+    The symlink is checked at most every check_interval seconds. Lookups return None when there is no store yet
+    or the store is older than max_age seconds, so that callers fall back to live predictions.
+    """
+
+    def __init__(self, store_root, check_interval=10, max_age=None):
+        self.link = os.path.join(store_root, CURRENT)
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.store = None
+        self._target = None
+        self._last_check = 0
+        self.hits = 0
+        self.misses = 0
+
+    def current(self):
+        now = time.time()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            target = os.path.realpath(self.link) if os.path.lexists(self.link) else None
+            if target != self._target:
+                # existing lookups keep using the old store's memory maps until they finish
+                self.store = TopicStore(target) if target is not None else None
+                self._target = target
+                if target is not None:
+                    print("Loaded topic store {0} ({1} items)".format(target, len(self.store)))
+                    if not self.store.usable():
+                        print("Topic store {0} has no claim-based rules or score precision: "
+                              "rebuild it with the current build_topic_store.py".format(target))
+        if self.store is not None and self.max_age is not None and now - self.store.built > self.max_age:
+            return None
+        return self.store
+
+    def lookup(self, qid, threshold=0.5):
+        store = self.current()
+        found = store.lookup(qid, threshold) if store is not None else None
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    def stats(self):
+        store = self.current()
+        lookups = self.hits + self.misses
+        return {'store': self._target, 'items': len(store) if store is not None else 0,
+                'built': store.built if store is not None else None, 'max_age': self.max_age,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0}
@@ -0,0 +1,108 @@
+"""Client for the Wikidata and Wikipedia APIs that is shared by all of the request threads of an app process.
+
+Requests reuse a pool of keep-alive connections, have connect / read timeouts, and at most max_concurrency of them
+are in flight at once. Request threads that cannot get a slot within queue_timeout seconds fail fast with UpstreamBusy
+instead of piling up behind a slow API, so a slow wikidata.org does not take all of the app's threads with it.
+"""
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from timing import stage
+
+
+class UpstreamError(Exception):
+    """The API call failed or returned an error."""
+
+
+class UpstreamBusy(UpstreamError):
+    """Too many API calls were already in flight."""
+
+
+class WikiClient:
+    """Pooled, rate-limited HTTP client for MediaWiki APIs. Use api(url) to get a session for one wiki."""
+
+    def __init__(self, user_agent, timeout=(3.05, 10), max_concurrency=16, queue_timeout=1, max_hosts=32):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_hosts = max_hosts
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+
+    @property
+    def session(self):
+        # connections must not be shared with a parent / child process, so each process opens its own pool
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                session.headers['User-Agent'] = self.user_agent
+                adapter = HTTPAdapter(pool_connections=self.max_hosts, pool_maxsize=self.max_concurrency)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _count(self, counter, n=1):
+        # counters are updated by all of the request threads
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get(self, api_url, **params):
+        """JSON result of a GET request to api_url. Raises UpstreamError if the call fails or the API returns an error."""
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._count('rejected')
+            raise UpstreamBusy("{0} API calls already in flight".format(self.max_concurrency))
+        self._count('in_flight')
+        try:
+            self._count('requests')
+            with stage('fetch'):
+                resp = self.session.get(api_url, params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            with stage('decode'):
+                result = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            self._count('failures')
+            raise UpstreamError(str(e))
+        finally:
+            self._count('in_flight', -1)
+            self._slots.release()
+        if 'error' in result:
+            self._count('failures')
+            raise UpstreamError(result['error'].get('info', result['error']))
+        return result
+
+    def api(self, api_url):
+        return WikiSession(self, api_url)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def stats(self):
+        with self._lock:
+            return {'max_concurrency': self.max_concurrency, 'in_flight': self.in_flight, 'requests': self.requests,
+                    'failures': self.failures, 'rejected': self.rejected}
+
+
+class WikiSession:
+    """The API of one wiki, called like mwapi.Session: session.get(action='query', ...)."""
+
+    def __init__(self, client, api_url):
+        self.client = client
+        self.api_url = api_url
+
+    def get(self, **params):
+        return self.client.get(self.api_url, **params)
@@ -0,0 +1,7 @@
+"""Production entry point: gunicorn -c gunicorn.conf.py wsgi:application
+
+gunicorn.conf.py preloads this module in the parent process, so the model is loaded once and shared by all workers.
+"""
+from app import create_app
+
+application = create_app()
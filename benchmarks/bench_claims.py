@@ -0,0 +1,137 @@
+"""Compare the memory and time per million items of claims as strings with claims as token IDs (see app/claims.py).
+
+    strings -- the previous path: (property, value) tuples, joined into a shuffled string that the model splits again
+    ids     -- token IDs collected in a reused buffer and scored without building strings (with NumPy-exported models)
+
+Items are synthetic (see synthetic.py). For each path this reports the seconds to extract claims (with the rules mask
+and fingerprint) and to score them, the bytes held by the extracted claims, and the peak memory allocated while
+extracting and scoring one batch (traced with tracemalloc in a separate pass, so the timings are not affected):
+
+    python3 bench_claims.py --fasttext_model ../app/models/model_npy --num_items 100000
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+from random import sample
+import sys
+import time
+import tracemalloc
+
+from synthetic import synthetic_item
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from claims import ClaimEncoder, fingerprint
+from inference import TopicModel
+from rules import DEFAULT_RULES
+
+PER = 10 ** 6
+
+
+def strings_extract(claims):
+    """The previous claims conversion -> (claims string, rules mask, fingerprint)."""
+    claims_tuples = []
+    for prop in claims:
+        included = False
+        for statement in claims[prop]:
+            try:
+                if statement['type'] == 'statement' and statement['mainsnak']['datatype'] == 'wikibase-item':
+                    claims_tuples.append((prop, statement['mainsnak']['datavalue']['value']['id']))
+                    included = True
+            except Exception:
+                continue
+        if not included:
+            claims_tuples.append((prop,))
+    if not len(claims_tuples):
+        claims_tuples = [('<NOCLAIM>',)]
+    claims_str = ' '.join([' '.join(c) for c in sample(claims_tuples, len(claims_tuples))])
+    claims_bytes = '\n'.join(sorted(' '.join(c) for c in claims_tuples)).encode('utf-8')
+    return claims_str, DEFAULT_RULES.mask(claims_tuples), hashlib.blake2b(claims_bytes, digest_size=8).hexdigest()
+
+
+def ids_extract(encoder, claims):
+    ids, _ = encoder.encode(claims)
+    return ids, DEFAULT_RULES.mask_ids(ids), fingerprint(ids)
+
+
+def run_path(path, model, entities, batch_size, encoder):
+    """Extract and score all entities in batches -> (extract seconds, predict seconds, bytes held by the claims)."""
+    extract_seconds = 0
+    predict_seconds = 0
+    held = 0
+    for i in range(0, len(entities), batch_size):
+        start = time.perf_counter()
+        if path == 'strings':
+            items = [strings_extract(e['claims']) for e in entities[i:i + batch_size]]
+        else:
+            items = [ids_extract(encoder, e['claims']) for e in entities[i:i + batch_size]]
+        extract_seconds += time.perf_counter() - start
+        held += sum(sys.getsizeof(item[0]) for item in items)
+        claims = [item[0] for item in items]
+        start = time.perf_counter()
+        if path == 'strings':
+            model.predict(claims)
+        else:
+            model.predict_ids(claims)
+        predict_seconds += time.perf_counter() - start
+    return extract_seconds, predict_seconds, held
+
+
+def peak_batch_memory(path, model, entities):
+    """Peak bytes allocated while extracting and scoring one batch of entities."""
+    encoder = ClaimEncoder()
+    # warm up caches so that only the per-item allocations are traced
+    run_path(path, model, entities, len(entities), encoder)
+    gc.collect()
+    tracemalloc.start()
+    if path == 'strings':
+        model.predict([strings_extract(e['claims'])[0] for e in entities])
+    else:
+        model.predict_ids([ids_extract(encoder, e['claims'])[0] for e in entities])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasttext_model",
+                        default="../app/models/model_npy",
+                        help="Location of a fastText .bin model or of a model exported for NumPy scoring. "
+                             "Token IDs are only scored directly by exported models.")
+    parser.add_argument("--num_items",
+                        default=100000,
+                        type=int,
+                        help="Number of synthetic items.")
+    parser.add_argument("--batch_size",
+                        default=1000,
+                        type=int,
+                        help="Items per batch, as in the bulk scripts.")
+    parser.add_argument("--output",
+                        default=None,
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    model = TopicModel.load(args.fasttext_model)
+    entities = [synthetic_item('Q{0}'.format(i))[0] for i in range(1, args.num_items + 1)]
+    scale = PER / len(entities)
+    results = {'fasttext_model': args.fasttext_model, 'num_items': len(entities)}
+    for path in ('strings', 'ids'):
+        extract_seconds, predict_seconds, held = run_path(path, model, entities, args.batch_size, ClaimEncoder())
+        peak = peak_batch_memory(path, model, entities[:args.batch_size])
+        results[path] = {'extract_seconds_per_million': extract_seconds * scale,
+                         'predict_seconds_per_million': predict_seconds * scale,
+                         'claims_mb_per_million': held * scale / 2 ** 20,
+                         'peak_mb_per_batch': peak / 2 ** 20}
+        print("{0:>7}: extract {1:.1f}s, predict {2:.1f}s per million items. Claims take {3:.0f} MB per million items. "
+              "Peak {4:.1f} MB allocated per batch of {5}.".format(
+                  path, extract_seconds * scale, predict_seconds * scale, held * scale / 2 ** 20, peak / 2 ** 20,
+                  args.batch_size))
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
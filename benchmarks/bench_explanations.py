@@ -0,0 +1,111 @@
+"""Compare the time to explain predictions with the batched explanations in app/explain.py and with LIME.
+
+LIME is only run if the lime module is installed. Claims strings are either read from a file (one per line)
+or built from random words in the vocabulary of a fastText .bin model.
+
+    python3 bench_explanations.py --fasttext_model ../app/models/model.bin --num_items 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from explain import NUM_FEATURES, explain
+from inference import TopicModel
+
+
+def random_claims_strs(model, num_items, max_claims=20, seed=0):
+    """Claims strings built from random words in the model's vocabulary (or random IDs if it has no word list)."""
+    rng = random.Random(seed)
+    if hasattr(model.model, 'get_words'):
+        words = [w for w in model.model.get_words() if w != '</s>']
+    else:
+        words = ['P{0}'.format(rng.randint(1, 3000)) for _ in range(500)] + ['Q{0}'.format(rng.randint(1, 10 ** 7)) for _ in range(2000)]
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(1, max_claims))) for _ in range(num_items)]
+
+
+def claims_tuples(claims_str):
+    """Example: 'P31 Q5 P625' -> [('P31', 'Q5'), ('P625',)] -- tokens before the first property are left out."""
+    claims = []
+    for token in claims_str.split():
+        if token.startswith('P'):
+            claims.append((token,))
+        elif claims and len(claims[-1]) == 1:
+            claims[-1] = (claims[-1][0], token)
+    return claims
+
+
+def top_labels(model, claims_str, num_labels):
+    scores = model.predict([claims_str])[0]
+    return [model.labels[i] for i in scores.argsort()[::-1][:num_labels]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasttext_model",
+                        default="../app/models/model.bin",
+                        help="Location of pretrained fastText model (probably .bin file) "
+                             "or of the model exported for NumPy scoring (see app/numpy_fasttext.py)")
+    parser.add_argument("--input_claims",
+                        default=None,
+                        help="File with one claims string (e.g., 'P31 Q5 P21 Q6581097') per line. Random claims if not provided.")
+    parser.add_argument("--num_items",
+                        default=50,
+                        type=int,
+                        help="Number of items to explain.")
+    parser.add_argument("--num_labels",
+                        default=2,
+                        type=int,
+                        help="Number of labels explained per item (the highest-scoring ones).")
+    parser.add_argument("--num_samples",
+                        default=5000,
+                        type=int,
+                        help="Number of perturbed strings for LIME and for the sampled batched explanations (LIME's default is 5000).")
+    args = parser.parse_args()
+
+    model = TopicModel.load(args.fasttext_model)
+    if args.input_claims:
+        with open(args.input_claims, 'r') as fin:
+            claims_strs = [line.strip() for line in fin][:args.num_items]
+    else:
+        claims_strs = random_claims_strs(model, args.num_items)
+    labels = [top_labels(model, c, args.num_labels) for c in claims_strs]
+
+    results = {}
+    for name, num_samples in [('leave-one-out', 0), ('leave-one-out + {0} samples'.format(args.num_samples), args.num_samples)]:
+        start = time.perf_counter()
+        results[name] = [explain(model, claims_tuples(c), l, num_samples=num_samples) for c, l in zip(claims_strs, labels)]
+        elapsed = time.perf_counter() - start
+        print("Batched {0}: {1:.1f} ms per item".format(name, 1000 * elapsed / len(claims_strs)))
+
+    try:
+        from lime.lime_text import LimeTextExplainer
+    except ImportError:
+        print("LIME is not installed (pip install lime) -- skipping.")
+        return
+    explainer = LimeTextExplainer(class_names=model.labels)
+    start = time.perf_counter()
+    lime_results = []
+    for c, l in zip(claims_strs, labels):
+        exp = explainer.explain_instance(c, model.predict, num_features=NUM_FEATURES, num_samples=args.num_samples,
+                                         labels=[model.label_to_idx[lbl] for lbl in l])
+        lime_results.append({lbl: exp.as_list(label=model.label_to_idx[lbl]) for lbl in l})
+    lime_time = time.perf_counter() - start
+    print("LIME ({0} samples): {1:.1f} ms per item".format(args.num_samples, 1000 * lime_time / len(claims_strs)))
+
+    # how many of LIME's top tokens are part of the top claims in the batched explanations
+    for name in results:
+        overlap = []
+        for batched_exp, lime_exp in zip(results[name], lime_results):
+            for lbl in lime_exp:
+                lime_tokens = set(t for t, _ in lime_exp[lbl])
+                if lime_tokens:
+                    claim_tokens = set(t for claim, _ in batched_exp[lbl] for t in claim.split(':'))
+                    overlap.append(len(lime_tokens & claim_tokens) / len(lime_tokens))
+        print("{0}: {1:.0%} of LIME's top tokens in common".format(name, sum(overlap) / len(overlap) if overlap else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare the per-item model.predict loop with batched predictions from inference.TopicModel.
+
+Claims strings are either read from a file (one per line) or sampled at random from the model's vocabulary.
+
+    python3 bench_inference.py --fasttext_model ../app/models/model.bin --num_items 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import fasttext
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from inference import TopicModel
+from numpy_fasttext import NumpyFastText
+
+
+def random_claims_strs(model, num_items, max_claims=20, seed=0):
+    """Claims strings built from random words in the model's vocabulary."""
+    rng = random.Random(seed)
+    words = [w for w in model.get_words() if w != '</s>']
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(1, max_claims))) for _ in range(num_items)]
+
+
+def per_item(model, claims_strs, threshold):
+    """The original approach: one predict call, dict, and Python sort per item."""
+    output = []
+    for claims_str in claims_strs:
+        lbls, scores = model.predict(claims_str, k=-1)
+        results = {l:s for l,s in zip(lbls, scores)}
+        sorted_res = [(l.replace("__label__", ""), results[l]) for l in sorted(results, key=results.get, reverse=True)]
+        output.append([r for r in sorted_res if r[1] >= threshold])
+    return output
+
+
+def batched(topic_model, claims_strs, threshold, batch_size):
+    output = []
+    for i in range(0, len(claims_strs), batch_size):
+        scores = topic_model.predict(claims_strs[i:i + batch_size])
+        output.extend(topic_model.rank(scores, threshold))
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasttext_model",
+                        default="../app/models/model.bin",
+                        help="Location of pretrained fastText model (probably .bin file)")
+    parser.add_argument("--numpy_model",
+                        default=None,
+                        help="Also benchmark the model exported for NumPy scoring at this location (see app/numpy_fasttext.py)")
+    parser.add_argument("--input_claims",
+                        default=None,
+                        help="File with one claims string (e.g., 'P31 Q5 P21 Q6581097') per line. Random claims if not provided.")
+    parser.add_argument("--num_items",
+                        default=50000,
+                        type=int,
+                        help="Number of items to score.")
+    parser.add_argument("--batch_size",
+                        default=1000,
+                        type=int,
+                        help="Number of items scored at once by the batched approach.")
+    parser.add_argument("--threshold",
+                        default=0.5,
+                        type=float,
+                        help="Minimum score for a topic to be kept.")
+    args = parser.parse_args()
+
+    model = fasttext.load_model(args.fasttext_model)
+    topic_model = TopicModel(model)
+    if args.input_claims:
+        with open(args.input_claims, 'r') as fin:
+            claims_strs = [line.strip() for line in fin][:args.num_items]
+    else:
+        claims_strs = random_claims_strs(model, args.num_items)
+
+    start = time.perf_counter()
+    expected = per_item(model, claims_strs, args.threshold)
+    per_item_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = batched(topic_model, claims_strs, args.threshold, args.batch_size)
+    batched_time = time.perf_counter() - start
+
+    mismatches = sum(1 for e, a in zip(expected, actual) if dict(e) != dict(a))
+    print("{0} items. {1} mismatched results.".format(len(claims_strs), mismatches))
+    print("Per-item loop: {0:.0f} items/sec".format(len(claims_strs) / per_item_time))
+    print("Batched (batch size {0}): {1:.0f} items/sec ({2:.1f}x)".format(
+        args.batch_size, len(claims_strs) / batched_time, per_item_time / batched_time))
+
+    if args.numpy_model:
+        start = time.perf_counter()
+        numpy_model = TopicModel(NumpyFastText(args.numpy_model))
+        load_time = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = batched(numpy_model, claims_strs, args.threshold, args.batch_size)
+        numpy_time = time.perf_counter() - start
+        mismatches = sum(1 for e, a in zip(expected, actual) if dict(e).keys() != dict(a).keys())
+        print("NumPy model (loaded in {0:.3f} sec): {1:.0f} items/sec ({2:.1f}x). {3} items with different labels.".format(
+            load_time, len(claims_strs) / numpy_time, per_item_time / numpy_time, mismatches))
+
+
+if __name__ == "__main__":
+    main()
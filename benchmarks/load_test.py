@@ -0,0 +1,176 @@
+"""Load test of the app against a local mock of the Wikidata API (see mock_wikidata.py) -> requests/second and latency percentiles.
+
+By default this starts the mock API and the production server (gunicorn, see app/gunicorn.conf.py) pointed at it,
+sends requests from --concurrency threads for --duration seconds, and then stops the server with SIGTERM:
+
+    python3 load_test.py --concurrency 32 --duration 30 --latency 50
+    python3 load_test.py --batch_size 50 --output results.json
+
+Use --url to test an app that is already running (it must already be pointed at a mock API).
+Requests are for random QIDs out of --num_qids, so a smaller pool means more cache hits.
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from mock_wikidata import start_server
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app')
+
+
+def start_app(app_cmd, port, api_url, workers, threads, env=None):
+    """Run the app pointed at the mock API -> process, once it reports ready. env: extra environment variables
+    (e.g., {'FLASK_MODEL_PATH': ...} to serve another model)."""
+    env = dict(os.environ, BIND='127.0.0.1:{0}'.format(port), WEB_CONCURRENCY=str(workers), THREADS=str(threads),
+               DRAIN_SECONDS='1', FLASK_WIKIDATA_API=api_url, FLASK_WIKIPEDIA_API=api_url, **(env or {}))
+    proc = subprocess.Popen(app_cmd.split(), cwd=APP_DIR, env=env)
+    url = 'http://127.0.0.1:{0}'.format(port)
+    for _ in range(600):
+        if proc.poll() is not None:
+            raise RuntimeError("App exited with code {0}".format(proc.returncode))
+        try:
+            if requests.get(url + '/ready', timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("App did not become ready.")
+
+
+def run_load(url, concurrency, duration, num_qids, batch_size, seed=0):
+    """Send requests from many threads until duration is up -> (latencies in seconds, status codes, elapsed seconds)."""
+    latencies = []
+    statuses = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(client_id):
+        rng = random.Random(seed * 1000 + client_id)
+        session = requests.Session()
+        my_latencies = []
+        my_statuses = []
+        while time.perf_counter() < deadline:
+            qids = ['Q{0}'.format(rng.randint(1, num_qids)) for _ in range(max(1, batch_size))]
+            start = time.perf_counter()
+            try:
+                if batch_size:
+                    resp = session.post(url + '/api/v1/wikidata/topics', json={'qids': qids}, timeout=60)
+                else:
+                    resp = session.get(url + '/api/v1/wikidata/topic', params={'qid': qids[0]}, timeout=60)
+                resp.content
+                status = resp.status_code
+            except requests.RequestException:
+                status = 0
+            my_latencies.append(time.perf_counter() - start)
+            my_statuses.append(status)
+        with lock:
+            latencies.extend(my_latencies)
+            statuses.extend(my_statuses)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return np.array(latencies), statuses, time.perf_counter() - start
+
+
+def summarize(latencies, statuses, elapsed, batch_size):
+    """Requests, errors, requests/sec, items/sec, and latency percentiles (ms) of a run_load run."""
+    results = {'requests': len(latencies), 'errors': sum(1 for s in statuses if s != 200),
+               'requests_per_second': len(latencies) / elapsed,
+               'items_per_second': len(latencies) * max(1, batch_size) / elapsed}
+    for p in (50, 90, 99):
+        results['p{0}_ms'.format(p)] = float(np.percentile(latencies, p) * 1000) if len(latencies) else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url",
+                        default=None,
+                        help="Base URL of an app that is already running -- e.g., http://127.0.0.1:8000. "
+                             "If not provided, the app is started with --app_cmd.")
+    parser.add_argument("--app_cmd",
+                        default="gunicorn -c gunicorn.conf.py wsgi:application",
+                        help="Command that starts the app (run from the app directory).")
+    parser.add_argument("--port",
+                        default=8000,
+                        type=int,
+                        help="Port for the app started with --app_cmd.")
+    parser.add_argument("--workers",
+                        default=4,
+                        type=int,
+                        help="App worker processes.")
+    parser.add_argument("--threads",
+                        default=8,
+                        type=int,
+                        help="Threads per app worker.")
+    parser.add_argument("--latency",
+                        default=50,
+                        type=float,
+                        help="Milliseconds the mock API waits before answering.")
+    parser.add_argument("--concurrency",
+                        default=32,
+                        type=int,
+                        help="Number of clients sending requests at the same time.")
+    parser.add_argument("--duration",
+                        default=20,
+                        type=float,
+                        help="Seconds to send requests for.")
+    parser.add_argument("--num_qids",
+                        default=10 ** 6,
+                        type=int,
+                        help="Requests are for random QIDs between Q1 and Q<num_qids>.")
+    parser.add_argument("--batch_size",
+                        default=0,
+                        type=int,
+                        help="QIDs per POST to the batch endpoint. 0 sends single-item GET requests instead.")
+    parser.add_argument("--output",
+                        default=None,
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    mock, api_url = start_server(latency=args.latency / 1000)
+    proc = None
+    url = args.url
+    if url is None:
+        proc, url = start_app(args.app_cmd, args.port, api_url, args.workers, args.threads)
+    try:
+        latencies, statuses, elapsed = run_load(url, args.concurrency, args.duration, args.num_qids, args.batch_size)
+    finally:
+        shutdown_time = None
+        if proc is not None:
+            start = time.perf_counter()
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+            shutdown_time = time.perf_counter() - start
+        mock.shutdown()
+
+    results = {'endpoint': 'batch' if args.batch_size else 'single', 'batch_size': args.batch_size,
+               'concurrency': args.concurrency, 'mock_latency_ms': args.latency, 'workers': args.workers,
+               'threads': args.threads}
+    results.update(summarize(latencies, statuses, elapsed, args.batch_size))
+    results['shutdown_seconds'] = shutdown_time
+    print("{0} requests in {1:.1f} seconds ({2} errors): {3:.1f} req/s, p50 {4:.1f} ms, p99 {5:.1f} ms".format(
+        results['requests'], elapsed, results['errors'], results['requests_per_second'], results['p50_ms'] or 0,
+        results['p99_ms'] or 0))
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2)
+    return 0 if not results['errors'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Local stand-in for the Wikidata and Wikipedia APIs, for load tests that should not touch wikidata.org.
+
+Answers wbgetentities with synthetic items (the same ones as in the synthetic dump, see synthetic.py) and pageprops
+queries with a QID for every title, after an optional delay to mimic the real API's latency:
+
+    python3 mock_wikidata.py --port 8001 --latency 50
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic import synthetic_item
+
+
+def title_qid(title):
+    return 'Q{0}'.format(random.Random(title).randint(1, 10 ** 8))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, which would otherwise stall keep-alive connections
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        if self.latency:
+            time.sleep(self.latency)
+        if params.get('action') == 'wbgetentities':
+            result = {'entities': {qid: synthetic_item(qid)[0] for qid in params.get('ids', '').split('|') if qid}}
+        elif params.get('action') == 'query':
+            result = {'query': {'pages': [{'title': t, 'pageprops': {'wikibase_item': title_qid(t)}}
+                                          for t in params.get('titles', '').split('|') if t]}}
+        else:
+            result = {'error': {'code': 'badvalue', 'info': 'Unsupported action: {0}'.format(params.get('action'))}}
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(port=0, latency=0):
+    """Serve the mock API from a background thread -> (server, API URL). Port 0 picks a free port."""
+    handler = type('Handler', (MockHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}/w/api.php'.format(server.server_address[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port",
+                        default=8001,
+                        type=int,
+                        help="Port to listen on.")
+    parser.add_argument("--latency",
+                        default=50,
+                        type=float,
+                        help="Milliseconds to wait before answering each request.")
+    args = parser.parse_args()
+
+    server, api_url = start_server(args.port, args.latency / 1000)
+    print("Mock API at {0}".format(api_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
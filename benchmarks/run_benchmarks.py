@@ -0,0 +1,257 @@
+"""Offline benchmarks of the dump script, the bulk API script, and the app -> throughput / latency saved as JSON.
+
+Everything runs against synthetic fixtures (see synthetic.py) and the mock API (see mock_wikidata.py), so no real dump,
+model, or network access is needed. Fixtures are generated into --fixtures_dir on the first run and reused after that.
+
+    python3 run_benchmarks.py --output results/baseline.json
+    (... change something ...)
+    python3 run_benchmarks.py --output results/new.json --compare results/baseline.json
+
+With --compare, results that are more than --tolerance worse than the baseline are listed as regressions and the
+exit code is 1. Higher is better for *_per_second results; lower is better for *_ms and *seconds results.
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from load_test import run_load, start_app, summarize
+from mock_wikidata import start_server
+import synthetic
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BULK_DIR = os.path.join(BENCHMARKS_DIR, os.pardir, 'bulk')
+SUITES = ('dump', 'api', 'app')
+
+
+def ensure_fixtures(fixtures_dir, dump_items, api_items, model_items, processes=1):
+    """Generate the synthetic dump, input QIDs, and fastText model if they do not exist yet -> {name: path}."""
+    os.makedirs(fixtures_dir, exist_ok=True)
+    fixtures = {'dump': os.path.join(fixtures_dir, 'latest-all-{0}.json.bz2'.format(dump_items)),
+                'qids': os.path.join(fixtures_dir, 'qids-{0}.txt'.format(api_items)),
+                'model': os.path.join(fixtures_dir, 'model-{0}.bin'.format(model_items))}
+    if not os.path.exists(fixtures['dump']):
+        print("Generating a synthetic dump with {0} items".format(dump_items))
+        synthetic.write_dump(fixtures['dump'] + '.partial', dump_items, processes=processes)
+        os.replace(fixtures['dump'] + '.partial', fixtures['dump'])
+    if not os.path.exists(fixtures['qids']):
+        synthetic.write_qids(fixtures['qids'], api_items)
+    if not os.path.exists(fixtures['model']):
+        print("Training a fixture model on {0} items".format(model_items))
+        synthetic.train_model(fixtures['model'], model_items)
+    return {name: os.path.abspath(path) for name, path in fixtures.items()}
+
+
+def run_script(script, args, work_dir):
+    """Run a bulk script with --stats_output -> its stats."""
+    stats_fn = os.path.join(work_dir, 'stats.json')
+    cmd = [sys.executable, os.path.join(BULK_DIR, script), '--stats_output', stats_fn, '--report_interval', '3600'] + args
+    subprocess.run(cmd, check=True, cwd=BULK_DIR, stdout=subprocess.DEVNULL)
+    with open(stats_fn) as fin:
+        return json.load(fin)
+
+
+def bench_dump(fixtures, workers, work_dir):
+    results = {}
+    for num_workers in sorted({0, workers}):
+        name = 'dump.sequential' if not num_workers else 'dump.workers_{0}'.format(num_workers)
+        print("Running {0}".format(name))
+        results[name] = run_script('wikidata_ids_to_topics_dumps.py',
+                                   ['--fasttext_model', fixtures['model'], '--dump_fn', fixtures['dump'],
+                                    '--output_results', os.path.join(work_dir, 'dump_output.json.bz2'),
+                                    '--threshold', '0.1', '--workers', str(num_workers)], work_dir)
+    return results
+
+
+def bench_api(fixtures, concurrency, latency, work_dir):
+    results = {}
+    mock, api_url = start_server(latency=latency / 1000)
+    try:
+        for c in sorted({1, concurrency}):
+            name = 'api.concurrency_{0}'.format(c)
+            print("Running {0}".format(name))
+            results[name] = run_script('wikidata_ids_to_topics_api.py',
+                                       ['--fasttext_model', fixtures['model'], '--input_qids', fixtures['qids'],
+                                        '--output_results', os.path.join(work_dir, 'api_output.txt'),
+                                        '--threshold', '0.1', '--concurrency', str(c), '--wikidata_api', api_url], work_dir)
+    finally:
+        mock.shutdown()
+    return results
+
+
+def bench_app(fixtures, args):
+    results = {}
+    mock, api_url = start_server(latency=args.latency / 1000)
+    proc = None
+    try:
+        proc, url = start_app(args.app_cmd, args.port, api_url, args.app_workers, args.app_threads,
+                              env={'FLASK_MODEL_PATH': fixtures['model']})
+        for name, batch_size in (('app.single', 0), ('app.batch_{0}'.format(args.batch_size), args.batch_size)):
+            print("Running {0}".format(name))
+            # a short warm-up so that first-request costs are not counted
+            run_load(url, args.concurrency, 1, args.num_qids, batch_size, seed=1)
+            latencies, statuses, elapsed = run_load(url, args.concurrency, args.duration, args.num_qids, batch_size)
+            results[name] = summarize(latencies, statuses, elapsed, batch_size)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+        mock.shutdown()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Results that got more than tolerance (fraction) worse than in the baseline -> list of (benchmark, metric, old, new)."""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, new in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            if metric.endswith('_per_second'):
+                worse = new < old * (1 - tolerance)
+            elif metric.endswith('_ms') or metric.endswith('seconds'):
+                worse = new > old * (1 + tolerance)
+            else:
+                continue
+            print("{0:<24} {1:<20} {2:>12.2f} -> {3:>12.2f} ({4:+.1%}){5}".format(
+                name, metric, old, new, new / old - 1, '  REGRESSION' if worse else ''))
+            if worse:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suites",
+                        default=','.join(SUITES),
+                        help="Comma-separated benchmarks to run: dump (dump script), api (bulk API script), app (Flask app).")
+    parser.add_argument("--fixtures_dir",
+                        default=os.path.join(BENCHMARKS_DIR, 'fixtures'),
+                        help="Where synthetic fixtures are generated and reused from.")
+    parser.add_argument("--dump_items",
+                        default=50000,
+                        type=int,
+                        help="Number of items in the synthetic dump.")
+    parser.add_argument("--api_items",
+                        default=5000,
+                        type=int,
+                        help="Number of QIDs labeled by the bulk API script.")
+    parser.add_argument("--model_items",
+                        default=20000,
+                        type=int,
+                        help="Number of synthetic items that the fixture model is trained on.")
+    parser.add_argument("--workers",
+                        default=2,
+                        type=int,
+                        help="--workers for the parallel run of the dump script (it is also run sequentially).")
+    parser.add_argument("--api_concurrency",
+                        default=4,
+                        type=int,
+                        help="--concurrency for the second run of the bulk API script (the first uses 1).")
+    parser.add_argument("--latency",
+                        default=50,
+                        type=float,
+                        help="Milliseconds the mock API waits before answering.")
+    parser.add_argument("--app_cmd",
+                        default="gunicorn -c gunicorn.conf.py wsgi:application",
+                        help="Command that starts the app (run from the app directory).")
+    parser.add_argument("--port",
+                        default=8000,
+                        type=int,
+                        help="Port for the app.")
+    parser.add_argument("--app_workers",
+                        default=2,
+                        type=int,
+                        help="App worker processes.")
+    parser.add_argument("--app_threads",
+                        default=8,
+                        type=int,
+                        help="Threads per app worker.")
+    parser.add_argument("--concurrency",
+                        default=16,
+                        type=int,
+                        help="Number of clients sending requests to the app at the same time.")
+    parser.add_argument("--duration",
+                        default=10,
+                        type=float,
+                        help="Seconds to send requests to each app endpoint for.")
+    parser.add_argument("--num_qids",
+                        default=10 ** 6,
+                        type=int,
+                        help="App requests are for random QIDs between Q1 and Q<num_qids>.")
+    parser.add_argument("--batch_size",
+                        default=50,
+                        type=int,
+                        help="QIDs per request to the app's batch endpoint.")
+    parser.add_argument("--output",
+                        default=None,
+                        help="Write the results (and how they were run) to this JSON file.")
+    parser.add_argument("--compare",
+                        default=None,
+                        help="Results JSON of an earlier run to compare with.")
+    parser.add_argument("--tolerance",
+                        default=0.1,
+                        type=float,
+                        help="With --compare, how much worse (as a fraction) a result can be before it is a regression.")
+    args = parser.parse_args()
+
+    suites = args.suites.split(',')
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error("Unknown suite: {0}".format(suite))
+    fixtures = ensure_fixtures(args.fixtures_dir, args.dump_items, args.api_items, args.model_items,
+                               processes=os.cpu_count() or 1)
+
+    start = time.time()
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        if 'dump' in suites:
+            results.update(bench_dump(fixtures, args.workers, work_dir))
+        if 'api' in suites:
+            results.update(bench_api(fixtures, args.api_concurrency, args.latency, work_dir))
+        if 'app' in suites:
+            results.update(bench_app(fixtures, args))
+
+    for name, metrics in results.items():
+        summary = ', '.join('{0} {1:.2f}'.format(metric, value) for metric, value in sorted(metrics.items())
+                            if isinstance(value, float) and (metric.endswith('_per_second') or metric.endswith('_ms')))
+        print("{0}: {1}".format(name, summary))
+    print("Benchmarks took {0:.1f} seconds.".format(time.time() - start))
+
+    if args.output:
+        output = {'meta': {'timestamp': datetime.now(timezone.utc).isoformat(), 'git_commit': git_commit(),
+                           'python': platform.python_version(), 'platform': platform.platform(),
+                           'cpu_count': os.cpu_count(), 'args': vars(args)},
+                  'results': results}
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, indent=2)
+        print("Results written to {0}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        print("Compared with {0} (commit {1}):".format(args.compare, baseline['meta'].get('git_commit')))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        print("{0} regressions (tolerance {1:.0%}).".format(len(regressions), args.tolerance))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""Synthetic Wikidata items for benchmarks that should not need the real dump, the real model, or wikidata.org.
+
+Every QID always gets the same made-up item (the random generator is seeded with it), so the synthetic dump,
+the mock API (see mock_wikidata.py), and the fixture model's training data all agree. Items are drawn from a few
+kinds -- people, places, creative works, taxa, scholarly articles, lists, ... -- with claims, sitelinks,
+and external IDs in the proportions and JSON layout of the real dump, so that parsing and filtering cost about as much.
+
+    python3 synthetic.py dump fixtures/latest-all.json.bz2 --num_items 100000
+    python3 synthetic.py model fixtures/model.bin --num_items 20000
+"""
+import argparse
+import bz2
+import json
+import multiprocessing as mp
+import os
+import random
+import tempfile
+
+COUNTRIES = ['Q30', 'Q145', 'Q183', 'Q142', 'Q38', 'Q29', 'Q17', 'Q148', 'Q668', 'Q155', 'Q16', 'Q96', 'Q159', 'Q408']
+# the continent-level topic of each country
+COUNTRY_REGIONS = {'Q30': 'Geography.Regions.Americas.North_America', 'Q16': 'Geography.Regions.Americas.North_America',
+                   'Q96': 'Geography.Regions.Americas.North_America', 'Q155': 'Geography.Regions.Americas.South_America',
+                   'Q17': 'Geography.Regions.Asia.East_Asia', 'Q148': 'Geography.Regions.Asia.East_Asia',
+                   'Q668': 'Geography.Regions.Asia.South_Asia', 'Q408': 'Geography.Regions.Oceania'}
+OCCUPATIONS = {'Q36180': 'Culture.Literature', 'Q33999': 'Culture.Media.Films', 'Q177220': 'Culture.Media.Music',
+               'Q937857': 'Culture.Sports', 'Q82955': 'History_and_Society.Politics_and_government',
+               'Q901': 'STEM.STEM*', 'Q1622272': 'History_and_Society.Education', 'Q1028181': 'Culture.Visual_arts.Visual_arts*',
+               'Q39631': 'STEM.Medicine_&_Health', 'Q81096': 'STEM.Engineering'}
+GENRES = ['Q130232', 'Q157443', 'Q188473', 'Q959790', 'Q2484376', 'Q1054574', 'Q11399', 'Q37073']
+TAXON_RANKS = ['Q7432', 'Q34740', 'Q35409', 'Q36602']
+# properties with values that are not items (ignored by the model except for the property itself)
+OTHER_DATATYPES = {'P569': 'time', 'P570': 'time', 'P577': 'time', 'P625': 'globe-coordinate', 'P1082': 'quantity',
+                   'P2044': 'quantity', 'P856': 'url', 'P18': 'commonsMedia', 'P373': 'string', 'P1476': 'monolingualtext'}
+EXTERNAL_IDS = ['P214', 'P227', 'P244', 'P268', 'P349', 'P646', 'P2671', 'P213', 'P1006', 'P356', 'P698', 'P932']
+WIKIS = ['enwiki', 'dewiki', 'frwiki', 'eswiki', 'itwiki', 'ruwiki', 'jawiki', 'zhwiki', 'ptwiki', 'arwiki', 'nlwiki',
+         'plwiki', 'svwiki', 'cebwiki', 'commonswiki', 'specieswiki', 'enwikiquote']
+
+# each kind of item: how common it is, the claims it has (property, values or None for other datatypes, probability),
+# how many external IDs and sitelinks it has, and its topics
+KINDS = [
+    {'name': 'person', 'weight': 20, 'claims': [('P31', ['Q5'], 1), ('P21', ['Q6581097', 'Q6581072'], 0.95),
+                                                ('P27', COUNTRIES, 0.8), ('P106', list(OCCUPATIONS), 0.9),
+                                                ('P569', None, 0.9), ('P570', None, 0.4), ('P18', None, 0.3)],
+     'external_ids': (2, 10), 'sitelinks': (0, 12), 'topics': ['Culture.Biography.Biography*']},
+    {'name': 'place', 'weight': 12, 'claims': [('P31', ['Q515', 'Q532', 'Q486972', 'Q3957'], 1), ('P17', COUNTRIES, 1),
+                                               ('P131', ['Q1384', 'Q99', 'Q64', 'Q90', 'Q1490'], 0.7),
+                                               ('P625', None, 0.9), ('P1082', None, 0.6), ('P2044', None, 0.3)],
+     'external_ids': (0, 4), 'sitelinks': (1, 15), 'topics': ['Geography.Geographical']},
+    {'name': 'film', 'weight': 6, 'claims': [('P31', ['Q11424'], 1), ('P136', GENRES, 0.9), ('P495', COUNTRIES, 0.9),
+                                             ('P577', None, 0.9), ('P57', ['Q25191', 'Q8877', 'Q56093'], 0.6),
+                                             ('P1476', None, 0.5)],
+     'external_ids': (1, 6), 'sitelinks': (0, 8), 'topics': ['Culture.Media.Films', 'Culture.Media.Media*']},
+    {'name': 'album', 'weight': 5, 'claims': [('P31', ['Q482994'], 1), ('P136', GENRES, 0.8), ('P577', None, 0.8),
+                                              ('P175', ['Q1299', 'Q2831', 'Q15862'], 0.9)],
+     'external_ids': (1, 4), 'sitelinks': (0, 5), 'topics': ['Culture.Media.Music', 'Culture.Media.Media*']},
+    {'name': 'taxon', 'weight': 15, 'claims': [('P31', ['Q16521'], 1), ('P105', TAXON_RANKS, 1),
+                                               ('P171', ['Q25314', 'Q5113', 'Q10908', 'Q1390'], 0.95), ('P225', None, 1)],
+     'external_ids': (1, 8), 'sitelinks': (0, 4), 'topics': ['STEM.Biology']},
+    {'name': 'organization', 'weight': 5, 'claims': [('P31', ['Q4830453', 'Q3918', 'Q43229', 'Q163740'], 1),
+                                                     ('P17', COUNTRIES, 0.9), ('P159', ['Q60', 'Q84', 'Q90'], 0.5),
+                                                     ('P856', None, 0.6), ('P452', ['Q11661', 'Q8148', 'Q1344'], 0.4)],
+     'external_ids': (1, 6), 'sitelinks': (0, 6), 'topics': ['History_and_Society.Business_and_economics']},
+    {'name': 'scholarly article', 'weight': 30, 'claims': [('P31', ['Q13442814'], 1), ('P1476', None, 1),
+                                                           ('P577', None, 1), ('P921', ['Q12136', 'Q11190', 'Q7150'], 0.7),
+                                                           ('P50', ['Q42', 'Q937', 'Q7186'], 0.3)],
+     'external_ids': (1, 3), 'sitelinks': (0, 0), 'topics': ['STEM.STEM*']},
+    {'name': 'list', 'weight': 2, 'claims': [('P31', ['Q13406463', 'Q4167410'], 1), ('P360', ['Q5', 'Q515', 'Q11424'], 0.6)],
+     'external_ids': (0, 0), 'sitelinks': (1, 6), 'topics': ['Compilation.List_Disambig']},
+    {'name': 'other', 'weight': 5, 'claims': [('P31', ['Q4167836', 'Q11266439', 'Q17633526'], 0.8), ('P373', None, 0.3)],
+     'external_ids': (0, 2), 'sitelinks': (0, 3), 'topics': ['Culture.Philosophy_and_religion']},
+]
+KIND_CUM_WEIGHTS = []
+for _kind in KINDS:
+    KIND_CUM_WEIGHTS.append((KIND_CUM_WEIGHTS[-1] if KIND_CUM_WEIGHTS else 0) + _kind['weight'])
+WORDS = ['river', 'house', 'saint', 'north', 'battle', 'song', 'garden', 'star', 'island', 'castle', 'station', 'lake',
+         'history', 'school', 'bridge', 'museum', 'valley', 'mount', 'new', 'old', 'red', 'blue', 'king', 'queen']
+
+
+def _snak(prop, datatype, value):
+    if datatype == 'wikibase-item':
+        datavalue = {'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value},
+                     'type': 'wikibase-entityid'}
+    elif datatype == 'time':
+        datavalue = {'value': {'time': '+1950-01-01T00:00:00Z', 'timezone': 0, 'before': 0, 'after': 0, 'precision': 11,
+                               'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}, 'type': 'time'}
+    elif datatype == 'globe-coordinate':
+        datavalue = {'value': {'latitude': 51.5, 'longitude': -0.12, 'altitude': None, 'precision': 0.0001,
+                               'globe': 'http://www.wikidata.org/entity/Q2'}, 'type': 'globecoordinate'}
+    elif datatype == 'quantity':
+        datavalue = {'value': {'amount': '+12345', 'unit': '1'}, 'type': 'quantity'}
+    elif datatype == 'monolingualtext':
+        datavalue = {'value': {'text': value, 'language': 'en'}, 'type': 'monolingualtext'}
+    else:
+        datavalue = {'value': value, 'type': 'string'}
+    return {'snaktype': 'value', 'property': prop, 'datavalue': datavalue, 'datatype': datatype}
+
+
+def _statement(qid, rng, prop, datatype, value):
+    statement = {'mainsnak': _snak(prop, datatype, value), 'type': 'statement',
+                 'id': '{0}${1:08X}-{2:04X}'.format(qid, rng.getrandbits(32), rng.getrandbits(16)), 'rank': 'normal'}
+    if rng.random() < 0.5:
+        statement['references'] = [{'hash': '{0:040x}'.format(rng.getrandbits(160)),
+                                    'snaks': {'P248': [_snak('P248', 'wikibase-item', 'Q36578')]},
+                                    'snaks-order': ['P248']}]
+    return statement
+
+
+def synthetic_item(qid):
+    """Dump / wbgetentities JSON for a QID -> (entity, kind). The same QID always gives the same item."""
+    rng = random.Random(qid)
+    pick = rng.random() * KIND_CUM_WEIGHTS[-1]
+    kind = next(k for k, w in zip(KINDS, KIND_CUM_WEIGHTS) if pick < w)
+    label = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+    claims = {}
+    for prop, values, probability in kind['claims']:
+        if rng.random() >= probability:
+            continue
+        if values is None:
+            datatype = OTHER_DATATYPES.get(prop, 'string')
+            claims[prop] = [_statement(qid, rng, prop, datatype, label)]
+        else:
+            claims[prop] = [_statement(qid, rng, prop, 'wikibase-item', rng.choice(values))
+                            for _ in range(1 if rng.random() < 0.8 else 2)]
+    for prop in rng.sample(EXTERNAL_IDS, rng.randint(*kind['external_ids'])):
+        claims[prop] = [_statement(qid, rng, prop, 'external-id', str(rng.randint(10 ** 5, 10 ** 9)))]
+    sitelinks = {}
+    for wiki in rng.sample(WIKIS, rng.randint(*kind['sitelinks'])):
+        sitelinks[wiki] = {'site': wiki, 'title': label, 'badges': []}
+    entity = {'type': 'item', 'id': qid,
+              'labels': {lang: {'language': lang, 'value': label} for lang in ('en', 'de', 'fr')[:rng.randint(1, 3)]},
+              'descriptions': {'en': {'language': 'en', 'value': '{0} ({1})'.format(kind['name'], label)}},
+              'aliases': {}, 'claims': claims, 'sitelinks': sitelinks, 'lastrevid': rng.randint(10 ** 8, 2 * 10 ** 9)}
+    return entity, kind
+
+
+def item_topics(entity, kind):
+    """Topics that the fixture model is trained to predict for an item."""
+    topics = list(kind['topics'])
+    claims = entity['claims']
+    for statement in claims.get('P106', []):
+        topics.append(OCCUPATIONS[statement['mainsnak']['datavalue']['value']['id']])
+    if 'Q6581072' in [s['mainsnak']['datavalue']['value']['id'] for s in claims.get('P21', [])]:
+        topics.append('Culture.Biography.Women')
+    for prop in ('P17', 'P27', 'P495'):
+        for statement in claims.get(prop, []):
+            country = statement['mainsnak']['datavalue']['value']['id']
+            topics.append(COUNTRY_REGIONS.get(country, 'Geography.Regions.Europe.Europe*'))
+    return sorted(set(topics))
+
+
+def claims_str(entity):
+    """Claims in the model's bag-of-words format (as the bulk scripts build them)."""
+    tokens = []
+    for prop, statements in entity['claims'].items():
+        values = [s['mainsnak']['datavalue']['value']['id'] for s in statements
+                  if s['mainsnak']['datatype'] == 'wikibase-item']
+        if values:
+            for value in values:
+                tokens.extend([prop, value])
+        else:
+            tokens.append(prop)
+    return ' '.join(tokens) or '<NOCLAIM>'
+
+
+def _dump_chunk(task):
+    """bz2-compressed dump lines for num_items items starting at first_qid (a stream of a multi-stream bz2 file)."""
+    first_qid, num_items, last_qid, properties_every = task
+    lines = []
+    for qid_num in range(first_qid, first_qid + num_items):
+        if properties_every and qid_num % properties_every == 0:
+            prop = {'type': 'property', 'datatype': 'wikibase-item', 'id': 'P{0}'.format(qid_num // properties_every),
+                    'labels': {}, 'descriptions': {}, 'aliases': {}, 'claims': {}}
+            lines.append(json.dumps(prop) + ',\n')
+        entity, _ = synthetic_item('Q{0}'.format(qid_num))
+        lines.append(json.dumps(entity) + (',\n' if qid_num < last_qid else '\n'))
+    return bz2.compress(''.join(lines).encode('utf-8'))
+
+
+def write_dump(dump_fn, num_items, first_qid=1, properties_every=1000, processes=1, chunk_size=10000):
+    """Write a dump like latest-all.json.bz2: a JSON array with one entity per line, including a property
+    entity every properties_every items.
+
+    Chunks of items are compressed separately (in parallel with processes > 1) into a multi-stream bz2 file,
+    as parallel bzip2 tools do. Compression takes most of the time.
+    """
+    last_qid = first_qid + num_items - 1
+    tasks = [(start, min(chunk_size, last_qid + 1 - start), last_qid, properties_every)
+             for start in range(first_qid, last_qid + 1, chunk_size)]
+    with open(dump_fn, 'wb') as fout:
+        fout.write(bz2.compress(b'[\n'))
+        if processes > 1:
+            with mp.Pool(processes) as pool:
+                for chunk in pool.imap(_dump_chunk, tasks):
+                    fout.write(chunk)
+        else:
+            for task in tasks:
+                fout.write(_dump_chunk(task))
+        fout.write(bz2.compress(b']\n'))
+
+
+def write_qids(qids_fn, num_items, first_qid=1):
+    """Input for the bulk API script: one {"QID": ...} object per line."""
+    with open(qids_fn, 'w') as fout:
+        for i in range(num_items):
+            fout.write(json.dumps({'QID': 'Q{0}'.format(first_qid + i)}) + '\n')
+
+
+def train_model(model_fn, num_items, first_qid=10 ** 7, dim=16, epoch=10):
+    """Train a small fastText model on synthetic items (QIDs that are not in the synthetic dump by default)."""
+    import fasttext
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as fout:
+        train_fn = fout.name
+        for i in range(num_items):
+            entity, kind = synthetic_item('Q{0}'.format(first_qid + i))
+            fout.write(' '.join('__label__' + t for t in item_topics(entity, kind)) + ' ' + claims_str(entity) + '\n')
+    try:
+        model = fasttext.train_supervised(train_fn, loss='ova', dim=dim, epoch=epoch, lr=0.5, minCount=1, thread=1, seed=0,
+                                          verbose=0)
+    finally:
+        os.remove(train_fn)
+    model.save_model(model_fn)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fixture",
+                        choices=['dump', 'qids', 'model'],
+                        help="What to generate: a bz2 JSON dump, an input file for the bulk API script, or a fastText model.")
+    parser.add_argument("output_fn",
+                        help="Where to write it.")
+    parser.add_argument("--num_items",
+                        default=100000,
+                        type=int,
+                        help="Number of items in the dump / input file, or to train the model on.")
+    parser.add_argument("--processes",
+                        default=1,
+                        type=int,
+                        help="Number of processes that generate and compress the dump.")
+    parser.add_argument("--first_qid",
+                        default=None,
+                        type=int,
+                        help="Number of the first QID. Defaults to 1 (dump, qids) or 10000000 (model).")
+    args = parser.parse_args()
+
+    if args.fixture == 'dump':
+        write_dump(args.output_fn, args.num_items, first_qid=args.first_qid or 1, processes=args.processes)
+    elif args.fixture == 'qids':
+        write_qids(args.output_fn, args.num_items, first_qid=args.first_qid or 1)
+    else:
+        train_model(args.output_fn, args.num_items, first_qid=args.first_qid or 10 ** 7)
+    print("Wrote {0}".format(args.output_fn))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Build the topic lookup store served by the Flask app (see app/topic_store.py) from the output of the dump script.
+
+Each build goes into a new directory under the store root, which is then published as the current store:
+    python3 build_topic_store.py dump_output.json.bz2 ../app/models/topic_store --min_score 0.1
+    python3 build_topic_store.py columnar_output_dir ../app/models/topic_store
+The app switches to the new store without restarting.
+
+The dump output only has scores at or above the --threshold it was run with, so the store must not claim to have lower
+ones: requests for thresholds below the store's minimum score are answered live. Columnar output records its threshold,
+which is used as the minimum score. JSON lines output does not, so pass the dump run's --threshold as --min_score
+(otherwise the dump script's default of 0.5 is assumed).
+
+The store also records how precisely the output holds scores (4 decimals in JSON lines, the score dtype in columnar
+output), so that it only answers when rounding cannot change which labels are at or above the requested threshold.
+
+The store also keeps which claim-based rules applied to each item, so that its answers have the same explanations as
+live predictions. Outputs written before the dump script recorded them have to be re-run.
+"""
+import argparse
+import bz2
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from columnar import ColumnarReader, qid_to_int
+
+# shared modules live alongside the Flask app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from topic_store import CURRENT, publish, write_store
+
+# default --threshold of wikidata_ids_to_topics_dumps.py
+DUMP_THRESHOLD = 0.5
+# JSON lines output has scores rounded to 4 decimals, which the store then keeps as float32
+JSONL_SCORE_PRECISION = 0.5e-4 + float(np.finfo(np.float32).eps)
+
+
+def read_jsonl_output(output_fn):
+    """CSR arrays of mid-level predictions from JSON lines output
+    -> (labels, keys, counts, label IDs, scores, rule masks, rule names)."""
+    labels = []
+    label_to_idx = {}
+    rule_names = []
+    rule_bits = {}
+    keys = []
+    counts = []
+    label_ids = []
+    scores = []
+    rules = []
+    with bz2.open(output_fn, 'rt') as fin:
+        for i, line in enumerate(fin, start=1):
+            row = json.loads(line)
+            if 'rules' not in row:
+                raise ValueError("{0} was written before the dump script recorded claim-based rules ({1}): "
+                                 "re-run it to build a store.".format(output_fn, row['qid']))
+            mask = 0
+            for name in row['rules']:
+                if name not in rule_bits:
+                    rule_bits[name] = len(rule_names)
+                    rule_names.append(name)
+                mask |= 1 << rule_bits[name]
+            rules.append(mask)
+            keys.append(qid_to_int(row['qid']))
+            counts.append(len(row['predicted_mid_labels']))
+            for label, score in row['predicted_mid_labels']:
+                if label not in label_to_idx:
+                    label_to_idx[label] = len(labels)
+                    labels.append(label)
+                label_ids.append(label_to_idx[label])
+                scores.append(score)
+            if i % 1000000 == 0:
+                print("{0} rows read.".format(i))
+    return labels, keys, counts, label_ids, np.array(scores, dtype=np.float32), rules, rule_names
+
+
+def read_columnar_output(output_dir):
+    """CSR arrays of mid-level predictions from columnar output
+    -> (labels, keys, counts, label IDs, scores, rule masks, rule names)."""
+    reader = ColumnarReader(output_dir)
+    if 'rules' not in reader.meta:
+        raise ValueError("{0} was written before the dump script recorded claim-based rules: "
+                         "re-run it to build a store.".format(output_dir))
+    return (reader.labels, reader.column('qid'), reader.column('mid_count'), reader.column('mid_label'),
+            reader.column('mid_score'), reader.column('rules'), reader.meta['rules'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump_output",
+                        help="Output of wikidata_ids_to_topics_dumps.py: JSON lines (.bz2) or a columnar output directory.")
+    parser.add_argument("store_root",
+                        help="Directory that holds the stores -- e.g., ../app/models/topic_store")
+    parser.add_argument("--min_score",
+                        default=None,
+                        type=float,
+                        help="Only keep scores at or above this value. Requests for lower thresholds are answered live. "
+                             "Defaults to the threshold of the dump run: read from columnar output; for JSON lines output, "
+                             "pass the run's --threshold (otherwise {0} is assumed).".format(DUMP_THRESHOLD))
+    parser.add_argument("--keep",
+                        default=2,
+                        type=int,
+                        help="Number of stores (including the new one) to keep. Older ones are deleted.")
+    args = parser.parse_args()
+
+    start = time.time()
+    min_score = args.min_score
+    if os.path.isdir(args.dump_output):
+        meta = ColumnarReader(args.dump_output).meta
+        # a threshold of 0 or less keeps every score
+        threshold = max(meta['threshold'], 0)
+        if min_score is None:
+            min_score = threshold
+        elif min_score < threshold:
+            parser.error("--min_score {0} is below the threshold that {1} was written with ({2}).".format(
+                min_score, args.dump_output, threshold))
+        score_precision = float(np.finfo(meta['score_dtype']).eps)
+        read_output = read_columnar_output
+    else:
+        if min_score is None:
+            print("Assuming the dump output was written with the default --threshold {0} "
+                  "(pass --min_score otherwise).".format(DUMP_THRESHOLD))
+            min_score = DUMP_THRESHOLD
+        threshold = min_score = max(min_score, 0)
+        score_precision = JSONL_SCORE_PRECISION
+        read_output = read_jsonl_output
+    try:
+        labels, keys, counts, label_ids, scores, rules, rule_names = read_output(args.dump_output)
+    except ValueError as e:
+        parser.error(str(e))
+    print("Keeping scores >= {0}. Requests for lower thresholds are answered live.".format(min_score))
+
+    os.makedirs(args.store_root, exist_ok=True)
+    store_dir = os.path.join(args.store_root, time.strftime('%Y%m%d-%H%M%S'))
+    write_store(store_dir, labels, keys, counts, label_ids, scores, rules, rule_names, threshold, score_precision,
+                min_score=min_score, source=os.path.abspath(args.dump_output))
+    publish(args.store_root, store_dir)
+    print("Built and published {0} in {1:.1f} seconds.".format(store_dir, time.time() - start))
+
+    # stores are named by when they were built so the oldest sort first
+    stores = sorted(d for d in os.listdir(args.store_root)
+                    if d != CURRENT and os.path.isdir(os.path.join(args.store_root, d)))
+    for d in stores[:max(0, len(stores) - args.keep)]:
+        shutil.rmtree(os.path.join(args.store_root, d))
+        print("Deleted old store {0}".format(d))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Block index for bz2 files so that a dump can be read starting from any block.
+
+bz2 compresses data in independent blocks (up to 900k each) that start with a 48-bit magic number.
+The blocks are not byte-aligned, so a block is read by copying its bits into a new single-block bz2 stream.
+Scanning the file for these magic numbers once gives an index that workers or separate jobs can use
+to each process one shard of the dump (--shard i/N), and the outputs of the shards concatenated in order
+are the same as the output of a run over the whole file.
+
+Build an index:
+    python3 bz2_index.py latest-all.json.bz2
+"""
+import argparse
+import bz2
+import json
+import os
+
+BLOCK_MAGIC = 0x314159265359  # pi
+EOS_MAGIC = 0x177245385090  # sqrt(pi) -- end of stream, followed by the 32-bit combined CRC
+MAGIC_BITS = 48
+CHUNK_SIZE = 2 ** 24
+
+
+def _search_patterns(magic):
+    """Byte patterns for finding a magic number at each of the 8 possible bit offsets within a byte.
+
+    For a bit offset of s, the magic spans 7 bytes (6 if s == 0) and bytes 1-5 are fully determined by it,
+    so they can be found with a fast byte search and the candidate checked against the full magic.
+    Returns a list of (shift, pattern, offset of pattern within the spanned bytes).
+    """
+    patterns = [(0, magic.to_bytes(6, 'big'), 0)]
+    for shift in range(1, 8):
+        spanned = (magic << (8 - shift)).to_bytes(7, 'big')
+        patterns.append((shift, spanned[1:6], 1))
+    return patterns
+
+
+def _matches(buf, byte_pos, shift, magic):
+    window = int.from_bytes(buf[byte_pos:byte_pos + 7].ljust(7, b'\x00'), 'big')
+    return (window >> (56 - shift - MAGIC_BITS)) & ((1 << MAGIC_BITS) - 1) == magic
+
+
+def scan_boundaries(fn, verbose=True):
+    """Find the bit offsets of all block and end-of-stream magic numbers in a bz2 file."""
+    block_starts = []
+    stream_ends = []
+    searches = [(BLOCK_MAGIC, block_starts, p) for p in _search_patterns(BLOCK_MAGIC)]
+    searches += [(EOS_MAGIC, stream_ends, p) for p in _search_patterns(EOS_MAGIC)]
+    with open(fn, 'rb') as fin:
+        base = 0  # file offset of buf[0]
+        buf = b''
+        chunks_read = 0
+        while True:
+            chunk = fin.read(CHUNK_SIZE)
+            at_eof = not chunk
+            buf += chunk
+            chunks_read += 1
+            # positions whose 7-byte window is incomplete are checked again with the next chunk
+            limit = len(buf) if at_eof else len(buf) - 7
+            for magic, found, (shift, pattern, pattern_offset) in searches:
+                idx = buf.find(pattern, pattern_offset)
+                while idx != -1 and idx - pattern_offset < limit:
+                    byte_pos = idx - pattern_offset
+                    if _matches(buf, byte_pos, shift, magic):
+                        found.append((base + byte_pos) * 8 + shift)
+                    idx = buf.find(pattern, idx + 1)
+            base += limit
+            buf = buf[limit:]
+            if at_eof:
+                break
+            if verbose and chunks_read % 64 == 0:
+                print("{0:.1f} GB scanned. {1} blocks found.".format(base / 1e9, len(block_starts)))
+    return sorted(set(block_starts)), sorted(set(stream_ends))
+
+
+def build_index(fn, verbose=True):
+    """Index the blocks in a bz2 file as [start bit, end bit) pairs."""
+    block_starts, stream_ends = scan_boundaries(fn, verbose=verbose)
+    boundaries = sorted(block_starts + stream_ends)
+    starts = set(block_starts)
+    blocks = [[b, boundaries[i + 1]] for i, b in enumerate(boundaries[:-1]) if b in starts]
+    return {'dump_fn': os.path.basename(fn), 'size': os.path.getsize(fn), 'blocks': blocks}
+
+
+def save_index(index, index_fn):
+    """Write the index atomically so that concurrent jobs never see a partial file."""
+    tmp_fn = '{0}.tmp{1}'.format(index_fn, os.getpid())
+    with open(tmp_fn, 'w') as fout:
+        json.dump(index, fout)
+    os.replace(tmp_fn, index_fn)
+
+
+def load_index(dump_fn, index_fn=None, build=True):
+    """Load the index for a dump (by default stored alongside it), building it first if missing."""
+    if index_fn is None:
+        index_fn = default_index_fn(dump_fn)
+    if not os.path.exists(index_fn):
+        if not build:
+            raise FileNotFoundError("No bz2 index at {0}".format(index_fn))
+        print("Building bz2 block index for {0} at {1}".format(dump_fn, index_fn))
+        save_index(build_index(dump_fn), index_fn)
+    with open(index_fn, 'r') as fin:
+        index = json.load(fin)
+    if index['size'] != os.path.getsize(dump_fn):
+        raise ValueError("Index {0} does not match {1} (file size differs).".format(index_fn, dump_fn))
+    return index
+
+
+def default_index_fn(dump_fn):
+    return dump_fn + '.idx.json'
+
+
+def read_block(fin, start_bit, end_bit):
+    """Decompress the single bz2 block stored at bits [start_bit, end_bit) of an open file."""
+    start_byte = start_bit // 8
+    end_byte = (end_bit + 7) // 8
+    fin.seek(start_byte)
+    data = fin.read(end_byte - start_byte)
+    nbits = end_bit - start_bit
+    block = int.from_bytes(data, 'big') >> (len(data) * 8 - (start_bit - start_byte * 8) - nbits)
+    block &= (1 << nbits) - 1
+    # the block CRC follows the block magic; for a single-block stream it is also the combined CRC
+    crc = (block >> (nbits - MAGIC_BITS - 32)) & 0xffffffff
+    stream = (((block << MAGIC_BITS) | EOS_MAGIC) << 32) | crc
+    stream_bits = nbits + MAGIC_BITS + 32
+    padding = -stream_bits % 8
+    return bz2.decompress(b'BZh9' + (stream << padding).to_bytes((stream_bits + padding) // 8, 'big'))
+
+
+def parse_shard(shard_str):
+    """Example: '3/16' -> (3, 16). Shards are numbered from 0."""
+    shard, num_shards = [int(s) for s in shard_str.split('/')]
+    if num_shards < 1 or not 0 <= shard < num_shards:
+        raise ValueError("Invalid shard: {0}. Expected i/N with 0 <= i < N.".format(shard_str))
+    return shard, num_shards
+
+
+def shard_block_range(blocks, shard, num_shards):
+    """Split the blocks into num_shards contiguous ranges of about equal compressed size -> [first, last) block."""
+    if not blocks:
+        return 0, 0
+    total = blocks[-1][1] - blocks[0][0]
+
+    def first_block(s):
+        if s == 0:
+            return 0
+        if s == num_shards:
+            return len(blocks)
+        target = blocks[0][0] + total * s // num_shards
+        for i, (start, _) in enumerate(blocks):
+            if start >= target:
+                return i
+        return len(blocks)
+
+    return first_block(shard), first_block(shard + 1)
+
+
+def iter_shard_lines(dump_fn, index, shard=0, num_shards=1, start=None, with_positions=False):
+    """Yield the decoded lines that start within one shard of the dump.
+
+    A line that crosses into the next shard is completed by reading ahead, and a partial line at the start
+    of the shard is left to the previous shard, so each line is yielded by exactly one shard.
+
+    With with_positions=True, (position, line) pairs are yielded instead, where position is [block, byte offset within
+    the decompressed block] of the start of the line. Passing a position as start resumes reading at that line.
+    """
+    blocks = index['blocks']
+    first, last = shard_block_range(blocks, shard, num_shards)
+    start_offset = 0
+    with open(dump_fn, 'rb') as fin:
+        if start is not None:
+            first, start_offset = start
+            skipping = False
+        else:
+            # a line belongs to this shard unless it started in the previous block
+            skipping = first > 0 and not read_block(fin, *blocks[first - 1]).endswith(b'\n')
+        pending = b''
+        pending_pos = None
+        for b in range(first, len(blocks)):
+            data = read_block(fin, *blocks[b])
+            base = 0
+            if b == first and start_offset:
+                data = data[start_offset:]
+                base = start_offset
+            if b >= last:
+                # past the shard: only finish the line that started inside it
+                if not pending:
+                    break
+                idx = data.find(b'\n')
+                if idx == -1:
+                    pending += data
+                    continue
+                line = (pending + data[:idx + 1]).decode('utf-8')
+                yield (pending_pos, line) if with_positions else line
+                pending = b''
+                break
+            if skipping:
+                idx = data.find(b'\n')
+                if idx == -1:
+                    continue
+                data = data[idx + 1:]
+                base += idx + 1
+                skipping = False
+            buf = pending + data
+            pos = pending_pos if pending else [b, base]
+            line_start = 0
+            idx = buf.find(b'\n')
+            while idx != -1:
+                line = buf[line_start:idx + 1].decode('utf-8')
+                yield (pos, line) if with_positions else line
+                line_start = idx + 1
+                pos = [b, base + line_start - len(pending)]
+                idx = buf.find(b'\n', line_start)
+            pending = buf[line_start:]
+            pending_pos = pos
+        if pending:
+            line = pending.decode('utf-8')
+            yield (pending_pos, line) if with_positions else line
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump_fn",
+                        help="bz2 file to index -- e.g., latest-all.json.bz2")
+    parser.add_argument("--output_index",
+                        default=None,
+                        help="Where to save the index. Defaults to <dump_fn>.idx.json")
+    args = parser.parse_args()
+
+    index_fn = args.output_index or default_index_fn(args.dump_fn)
+    index = build_index(args.dump_fn)
+    save_index(index, index_fn)
+    print("{0} blocks indexed in {1}".format(len(index['blocks']), index_fn))
+
+
+if __name__ == "__main__":
+    main()
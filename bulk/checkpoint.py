@@ -0,0 +1,107 @@
+"""Checkpoints so that an interrupted bulk run can be resumed without duplicated or missing output.
+
+While a run is in progress, output is written to <output>.partial and progress is periodically saved to <output>.ckpt:
+how far into the input the run has gotten, counters, and the size of the partial output at that point.
+A resumed run truncates the partial output back to that size (dropping anything written after the checkpoint)
+and continues from the saved input position. When the run finishes, the partial output is renamed to the
+output file in a single step so the output file is never incomplete.
+
+The output can also be a directory of files (e.g., columnar output), in which case the size of each file is saved.
+"""
+import json
+import os
+import shutil
+import time
+
+
+class Checkpoint:
+    """Progress of a bulk run, saved next to its output."""
+
+    def __init__(self, output_fn, config, interval=300, directory=False):
+        """config: arguments that must match for a run to be resumed (e.g., input file, threshold)."""
+        self.output_fn = output_fn
+        self.directory = directory
+        self.partial_fn = output_fn + '.partial'
+        self.checkpoint_fn = output_fn + '.ckpt'
+        self.config = config
+        self.interval = interval
+        self._last_saved = time.time()
+
+    def load(self):
+        """Saved state of an interrupted run, or None if there is nothing to resume."""
+        if not os.path.exists(self.checkpoint_fn) or not os.path.exists(self.partial_fn):
+            return None
+        with open(self.checkpoint_fn, 'r') as fin:
+            checkpoint = json.load(fin)
+        if checkpoint['config'] != self.config:
+            raise ValueError("Cannot resume: checkpoint {0} is for a run with different arguments: {1}".format(
+                self.checkpoint_fn, checkpoint['config']))
+        for fn, size in self._sizes(checkpoint['output_size']).items():
+            if not os.path.exists(fn) or os.path.getsize(fn) < size:
+                raise ValueError("Cannot resume: {0} is smaller than at the last checkpoint.".format(fn))
+        return checkpoint['state']
+
+    def _sizes(self, output_size):
+        """{file: size} for the output size saved in a checkpoint."""
+        if self.directory:
+            return {os.path.join(self.partial_fn, fn): size for fn, size in output_size.items()}
+        return {self.partial_fn: output_size}
+
+    def start(self, resume=False):
+        """Prepare the partial output file -> saved state to continue from, or None if starting from the beginning."""
+        state = self.load() if resume else None
+        if state is None:
+            if resume:
+                print("No checkpoint found at {0}. Starting from the beginning.".format(self.checkpoint_fn))
+            if self.directory:
+                shutil.rmtree(self.partial_fn, ignore_errors=True)
+                os.makedirs(self.partial_fn)
+                self.save({}, {})
+            else:
+                open(self.partial_fn, 'wb').close()
+                self.save({}, 0)
+        else:
+            with open(self.checkpoint_fn, 'r') as fin:
+                output_size = json.load(fin)['output_size']
+            # drop any output written after the checkpoint
+            sizes = self._sizes(output_size)
+            if self.directory:
+                for fn in os.listdir(self.partial_fn):
+                    if os.path.join(self.partial_fn, fn) not in sizes:
+                        os.remove(os.path.join(self.partial_fn, fn))
+            for fn, size in sizes.items():
+                with open(fn, 'r+b') as fout:
+                    fout.truncate(size)
+            print("Resuming from checkpoint: {0}".format(state))
+        return state
+
+    def due(self):
+        return time.time() - self._last_saved >= self.interval
+
+    def save(self, state, output_size):
+        """Atomically record progress.
+
+        output_size must be the size of the (flushed) partial output file -- or {file name: size} for a directory.
+        """
+        tmp_fn = self.checkpoint_fn + '.tmp'
+        with open(tmp_fn, 'w') as fout:
+            json.dump({'config': self.config, 'output_size': output_size, 'state': state, 'time': time.time()}, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_fn, self.checkpoint_fn)
+        self._last_saved = time.time()
+
+    def finish(self):
+        """Move the completed output into place and remove the checkpoint."""
+        if self.directory and os.path.isdir(self.output_fn):
+            # a directory cannot replace a non-empty one
+            shutil.rmtree(self.output_fn)
+        os.replace(self.partial_fn, self.output_fn)
+        os.remove(self.checkpoint_fn)
+
+
+def synced_size(fout):
+    """Flush a file to disk and return its size."""
+    fout.flush()
+    os.fsync(fout.fileno())
+    return os.fstat(fout.fileno()).st_size
@@ -0,0 +1,292 @@
+"""Columnar output format for bulk predictions -- an alternative to one JSON line per item.
+
+An output is a directory with one file per column and a meta.json that describes them:
+    qid                    -- QID as an integer (Q42 -> 42)
+    fingerprint            -- claims fingerprint (see claims_fingerprint in wikidata_ids_to_topics_dumps.py)
+    mid_count / top_count  -- number of mid-level / high-level labels kept for each item
+    mid_label / top_label  -- label IDs (indices into meta['labels'] / meta['toplevel_labels']) of those labels
+    mid_score / top_score  -- their scores as float16 or float32
+    sitelink_count         -- number of sitelinks for each item
+    rules                  -- bitmask of the claim-based rules that applied to each item (bit i: meta['rules'][i])
+and a separate sitelinks table:
+    sitelink_qid           -- QID of the item, as above
+    sitelink_wiki          -- wiki ID (index into meta['wikis']) -- e.g., 'en'
+    sitelink_title_length  -- length in bytes of the title
+    sitelink_title         -- UTF-8 titles, one after another
+
+Labels of an item are in label ID order rather than sorted by score. Columns are appended to as batches are written.
+Uncompressed columns are raw arrays that can be memory-mapped. Compressed columns are a series of frames,
+each preceded by its compressed length (uint64), and have to be decompressed to be read.
+
+Print the rows for a range of QIDs as JSON lines:
+    python3 columnar.py output_dir --qids Q1 Q1000
+"""
+import argparse
+import json
+import os
+import zlib
+
+import numpy as np
+
+FORMAT_VERSION = 2
+META_FN = 'meta.json'
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+SCORE_DTYPES = ('float16', 'float32')
+# dtypes of the columns that do not depend on the number of labels or the score dtype
+FIXED_DTYPES = {'qid': 'uint32', 'fingerprint': 'uint64', 'sitelink_count': 'uint16', 'rules': 'uint16',
+                'sitelink_qid': 'uint32', 'sitelink_wiki': 'uint16', 'sitelink_title_length': 'uint16',
+                'sitelink_title': 'uint8'}
+LABEL_COLUMNS = ('mid_count', 'mid_label', 'top_count', 'top_label')
+SCORE_COLUMNS = ('mid_score', 'top_score')
+
+
+def column_dtypes(num_labels, score_dtype):
+    label_dtype = 'uint8' if num_labels < 256 else 'uint16'
+    dtypes = dict(FIXED_DTYPES)
+    dtypes.update({c: label_dtype for c in LABEL_COLUMNS})
+    dtypes.update({c: score_dtype for c in SCORE_COLUMNS})
+    return dtypes
+
+
+def qid_to_int(qid):
+    if not qid.startswith('Q'):
+        raise ValueError("Only items (Q-IDs) can be written in columnar format: {0}".format(qid))
+    return int(qid[1:])
+
+
+def _compressor(compression):
+    if compression == 'zlib':
+        return lambda data: zlib.compress(data, 1)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compression requires the zstandard module: pip install zstandard")
+        return zstandard.ZstdCompressor(level=1).compress
+    return None
+
+
+def _decompressor(compression):
+    if compression == 'zlib':
+        return zlib.decompress
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress
+    return None
+
+
+def _kept_scores(scores, threshold, num_model_labels=None):
+    """Labels at or above threshold in each row -> (count per row, label IDs, scores) in row-major order."""
+    keep = scores >= threshold
+    if num_model_labels is not None and num_model_labels < scores.shape[1]:
+        # drop extra rule-based labels that were never assigned (see inference.rank)
+        keep[:, num_model_labels:] &= scores[:, num_model_labels:] > 0
+    rows, cols = np.nonzero(keep)
+    return keep.sum(axis=1), cols, scores[rows, cols]
+
+
+def encode_batch(model, qids, titles, scores, hlc_scores, fingerprints, rules_masks, threshold, score_dtype='float16'):
+    """Convert a batch of predictions into column arrays -> {column: array} to pass to ColumnarWriter.write.
+
+    Wikis are passed by name (under 'sitelink_wiki_names') because IDs are only assigned by the writer.
+    This is separate from the writer so that it can run in the worker processes that make predictions.
+    """
+    dtypes = column_dtypes(len(model.labels), score_dtype)
+    qid_ints = np.array([qid_to_int(q) for q in qids], dtype=dtypes['qid'])
+    mid_count, mid_label, mid_score = _kept_scores(scores, threshold, model.num_model_labels)
+    top_count, top_label, top_score = _kept_scores(hlc_scores, threshold)
+    sitelink_wikis = [w for t in titles for w in t]
+    title_bytes = [(t[w] or '').encode('utf-8') for t in titles for w in t]
+    columns = {'qid': qid_ints,
+               'fingerprint': np.array([int(fp, 16) for fp in fingerprints], dtype=np.uint64),
+               'mid_count': mid_count, 'mid_label': mid_label, 'mid_score': mid_score,
+               'top_count': top_count, 'top_label': top_label, 'top_score': top_score,
+               'sitelink_count': [len(t) for t in titles], 'rules': rules_masks,
+               'sitelink_qid': np.repeat(qid_ints, [len(t) for t in titles]),
+               'sitelink_title_length': [len(b) for b in title_bytes],
+               'sitelink_title': np.frombuffer(b''.join(title_bytes), dtype=np.uint8)}
+    columns = {c: np.asarray(v).astype(dtypes[c], copy=False) for c, v in columns.items()}
+    columns['sitelink_wiki_names'] = sitelink_wikis
+    return columns
+
+
+class ColumnarWriter:
+    """Appends batches of columns (see encode_batch) to an output directory.
+
+    rules are the names of the claim-based rules in the order of their bits in the 'rules' column.
+    To continue a previous output (i.e. a resumed run), pass the result of state() from when it was last synced.
+    """
+
+    def __init__(self, out_dir, labels, toplevel_labels, score_dtype='float16', compression='none', threshold=None,
+                 rules=(), state=None):
+        if score_dtype not in SCORE_DTYPES:
+            raise ValueError("Score dtype {0} is not supported. Supported: {1}".format(score_dtype, SCORE_DTYPES))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Compression {0} is not supported. Supported: {1}".format(compression, COMPRESSIONS))
+        self.out_dir = out_dir
+        self.meta = {'format_version': FORMAT_VERSION, 'labels': list(labels), 'toplevel_labels': list(toplevel_labels),
+                     'wikis': [], 'score_dtype': score_dtype, 'compression': compression, 'threshold': threshold,
+                     'rules': list(rules), 'qids_sorted': True, 'last_qid': 0}
+        if state:
+            self.meta.update(state)
+        self.dtypes = column_dtypes(len(labels), score_dtype)
+        self._wiki_ids = {w: i for i, w in enumerate(self.meta['wikis'])}
+        self._compress = _compressor(compression)
+        os.makedirs(out_dir, exist_ok=True)
+        self._files = {c: open(os.path.join(out_dir, c), 'ab') for c in self.dtypes}
+
+    def write(self, columns):
+        qids = columns['qid']
+        if len(qids):
+            if qids[0] < self.meta['last_qid'] or np.any(qids[1:] < qids[:-1]):
+                self.meta['qids_sorted'] = False
+            self.meta['last_qid'] = int(qids[-1])
+        wiki_ids = []
+        for w in columns['sitelink_wiki_names']:
+            wiki_id = self._wiki_ids.get(w)
+            if wiki_id is None:
+                wiki_id = self._wiki_ids[w] = len(self.meta['wikis'])
+                self.meta['wikis'].append(w)
+            wiki_ids.append(wiki_id)
+        columns = dict(columns, sitelink_wiki=np.array(wiki_ids, dtype=self.dtypes['sitelink_wiki']))
+        for c, fout in self._files.items():
+            data = columns[c].tobytes()
+            if self._compress is not None:
+                data = self._compress(data)
+                fout.write(len(data).to_bytes(8, 'little'))
+            fout.write(data)
+
+    def _write_meta(self):
+        tmp_fn = os.path.join(self.out_dir, META_FN + '.tmp')
+        with open(tmp_fn, 'w') as fout:
+            json.dump(self.meta, fout)
+        os.replace(tmp_fn, os.path.join(self.out_dir, META_FN))
+
+    def state(self):
+        """Everything besides the columns that is needed to continue writing."""
+        return {k: self.meta[k] for k in ('wikis', 'qids_sorted', 'last_qid')}
+
+    def sync(self):
+        """Flush everything to disk -> {column: file size} (e.g., for a checkpoint)."""
+        self._write_meta()
+        sizes = {}
+        for c, fout in self._files.items():
+            fout.flush()
+            os.fsync(fout.fileno())
+            sizes[c] = os.fstat(fout.fileno()).st_size
+        return sizes
+
+    def close(self):
+        self._write_meta()
+        for fout in self._files.values():
+            fout.close()
+
+
+class ColumnarReader:
+    """Reads an output directory written by ColumnarWriter. Uncompressed columns are memory-mapped."""
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, META_FN), 'r') as fin:
+            self.meta = json.load(fin)
+        self.labels = self.meta['labels']
+        self.toplevel_labels = self.meta['toplevel_labels']
+        self.wikis = self.meta['wikis']
+        self.dtypes = column_dtypes(len(self.labels), self.meta['score_dtype'])
+        self._decompress = _decompressor(self.meta['compression'])
+        self._columns = {}
+        self._offsets = {}
+
+    def column(self, name):
+        """The whole column as an array -- memory-mapped if the output is not compressed."""
+        if name not in self._columns:
+            fn = os.path.join(self.out_dir, name)
+            dtype = np.dtype(self.dtypes[name])
+            if self._decompress is None:
+                if os.path.getsize(fn):
+                    self._columns[name] = np.memmap(fn, dtype=dtype, mode='r')
+                else:
+                    self._columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                frames = []
+                with open(fn, 'rb') as fin:
+                    header = fin.read(8)
+                    while header:
+                        frames.append(self._decompress(fin.read(int.from_bytes(header, 'little'))))
+                        header = fin.read(8)
+                self._columns[name] = np.frombuffer(b''.join(frames), dtype=dtype)
+        return self._columns[name]
+
+    def __len__(self):
+        return len(self.column('qid'))
+
+    def offsets(self, count_column):
+        """Start of each row's values in the columns that go with a count column (plus the end) -- e.g., 'mid_count'."""
+        if count_column not in self._offsets:
+            offsets = np.zeros(len(self.column(count_column)) + 1, dtype=np.int64)
+            np.cumsum(self.column(count_column), out=offsets[1:])
+            self._offsets[count_column] = offsets
+        return self._offsets[count_column]
+
+    def qid_rows(self, first_qid, last_qid):
+        """Indices of the rows with first_qid <= QID <= last_qid (e.g., 'Q1', 'Q1000')."""
+        qids = self.column('qid')
+        first, last = qid_to_int(first_qid), qid_to_int(last_qid)
+        if self.meta['qids_sorted']:
+            return np.arange(np.searchsorted(qids, first, side='left'), np.searchsorted(qids, last, side='right'))
+        return np.flatnonzero((qids >= first) & (qids <= last))
+
+    def _ranked(self, row, level):
+        labels = self.labels if level == 'mid' else self.toplevel_labels
+        offsets = self.offsets(level + '_count')
+        ids = self.column(level + '_label')[offsets[row]:offsets[row + 1]]
+        scores = self.column(level + '_score')[offsets[row]:offsets[row + 1]].astype(np.float64)
+        order = np.argsort(-scores, kind='stable')
+        return [(labels[i], round(float(s), 4)) for i, s in zip(ids[order].tolist(), scores[order].tolist())]
+
+    def _titles(self, row):
+        offsets = self.offsets('sitelink_count')
+        title_offsets = self.offsets('sitelink_title_length')
+        titles = {}
+        for i in range(offsets[row], offsets[row + 1]):
+            title = self.column('sitelink_title')[title_offsets[i]:title_offsets[i + 1]].tobytes().decode('utf-8')
+            titles[self.wikis[self.column('sitelink_wiki')[i]]] = title
+        return titles
+
+    def rule_names(self, row):
+        """Names of the claim-based rules that applied to a row -- None for outputs written before they were recorded."""
+        if 'rules' not in self.meta:
+            return None
+        mask = int(self.column('rules')[row])
+        return [name for bit, name in enumerate(self.meta['rules']) if mask >> bit & 1]
+
+    def rows(self, rows):
+        """Rows as JSON objects in the same layout as the JSON lines output (scores rounded to the stored precision)."""
+        for row in rows:
+            output_json = {'qid': 'Q{0}'.format(self.column('qid')[row]), 'titles': self._titles(row),
+                           'predicted_mid_labels': self._ranked(row, 'mid'), 'predicted_top_labels': self._ranked(row, 'top'),
+                           'rules': self.rule_names(row),
+                           'claims_fingerprint': '{0:016x}'.format(self.column('fingerprint')[row])}
+            if output_json['rules'] is None:
+                del output_json['rules']
+            yield output_json
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir",
+                        help="Columnar output directory")
+    parser.add_argument("--qids",
+                        nargs=2,
+                        default=None,
+                        help="First and last QID of the range of rows to print -- e.g., 'Q1 Q1000'. Defaults to all rows.")
+    args = parser.parse_args()
+
+    reader = ColumnarReader(args.output_dir)
+    rows = reader.qid_rows(*args.qids) if args.qids else range(len(reader))
+    for row_json in reader.rows(rows):
+        print(json.dumps(row_json))
+
+
+if __name__ == "__main__":
+    main()
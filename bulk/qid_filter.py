@@ -0,0 +1,154 @@
+"""Compact set of Wikidata IDs for filtering the dump (--input_qids) without a Python set of strings.
+
+IDs are stored by their number, one structure per entity type (Q items, P properties, L lexemes), as whichever is
+smaller for that type:
+    bitmap -- one bit per number up to the largest ID (e.g., 16 MB for every QID up to Q130,000,000)
+    sorted -- a sorted array of 32-bit numbers (4 bytes per ID), searched with bisect
+Either is a small fraction of a set of the same IDs as strings (~70 bytes per ID), and checking an ID only parses its
+number and reads from the array. A filter can be saved to a directory (meta.json + one .npy file per entity type)
+and memory-mapped by later runs, so large ID lists are only parsed once:
+    python3 qid_filter.py qids.json qid_filter/
+    python3 wikidata_ids_to_topics_dumps.py --input_qids qid_filter/ ...
+"""
+from array import array
+import argparse
+from bisect import bisect_left
+import json
+import os
+import time
+
+import numpy as np
+
+ENTITY_TYPES = 'QPL'
+
+
+class QIDFilter:
+    """Set-like filter of entity IDs: 'Q42' in qid_filter, or qid_filter.contains_id(42) for an integer QID."""
+
+    def __init__(self, numbers, meta=None):
+        """numbers: {entity type: sorted, unique array of ID numbers or bitmap} with the kind of each in meta['kinds']."""
+        self.meta = meta or {}
+        self._bitmaps = {}
+        self._sorted = {}
+        self._counts = {}
+        for entity_type, values in numbers.items():
+            # memoryviews index to plain ints, so a membership check does not create NumPy scalars
+            if self.meta['kinds'][entity_type] == 'bitmap':
+                self._bitmaps[entity_type] = memoryview(values)
+            else:
+                self._sorted[entity_type] = memoryview(values)
+            self._counts[entity_type] = self.meta['counts'][entity_type]
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Build a filter from an iterable of entity IDs -- e.g., ['Q42', 'Q5', 'P31']."""
+        collected = {t: array('I') for t in ENTITY_TYPES}
+        for entity_id in ids:
+            entity_type = entity_id[:1]
+            if entity_type not in collected or not entity_id[1:].isdecimal():
+                print("Invalid ID: {0}".format(entity_id))
+                continue
+            collected[entity_type].append(int(entity_id[1:]))
+        numbers = {}
+        meta = {'kinds': {}, 'counts': {}}
+        for entity_type in ENTITY_TYPES:
+            values = collected.pop(entity_type)
+            if not values:
+                continue
+            values = np.unique(np.array(values, dtype=np.uint32))
+            meta['counts'][entity_type] = len(values)
+            if (int(values[-1]) >> 3) + 1 <= len(values) * 4:
+                bitmap = np.zeros((int(values[-1]) >> 3) + 1, dtype=np.uint8)
+                np.bitwise_or.at(bitmap, values >> 3, (1 << (values & 7)).astype(np.uint8))
+                numbers[entity_type] = bitmap
+                meta['kinds'][entity_type] = 'bitmap'
+            else:
+                numbers[entity_type] = values
+                meta['kinds'][entity_type] = 'sorted'
+        return cls(numbers, meta)
+
+    @classmethod
+    def from_file(cls, ids_fn):
+        """Build a filter from a file with one ID per line, either plain or as a JSON object with a 'QID'."""
+        return cls.from_ids(read_ids(ids_fn))
+
+    @classmethod
+    def load(cls, filter_dir):
+        with open(os.path.join(filter_dir, 'meta.json'), 'r') as fin:
+            meta = json.load(fin)
+        numbers = {t: np.load(os.path.join(filter_dir, '{0}.npy'.format(t)), mmap_mode='r') for t in meta['kinds']}
+        return cls(numbers, meta)
+
+    def save(self, filter_dir, source=None):
+        os.makedirs(filter_dir, exist_ok=True)
+        for entity_type in self.meta['kinds']:
+            if entity_type in self._bitmaps:
+                values = np.asarray(self._bitmaps[entity_type], dtype=np.uint8)
+            else:
+                values = np.asarray(self._sorted[entity_type], dtype=np.uint32)
+            np.save(os.path.join(filter_dir, '{0}.npy'.format(entity_type)), values)
+        with open(os.path.join(filter_dir, 'meta.json'), 'w') as fout:
+            json.dump(dict(self.meta, built=time.time(), source=source), fout)
+
+    def contains_id(self, number, entity_type='Q'):
+        bitmap = self._bitmaps.get(entity_type)
+        if bitmap is not None:
+            byte = number >> 3
+            return byte < len(bitmap) and bool(bitmap[byte] >> (number & 7) & 1)
+        values = self._sorted.get(entity_type)
+        if values is None:
+            return False
+        i = bisect_left(values, number)
+        return i < len(values) and values[i] == number
+
+    def __contains__(self, entity_id):
+        number = entity_id[1:]
+        return number.isdecimal() and self.contains_id(int(number), entity_id[:1])
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    def nbytes(self):
+        return sum(v.nbytes for v in self._bitmaps.values()) + sum(v.nbytes for v in self._sorted.values())
+
+
+def read_ids(ids_fn):
+    """Yield the IDs in a file with one per line, either plain or as a JSON object with a 'QID' (as for --input_qids)."""
+    with open(ids_fn, 'r') as fin:
+        for i, line in enumerate(fin, start=1):
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    line = json.loads(line).get('QID', '')
+                except json.decoder.JSONDecodeError:
+                    print("Invalid line ({0}): {1}".format(i, line))
+                    continue
+            if line:
+                yield line
+
+
+def load_filter(path):
+    """Filter from a directory saved by QIDFilter.save or built from an ID file."""
+    if os.path.isdir(path):
+        return QIDFilter.load(path)
+    return QIDFilter.from_file(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ids_fn",
+                        help="File with one ID per line, either plain or as a JSON object with a 'QID' (as for --input_qids).")
+    parser.add_argument("filter_dir",
+                        help="Directory to save the filter to.")
+    args = parser.parse_args()
+
+    start = time.time()
+    qid_filter = QIDFilter.from_file(args.ids_fn)
+    qid_filter.save(args.filter_dir, source=args.ids_fn)
+    print("Saved {0} IDs ({1}) in {2:.1f} MB to {3} in {4:.1f} seconds.".format(
+        len(qid_filter), ', '.join('{0}: {1}'.format(t, k) for t, k in sorted(qid_filter.meta['kinds'].items())),
+        qid_filter.nbytes() / 2 ** 20, args.filter_dir, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,38 @@
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 import json
-from random import sample
+import random
+import sys
+import threading
+import time
 import traceback
 
-import fasttext
-import mwapi
+import requests
+from requests.adapters import HTTPAdapter
+
+from checkpoint import Checkpoint, synced_size
+
+# shared modules live alongside the Flask app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from claims import ClaimEncoder, fingerprint
+from inference import TopicModel
+from rules import DEFAULT_RULES
+from score_cache import ScoreCache, model_id
+from timing import ProgressReporter, SamplingProfiler, stage, write_run_stats
+
+WIKIDATA_API = 'https://www.wikidata.org/w/api.php'
+USER_AGENT = 'wikidata topic app -- isaac@wikimedia.org'
+# claims of each item are collected in the same buffer (items are only labeled from the main thread)
+CLAIM_ENCODER = ClaimEncoder()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--fasttext_model",
                         default="../app/models/model.bin",
-                        help="Location of pretrained fastText model (probably .bin file)")
+                        help="Location of pretrained fastText model (probably .bin file) "
+                             "or of the model exported for NumPy scoring (see app/numpy_fasttext.py)")
     parser.add_argument("--input_qids",
                         default="data/example_input_data.txt",
                         help="Input JSON file with one JSON object per row and at minimum a value under 'QID'")
@@ -28,96 +49,271 @@ def main():
                         default=50,
                         type=int,
                         help="Number of Wikidata IDs to process at once -- i.e. per API call. Max 50.")
+    parser.add_argument("--concurrency",
+                        default=1,
+                        type=int,
+                        help="Number of API calls in flight at once. Predictions for finished calls are made while "
+                             "later calls are in progress. Output order is the same regardless.")
+    parser.add_argument("--wikidata_api",
+                        default=WIKIDATA_API,
+                        help="URL of the Wikidata API.")
+    parser.add_argument("--maxlag",
+                        default=5,
+                        type=int,
+                        help="maxlag parameter for API calls -- the API asks clients to wait when replication lag is higher.")
+    parser.add_argument("--max_retries",
+                        default=5,
+                        type=int,
+                        help="Number of times to retry a failed API call (with exponential backoff) before skipping its items.")
+    parser.add_argument("--score_cache_size",
+                        default=100000,
+                        type=int,
+                        help="Number of claim sets whose scores are kept so that items with the same claims are only scored once "
+                             "(see app/score_cache.py). 0 scores every item.")
+    parser.add_argument("--score_cache",
+                        default=None,
+                        help="File to load the score cache from (if it exists and is for the same model) and save it to at the end.")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue an interrupted run from its last checkpoint (<output_results>.ckpt).")
+    parser.add_argument("--checkpoint_interval",
+                        default=60,
+                        type=int,
+                        help="Seconds between checkpoints. Output is written to <output_results>.partial "
+                             "and only renamed to --output_results once the run is complete.")
+    parser.add_argument("--report_interval",
+                        default=30,
+                        type=float,
+                        help="Seconds between progress reports (items/sec, time spent in each stage, and ETA).")
+    parser.add_argument("--verbose",
+                        action="store_true",
+                        help="Also print a line for each batch of items.")
+    parser.add_argument("--profile",
+                        default=None,
+                        help="Sample stacks while running and write them to this file (collapsed format for flame graphs).")
+    parser.add_argument("--stats_output",
+                        default=None,
+                        help="Write a JSON summary of the run (items, failed API calls, seconds, items/sec, seconds per stage) to this file.")
     args = parser.parse_args()
 
+    start = time.time()
+    profiler = SamplingProfiler().start() if args.profile else None
     try:
-        model = fasttext.load_model(args.fasttext_model)
+        counts = run(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile)
+    if args.stats_output and counts is not None:
+        write_run_stats(args.stats_output, time.time() - start, counts)
+
+
+def run(args):
+    """Label the input QIDs as configured by the command-line args -> counts of items written and failed API calls."""
+    try:
+        model = TopicModel.load(args.fasttext_model)
     except ValueError:
         print("Could not load model at location: {0}\n".format(os.path.abspath(args.fasttext_model)))
         traceback.print_exc()
         return
 
-    session = mwapi.Session('https://www.wikidata.org', user_agent='wikidata topic app -- isaac@wikimedia.org')
-
-    items_processed = 0
-    items_skipped = 0
-    with open(args.input_qids, 'r') as fin:
-        with open(args.output_results, 'w') as fout:
-            wd_items_to_query = []
-            for i, line in enumerate(fin, start=1):
-                try:
-                    wd_item = json.loads(line.strip())
-                except json.decoder.JSONDecodeError:
-                    print("Invalid line ({0}): {1}".format(i, line.strip()))
-                    items_skipped += 1
-                    continue
-                if 'QID' in wd_item:
-                    items_processed += 1
-                    wd_items_to_query.append(wd_item)
-                    # process 50 items at a time to reduce API load
-                    if len(wd_items_to_query) == args.query_limit:
-                        print("Processing items {0} through {1} ({2} skipped so far)".format(items_processed - args.query_limit,
+    if args.score_cache:
+        cache = ScoreCache.load(args.score_cache, max_size=args.score_cache_size, model_id=model_id(args.fasttext_model))
+    else:
+        cache = ScoreCache(max_size=args.score_cache_size)
+
+    fetcher = EntityFetcher(api_url=args.wikidata_api, maxlag=args.maxlag, max_retries=args.max_retries, pool_size=args.concurrency)
+
+    # a checkpoint can only be resumed by a run that would produce the same output
+    checkpoint = Checkpoint(args.output_results, interval=args.checkpoint_interval,
+                            config={'fasttext_model': args.fasttext_model, 'input_qids': args.input_qids,
+                                    'threshold': args.threshold})
+    state = checkpoint.start(resume=args.resume) or {}
+    items_processed = state.get('written', 0)
+    input_size = os.path.getsize(args.input_qids)
+    reporter = ProgressReporter(interval=args.report_interval, done=items_processed)
+    start = time.time()
+    with open(checkpoint.partial_fn, 'a') as fout:
+        # API calls for the next batches are made in the background while the current batch is scored and written
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            in_flight = deque()
+            for wd_items_to_query, input_state in read_batches(args.input_qids, args.query_limit, state, args.verbose):
+                in_flight.append((wd_items_to_query, input_state, executor.submit(fetcher.get_entities, wd_items_to_query)))
+                if len(in_flight) > args.concurrency:
+                    batch = in_flight.popleft()
+                    items_processed = write_batch(fout, *batch, model, args.threshold, items_processed, checkpoint, cache)
+                    reporter.update(items_processed, batch[1]['offset'] / input_size)
+            while in_flight:
+                batch = in_flight.popleft()
+                items_processed = write_batch(fout, *batch, model, args.threshold, items_processed, checkpoint, cache)
+                reporter.update(items_processed, batch[1]['offset'] / input_size)
+    checkpoint.finish()
+    elapsed = time.time() - start
+    reporter.update(items_processed, 1, force=True)
+    print("Finished: {0} items in {1:.1f} seconds ({2:.1f} items/sec). {3} API calls failed.".format(
+        items_processed, elapsed, items_processed / elapsed if elapsed else 0, fetcher.failures))
+    counts = {'items': items_processed, 'failed_calls': fetcher.failures}
+    if cache.max_size:
+        print(cache.summary())
+        if args.score_cache:
+            cache.save(args.score_cache)
+        counts['score_cache'] = cache.stats()
+    return counts
+
+
+def read_batches(input_qids, query_limit, state=None, verbose=False):
+    """Yield lists of up to query_limit Wikidata items (JSON objects with a 'QID') from the input file.
+
+    Each list comes with the input state after its last item: the byte offset in the input file and counters.
+    Passing such a state back in continues reading from that point.
+    """
+    state = state or {}
+    items_processed = state.get('items', 0)
+    items_skipped = state.get('skipped', 0)
+    i = state.get('lines', 0)
+    with open(input_qids, 'rb') as fin:
+        fin.seek(state.get('offset', 0))
+        wd_items_to_query = []
+        for line in fin:
+            i += 1
+            line = line.decode('utf-8')
+            try:
+                wd_item = json.loads(line.strip())
+            except json.decoder.JSONDecodeError:
+                print("Invalid line ({0}): {1}".format(i, line.strip()))
+                items_skipped += 1
+                continue
+            if 'QID' in wd_item:
+                items_processed += 1
+                wd_items_to_query.append(wd_item)
+                # process 50 items at a time to reduce API load
+                if len(wd_items_to_query) == query_limit:
+                    if verbose:
+                        print("Processing items {0} through {1} ({2} skipped so far)".format(items_processed - query_limit,
                                                                                              items_processed, items_skipped))
-                        label_qids(wd_items_to_query, session, model, args.threshold)
-                        for qid_json in wd_items_to_query:
-                            fout.write(json.dumps(qid_json) + "\n")
-                        wd_items_to_query = []
-                else:
-                    items_skipped += 1
-            if wd_items_to_query:
+                    yield wd_items_to_query, {'offset': fin.tell(), 'lines': i, 'items': items_processed,
+                                              'skipped': items_skipped}
+                    wd_items_to_query = []
+            else:
+                items_skipped += 1
+        if wd_items_to_query:
+            if verbose:
                 print("Processing final items {0} through {1} ({2} skipped so far)".format(
                     items_processed - len(wd_items_to_query), items_processed, items_skipped))
-                label_qids(wd_items_to_query, session, model, args.threshold)
-                for qid_json in wd_items_to_query:
-                    fout.write(json.dumps(qid_json) + "\n")
+            yield wd_items_to_query, {'offset': fin.tell(), 'lines': i, 'items': items_processed, 'skipped': items_skipped}
+
+
+def write_batch(fout, wd_items_to_query, input_state, future, model, threshold, items_processed, checkpoint, cache=None):
+    """Wait for a batch's API call, add predictions to its items, and write them out.
+
+    Batches are written in input order, so after each one the output covers the input up to input_state.
+    """
+    result = future.result()
+    if result is not None:
+        label_qids(wd_items_to_query, result, model, threshold, cache)
+    with stage('serialize'):
+        for qid_json in wd_items_to_query:
+            fout.write(json.dumps(qid_json) + "\n")
+    items_processed += len(wd_items_to_query)
+    if checkpoint.due():
+        checkpoint.save(dict(input_state, written=items_processed), synced_size(fout))
+    return items_processed
+
+
+class EntityFetcher:
+    """Gets Wikidata claims via wbgetentities, reusing connections and backing off when the API asks or fails."""
+
+    def __init__(self, api_url=WIKIDATA_API, maxlag=5, max_retries=5, pool_size=1, base_delay=1, max_delay=120):
+        self.api_url = api_url
+        self.maxlag = maxlag
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # one keep-alive session per thread
+        if not hasattr(self._local, 'session'):
+            session = requests.Session()
+            session.headers['User-Agent'] = USER_AGENT
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+            self._local.session = session
+        return self._local.session
 
+    def get_entities(self, wd_items_to_query):
+        """wbgetentities result for a batch of items -- None if the call still fails after retrying."""
+        qids_str = "|".join([item['QID'] for item in wd_items_to_query])
+        params = {'action': 'wbgetentities', 'props': 'claims', 'format': 'json', 'ids': qids_str}
+        if self.maxlag:
+            params['maxlag'] = self.maxlag
+        for attempt in range(self.max_retries + 1):
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * (1 + random.random())
+            try:
+                with stage('fetch'):
+                    resp = self.session.get(self.api_url, params=params, timeout=60)
+                retry_after = resp.headers.get('Retry-After')
+                if resp.status_code in (429, 503) and retry_after:
+                    delay = float(retry_after)
+                    print("Rate-limited ({0}). Waiting {1} seconds.".format(resp.status_code, delay))
+                else:
+                    resp.raise_for_status()
+                    with stage('decode'):
+                        result = resp.json()
+                    if 'error' not in result:
+                        return result
+                    if result['error'].get('code') == 'maxlag':
+                        delay = float(retry_after or self.maxlag)
+                        print("Replication lag too high. Waiting {0} seconds.".format(delay))
+                    else:
+                        print("API error for {0}: {1}".format(qids_str, result['error']))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print("Failed ({0}/{1}): {2} -- {3}".format(attempt + 1, self.max_retries + 1, qids_str, e))
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        self.failures += 1
+        print("Failed:", qids_str)
+        return None
+
+
+def label_qids(wd_items_to_query, result, model, threshold=0.5, cache=None):
+    """Add predicted labels to each item based on the claims in the wbgetentities result.
 
-def label_qids(wd_items_to_query, session, model, threshold=0.5):
+    With a cache (see app/score_cache.py), only items with claims that have not been scored recently go to the model.
+    """
     # build QID list
     qids = [item['QID'] for item in wd_items_to_query]
     qid_to_idx = {qid:idx for idx, qid in enumerate(qids)}
-    qids_str = "|".join(qids)
-
-    # get claims for wikidata item
-    try:
-        result = session.get(
-            action="wbgetentities",
-            props='claims',
-            format='json',
-            ids=qids_str
-        )
-    except Exception:
-        print("Failed:", qids_str)
-        return
 
-    for entity in result['entities']:
-        qid = result['entities'][entity]['id']
-        if 'redirects' in result['entities'][entity]:
-            qid = result['entities'][entity]['redirects']['from']
-        # convert claims to fastText bag-of-words format
-        claims = result['entities'][entity]['claims']
-        claims_tuples = []
-        for prop in claims:  # each property, such as P31 instance-of
-            included = False
-            for statement in claims[prop]:  # each value under that property -- e.g., instance-of might have three different values
-                try:
-                    if statement['type'] == 'statement' and statement['mainsnak']['datatype'] == 'wikibase-item':
-                        claims_tuples.append((prop, statement['mainsnak']['datavalue']['value']['id']))
-                        included = True
-                except Exception:
-                    continue
-            if not included:
-                claims_tuples.append((prop, ))
-        if not len(claims_tuples):
-            claims_tuples = [('<NOCLAIM>', )]
-        claims_str = ' '.join([' '.join(c) for c in sample(claims_tuples, len(claims_tuples))])
-
-        # make prediction
-        lbls, scores = model.predict(claims_str, k=-1)
-        results = {l:s for l,s in zip(lbls, scores)}
-        sorted_res = [(l.replace("__label__", ""), results[l]) for l in sorted(results, key=results.get, reverse=True)]
-        above_threshold = [r for r in sorted_res if r[1] >= threshold]
+    batch_qids = []
+    claims_ids = []
+    rules_masks = []
+    with stage('extract'):
+        for entity in result['entities']:
+            if 'missing' in result['entities'][entity]:
+                continue
+            qid = result['entities'][entity]['id']
+            if 'redirects' in result['entities'][entity]:
+                qid = result['entities'][entity]['redirects']['from']
+            # convert claims to the model's bag-of-words format as token IDs (see app/claims.py)
+            ids, _ = CLAIM_ENCODER.encode(result['entities'][entity]['claims'])
+            batch_qids.append(qid)
+            claims_ids.append(ids)
+            rules_masks.append(DEFAULT_RULES.mask_ids(ids))
 
+    # make predictions for all of the items at once and adjust them based on claims (see app/rules.py)
+    with stage('predict'):
+        if cache is None:
+            scores = model.predict_ids(claims_ids)
+        else:
+            scores = cache.predict_ids(model, claims_ids, [fingerprint(ids) for ids in claims_ids])
+    with stage('rules'):
+        DEFAULT_RULES.apply(model, scores, rules_masks)
+    with stage('serialize'):
+        ranked = model.rank(scores, threshold)
+    for qid, above_threshold in zip(batch_qids, ranked):
         # add results to input list of wikidata items
         wd_items_to_query[qid_to_idx[qid]]['labels'] = above_threshold
 
@@ -1,24 +1,65 @@
 import argparse
 import bz2
+import multiprocessing as mp
 import os
 import json
-from random import sample
+import queue
+import re
+import sys
+import time
 import traceback
 
-import fasttext
+import numpy as np
 
-# male; transgender male; male organisms; transmasculine; cisgender male
-SEX_OR_GENDER_MALE = ('Q6581097', 'Q2449503', 'Q44148', 'Q27679766', 'Q15145778')
+from bz2_index import iter_shard_lines, load_index, parse_shard, shard_block_range
+from checkpoint import Checkpoint, synced_size
+import columnar
+from qid_filter import load_filter
+
+# shared modules live alongside the Flask app
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app'))
+from claims import ClaimEncoder, fingerprint as claims_fingerprint
+from inference import TopicModel
+from rules import DEFAULT_RULES
+from score_cache import ScoreCache, model_id
+from timing import TIMER, LapTimer, ProgressReporter, SamplingProfiler, stage, write_run_stats
+from title_index import TitleIndexWriter, item_title_keys
+
+DUMP_FN = '/mnt/data/xmldatadumps/public/wikidatawiki/entities/latest-all.json.bz2'
+# dump lines always start with the entity type and ID, and each sitelink repeats its key as "site"
+ENTITY_ID_RE = re.compile(r'^\{\s*"type":\s*"[a-z]+",\s*"id":\s*"([^"]+)"')
+SITELINKS_RE = re.compile(r'"sitelinks":\s*\{')
+SITELINK_SITE_RE = re.compile(r'"site":\s*"([^"]+)"')
+# output lines always start with the QID (see predict_topics)
+OUTPUT_QID_RE = re.compile(r'^\{"qid":\s*"([^"]+)"')
+# --previous_output: rows copied over are held back behind a partial batch of items to re-score for at most this
+# many batches' worth of rows before the partial batch is scored
+MAX_HELD_BATCHES = 10
+# claims of each item are collected in the same buffer (each process has its own)
+CLAIM_ENCODER = ClaimEncoder()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--fasttext_model",
                         default="../app/models/model.bin",
-                        help="Location of pretrained fastText model (probably .bin file)")
+                        help="Location of pretrained fastText model (probably .bin file) "
+                             "or of the model exported for NumPy scoring (see app/numpy_fasttext.py)")
+    parser.add_argument("--dump_fn",
+                        default=DUMP_FN,
+                        help="Location of the Wikidata JSON dump (latest-all.json.bz2)")
+    parser.add_argument("--shard",
+                        default=None,
+                        help="Only process one shard of the dump -- e.g., '3/16' for the fourth of 16 shards. "
+                             "Concatenating the outputs of shards 0/N through N-1/N gives the same result as a full run. "
+                             "Uses the bz2 block index, which is built on first use if it does not exist.")
+    parser.add_argument("--dump_index",
+                        default=None,
+                        help="Location of the bz2 block index for --shard (see bz2_index.py). Defaults to <dump_fn>.idx.json")
     parser.add_argument("--input_qids",
                         default=None,
-                        help="Input JSON file with one JSON object per row and at minimum a value under 'QID'")
+                        help="Input JSON file with one JSON object per row and at minimum a value under 'QID' "
+                             "(or one QID per line), or a QID filter saved by qid_filter.py for reuse across runs.")
     parser.add_argument("--wiki_filter",
                         nargs="*",
                         default=None,
@@ -32,11 +73,101 @@ def main():
                         help="Value at which a given topic is considered to apply for a Wikidata ID. "
                              "Defaults to 0.5 but lower values will give more topics and higher values less topics. "
                              "Set threshold to 0 for full model output.")
+    parser.add_argument("--no_prefilter",
+                        action="store_true",
+                        help="Fully parse every line of the dump instead of first checking the raw line against the filters.")
+    parser.add_argument("--workers",
+                        default=0,
+                        type=int,
+                        help="Number of processes for parsing / extracting claims from dump lines. "
+                             "Defaults to 0, which processes the dump sequentially in a single process.")
+    parser.add_argument("--predict_workers",
+                        default=None,
+                        type=int,
+                        help="Number of processes making predictions when --workers > 0. Defaults to half of --workers.")
+    parser.add_argument("--batch_size",
+                        default=1000,
+                        type=int,
+                        help="Number of dump lines passed between processes at once when --workers > 0 "
+                             "and number of items scored by the model at once.")
+    parser.add_argument("--output_format",
+                        default="jsonl",
+                        choices=["jsonl", "columnar"],
+                        help="'jsonl': bz2-compressed JSON lines (default). 'columnar': a directory with one file per column "
+                             "that can be memory-mapped (see columnar.py).")
+    parser.add_argument("--score_dtype",
+                        default="float16",
+                        choices=columnar.SCORE_DTYPES,
+                        help="Precision of scores in columnar output.")
+    parser.add_argument("--compression",
+                        default="none",
+                        choices=columnar.COMPRESSIONS,
+                        help="Compression of columnar output. Only uncompressed columns can be memory-mapped. "
+                             "zstd requires the zstandard module.")
+    parser.add_argument("--previous_output",
+                        default=None,
+                        help="Incremental mode: output of a previous run to update instead of processing the whole dump. "
+                             "Only the items in --changed_qids are read from --dump_fn (e.g., a file of just the changed entities "
+                             "in dump format) and re-scored; all other rows are copied over unchanged. "
+                             "Use the same model, threshold, and filters as the previous run.")
+    parser.add_argument("--score_cache_size",
+                        default=100000,
+                        type=int,
+                        help="Number of claim sets whose scores are kept so that items with the same claims are only scored once "
+                             "(per predict process, see app/score_cache.py). 0 scores every item.")
+    parser.add_argument("--score_cache",
+                        default=None,
+                        help="File to load the score cache from (if it exists and is for the same model) and save it to at the end.")
+    parser.add_argument("--title_index",
+                        default=None,
+                        help="Also write an index from the sitelink titles of every item in the output to its QID to this "
+                             "directory (see app/title_index.py), so that the app can look up titles without the Wikipedia API.")
+    parser.add_argument("--changed_qids",
+                        default=None,
+                        help="Incremental mode: file with one changed QID per line (plain or as a JSON object with a 'QID').")
+    parser.add_argument("--deleted_qids",
+                        default=None,
+                        help="Incremental mode: file with one deleted QID per line (plain or as a JSON object with a 'QID').")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue an interrupted run from its last checkpoint (<output_results>.ckpt). "
+                             "With --shard, reading restarts directly at the checkpointed line. "
+                             "Otherwise the lines before it are decompressed again but not parsed.")
+    parser.add_argument("--checkpoint_interval",
+                        default=300,
+                        type=int,
+                        help="Seconds between checkpoints. Output is written to <output_results>.partial "
+                             "and only renamed to --output_results once the run is complete.")
+    parser.add_argument("--report_interval",
+                        default=30,
+                        type=float,
+                        help="Seconds between progress reports (items/sec, time spent in each stage, and ETA).")
+    parser.add_argument("--profile",
+                        default=None,
+                        help="Sample the main process's stacks while running and write them to this file "
+                             "(collapsed format for flame graphs). With --workers, use --workers 0 to profile every stage.")
+    parser.add_argument("--stats_output",
+                        default=None,
+                        help="Write a JSON summary of the run (lines, items, seconds, items/sec, seconds per stage) to this file.")
     args = parser.parse_args()
 
+    start = time.time()
+    profiler = SamplingProfiler().start() if args.profile else None
+    try:
+        counts = run(args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(args.profile)
+    if args.stats_output and counts is not None:
+        write_run_stats(args.stats_output, time.time() - start, counts)
+
+
+def run(args):
+    """Process the dump as configured by the command-line args -> counts of lines read and items written."""
     # fastText model for providing predicted labels to Wikidata items
     try:
-        model = fasttext.load_model(args.fasttext_model)
+        model = TopicModel.load(args.fasttext_model)
     except ValueError:
         print("Could not load model at location: {0}\n".format(os.path.abspath(args.fasttext_model)))
         print("Check to make sure that file exists and is not just a git LFS pointer.")
@@ -44,82 +175,331 @@ def main():
         return
 
     # if input JSON provided, only these Wikidata items will be processed
+    # they are held as a compact filter of ID numbers rather than a set of strings (see qid_filter.py)
     wd_items_to_query = None
     if args.input_qids:
         print("Loading QIDs to analyze from {0}".format(args.input_qids))
-        wd_items_to_query = set()
-        with open(args.input_qids, 'r') as fin:
-            for i, line in enumerate(fin, start=1):
-                try:
-                    wd_item = json.loads(line.strip())
-                except json.decoder.JSONDecodeError:
-                    print("Invalid line ({0}): {1}".format(i, line.strip()))
-                    continue
-                if 'QID' in wd_item:
-                    wd_items_to_query.add(wd_item['QID'])
-
-    items_processed = 0
-    with bz2.open(args.output_results, 'wt') as fout:
-        if args.threshold > 0:
-            print("Only providing labels with probability >= {0}".format(args.threshold))
-        for qid, titles, claims_str, disamb_list, has_coords, man in loop_through_wd_dump(
-                qids=wd_items_to_query, sites=args.wiki_filter):
-            items_processed += 1
-            # make prediction
-            lbls, scores = model.predict(claims_str, k=-1)
-            results = {l:s for l,s in zip(lbls, scores)}
-            # adjust model output according to a few rules to better match intuitions
-            if disamb_list:
-                # identify disambiguation pages and lists explicitly
-                results['Compilation.List_Disambig'] = 1
-            if man:
-                # women's biographies should not have any biographies of men (per Wikidata) at default threshold (0.5)
-                l = '__label__Culture.Biography.Women'
-                results[l] = min(0.49, results[l])
-
-            if not has_coords:
-                # geography should only be applied to topics w/ actual physical locations
-                geo_keys = [k for k in results if k.startswith('__label__Geography')]
-                for l in geo_keys:
-                    results[l] = max(0, results[l] - 0.501)
-
-            # build high-level category results (e.g., STEM, Geography, Culture)
-            # this depends on the assumption that predicted labels are independent, which is clearly wrong
-            # for instance, the model likely has correlated errors when it comes to things like STEM.Technology and STEM.Engineering
-            # this is the best I can do though currently without building a separate high-level topics model
-            # in practice, the high-level results tend to make sense
-            hlc_results = {}
-            for l in results:
-                hlc = ft_to_toplevel(l)
-                hlc_results[hlc] = hlc_results.get(hlc, 1) * (1 - results[l])
-            hlc_results = {l:1-p for l,p in hlc_results.items()}
-
-            # sort and filter results to just those above threshold
-            sorted_res = [(l.replace("__label__", ""), round(results[l], 4)) for l in sorted(results, key=results.get, reverse=True)]
-            sorted_hlc_res = [(l, round(hlc_results[l], 4)) for l in sorted(hlc_results, key=hlc_results.get, reverse=True)]
-            if args.threshold > 0:
-                sorted_res = [(l, p) for l,p in sorted_res if p > args.threshold]
-                sorted_hlc_res = [(l, p) for l,p in sorted_hlc_res if p > args.threshold]
-            output_json = {'qid':qid, 'titles':titles, 'predicted_mid_labels':sorted_res, 'predicted_top_labels':sorted_hlc_res}
-
-            fout.write(json.dumps(output_json) + '\n')
-            if items_processed % 100000 == 0:
-                print("{0} items processed. Last item: {1}".format(items_processed, output_json))
-
-def ft_to_toplevel(fasttext_lbl):
-    """Example: '__label__STEM.Technology' -> 'STEM'"""
-    return fasttext_lbl.replace('__label__','').split('.')[0]
-
-def tuple_to_ft_format(claims_tuples):
-    """Example: [(P31:Q5), (P625,), ...] -> 'P31 Q5 P625 ...'"""
-    return ' '.join([' '.join(c) for c in sample(claims_tuples, len(claims_tuples))])
-
-def loop_through_wd_dump(qids=None, sites=None):
-    """Get Wikidata claims for items that match filters."""
-    items_written = 0
-    indexerror = 0
-    disamb_list_vals = ['Q4167410', 'Q13406463']
-    dump_fn = '/mnt/data/xmldatadumps/public/wikidatawiki/entities/latest-all.json.bz2'
+        wd_items_to_query = load_filter(args.input_qids)
+
+    if args.threshold > 0:
+        print("Only providing labels with probability >= {0}".format(args.threshold))
+
+    cache = load_score_cache(args)
+
+    shard = None
+    if args.shard:
+        shard = parse_shard(args.shard)
+        print("Processing shard {0} of {1}".format(shard[0], shard[1]))
+
+    if args.previous_output:
+        if args.output_format != 'jsonl':
+            print("Incremental mode only supports JSON lines output.")
+            return
+        if args.title_index:
+            print("Incremental mode does not write a title index -- build it with a full run.")
+            return
+        changed = read_qid_list(args.changed_qids) if args.changed_qids else set()
+        deleted = read_qid_list(args.deleted_qids) if args.deleted_qids else set()
+        counts = update_output(args, model, changed, deleted, qids=wd_items_to_query, sites=args.wiki_filter, cache=cache)
+        return dict(counts, score_cache=finish_score_cache(args, cache))
+
+    # a checkpoint can only be resumed by a run that would produce the same output
+    checkpoint = Checkpoint(args.output_results, interval=args.checkpoint_interval,
+                            config={'fasttext_model': args.fasttext_model, 'dump_fn': args.dump_fn, 'shard': args.shard,
+                                    'input_qids': args.input_qids, 'wiki_filter': args.wiki_filter,
+                                    'threshold': args.threshold, 'output_format': args.output_format,
+                                    'score_dtype': args.score_dtype, 'compression': args.compression,
+                                    'title_index': args.title_index},
+                            directory=args.output_format == 'columnar')
+    resume_state = checkpoint.start(resume=args.resume)
+    titles = None
+    if args.title_index:
+        titles = TitleIndexWriter(args.title_index, entries=(resume_state or {}).get('title_entries'))
+
+    if args.workers > 0:
+        # each worker process loads its own copy of the model
+        labels = (model.labels, model.toplevel_labels)
+        del model
+        counts = run_parallel(args, checkpoint, labels, qids=wd_items_to_query, sites=args.wiki_filter, shard=shard,
+                              resume_state=resume_state, titles=titles, cache=cache)
+    else:
+        stats = dict(resume_state or {})
+        progress = {}
+        reporter = ProgressReporter(interval=args.report_interval, done=stats.get('written', 0))
+        batch = []
+        with open_output(args, checkpoint, (model.labels, model.toplevel_labels), resume_state) as out:
+            for item in loop_through_wd_dump(args.dump_fn, qids=wd_items_to_query, sites=args.wiki_filter,
+                                             shard=shard, index_fn=args.dump_index,
+                                             prefilter=not args.no_prefilter, stats=stats, progress=progress):
+                batch.append(item)
+                if len(batch) == args.batch_size:
+                    write_batch(out, model, batch, args, stats, titles, cache)
+                    batch = []
+                    reporter.update(stats['written'], progress.get('fraction'),
+                                    extra='from {0} lines'.format(stats['lines']))
+                    # the loop is paused right after the last item in the batch so stats describe exactly what was written
+                    if checkpoint.due():
+                        if titles is not None:
+                            stats['title_entries'] = titles.sync()
+                        out.save(stats)
+            if batch:
+                write_batch(out, model, batch, args, stats, titles, cache)
+            reporter.update(stats.get('written', 0), 1, extra='from {0} lines'.format(stats.get('lines', 0)), force=True)
+        counts = {'lines': stats.get('lines', 0), 'items': stats.get('written', 0)}
+    if titles is not None:
+        num_titles = titles.finish(source=args.dump_fn)
+        print("Title index with {0} titles written to {1}".format(num_titles, args.title_index))
+    counts['score_cache'] = finish_score_cache(args, cache)
+    checkpoint.finish()
+    print("Output written to {0}".format(args.output_results))
+    return counts
+
+
+def load_score_cache(args):
+    if args.score_cache:
+        return ScoreCache.load(args.score_cache, max_size=args.score_cache_size, model_id=model_id(args.fasttext_model))
+    return ScoreCache(max_size=args.score_cache_size)
+
+
+def finish_score_cache(args, cache):
+    """Report on the score cache and save it if --score_cache is set -> its stats."""
+    if not cache.max_size:
+        return None
+    print(cache.summary())
+    if args.score_cache:
+        cache.save(args.score_cache)
+    return cache.stats()
+
+
+class CheckpointedOutput:
+    """bz2 output that is appended to the checkpoint's partial file.
+
+    At each checkpoint the bz2 stream is closed so everything written so far is complete on disk, and a new stream
+    is started after it. The output is therefore a multi-stream bz2 file, which bz2 readers handle transparently.
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self._raw = open(checkpoint.partial_fn, 'ab')
+        self.fout = bz2.open(self._raw, 'wt')
+
+    def write(self, output):
+        self.fout.write(output)
+
+    def save(self, state):
+        self.fout.close()
+        self.checkpoint.save(state, synced_size(self._raw))
+        self.fout = bz2.open(self._raw, 'wt')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fout.close()
+        synced_size(self._raw)
+        self._raw.close()
+
+
+class ColumnarOutput:
+    """Columnar output (see columnar.py) in the checkpoint's partial directory, with the same interface as CheckpointedOutput."""
+
+    def __init__(self, checkpoint, labels, toplevel_labels, score_dtype, compression, threshold, state=None):
+        self.checkpoint = checkpoint
+        self.writer = columnar.ColumnarWriter(checkpoint.partial_fn, labels, toplevel_labels, score_dtype=score_dtype,
+                                              compression=compression, threshold=threshold,
+                                              rules=[rule['name'] for rule in DEFAULT_RULES.rules],
+                                              state=(state or {}).get('columnar'))
+
+    def write(self, output):
+        self.writer.write(output)
+
+    def save(self, state):
+        sizes = self.writer.sync()
+        self.checkpoint.save(dict(state, columnar=self.writer.state()), sizes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.writer.close()
+
+
+def open_output(args, checkpoint, labels, state=None):
+    """Output for --output_format. labels: the model's (labels, toplevel_labels)."""
+    if args.output_format == 'columnar':
+        return ColumnarOutput(checkpoint, *labels, score_dtype=args.score_dtype, compression=args.compression,
+                              threshold=args.threshold, state=state)
+    return CheckpointedOutput(checkpoint)
+
+
+def write_batch(out, model, items, args, stats, titles=None, cache=None):
+    """Make predictions for a batch of items and write them out, counting them in stats['written'].
+
+    If titles (a TitleIndexWriter) is provided, the items' titles are added to it as well.
+    """
+    output = encode_batch(model, items, args.threshold, args.output_format, args.score_dtype, cache)
+    with stage('compress'):
+        out.write(output)
+    if titles is not None:
+        titles.add_items(items)
+    stats['written'] = stats.get('written', 0) + len(items)
+
+
+def encode_batch(model, items, threshold, output_format='jsonl', score_dtype='float16', cache=None):
+    """Predictions for a batch of items in the output format: JSON lines (a string) or columns (see columnar.encode_batch)."""
+    if output_format == 'columnar':
+        qids, titles, _, rules_masks, fingerprints = zip(*items)
+        scores, hlc_scores = score_items(model, items, cache)
+        with stage('serialize'):
+            return columnar.encode_batch(model, qids, titles, scores, hlc_scores, fingerprints, rules_masks,
+                                         threshold if threshold > 0 else -np.inf, score_dtype)
+    outputs = predict_topics(model, items, threshold, cache)
+    with stage('serialize'):
+        return ''.join([json.dumps(output_json) + '\n' for output_json in outputs])
+
+
+def score_items(model, items, cache=None):
+    """Scores adjusted by claims-based rules and high-level topic scores for a batch of items.
+
+    With a cache (see app/score_cache.py), only items with claims that have not been scored recently go to the model.
+    """
+    claims_ids = [item[2] for item in items]
+    rules_masks = [item[3] for item in items]
+    with stage('predict'):
+        if cache is None:
+            scores = model.predict_ids(claims_ids)
+        else:
+            scores = cache.predict_ids(model, claims_ids, [item[4] for item in items])
+    # adjust model output according to a few rules to better match intuitions (see app/rules.py)
+    with stage('rules'):
+        DEFAULT_RULES.apply(model, scores, rules_masks)
+
+    # build high-level category results (e.g., STEM, Geography, Culture)
+    # this depends on the assumption that predicted labels are independent, which is clearly wrong
+    # for instance, the model likely has correlated errors when it comes to things like STEM.Technology and STEM.Engineering
+    # this is the best I can do though currently without building a separate high-level topics model
+    # in practice, the high-level results tend to make sense
+    with stage('predict'):
+        hlc_scores = model.toplevel(scores)
+    return scores, hlc_scores
+
+
+def predict_topics(model, items, threshold=0.5, cache=None):
+    """Make topic predictions for a batch of items and return them as output JSON objects.
+
+    Each item is a tuple of (qid, titles, claims_ids, rules_mask, fingerprint) as produced by extract_item.
+    """
+    qids, titles, _, rules_masks, fingerprints = zip(*items)
+    scores, hlc_scores = score_items(model, items, cache)
+
+    # sort and filter results to just those above threshold
+    if threshold <= 0:
+        threshold = -np.inf
+    with stage('serialize'):
+        # scores at or above the threshold before rounding, the same comparison as the app and the topic store
+        sorted_res = model.rank(scores, threshold, decimals=4)
+        sorted_hlc_res = model.rank_toplevel(hlc_scores, threshold, decimals=4)
+        # which rules applied, so that the topic store can explain scores the same way as live predictions
+        rules = [DEFAULT_RULES.names(f) for f in DEFAULT_RULES.fired(rules_masks)]
+    return [{'qid':qid, 'titles':t, 'predicted_mid_labels':mid, 'predicted_top_labels':top, 'rules':r, 'claims_fingerprint':fp}
+            for qid, t, mid, top, r, fp in zip(qids, titles, sorted_res, sorted_hlc_res, rules, fingerprints)]
+
+def parse_dump_line(line):
+    """Parse one line of the dump (items end in ',\n') -- returns None for the opening/closing brackets."""
+    try:
+        return json.loads(line[:-2])
+    except Exception:
+        try:
+            return json.loads(line)
+        except Exception:
+            return None
+
+def passes_prefilter(line, qids=None, sites=None):
+    """Check a raw dump line against the filters without parsing it.
+
+    Returns False only if the item would certainly be filtered out by extract_item. Lines that do not have the
+    expected layout return True so that they are fully parsed and filtered as usual.
+    """
+    if qids is not None:
+        match = ENTITY_ID_RE.match(line)
+        if match is None:
+            return True
+        if match.group(1) not in qids:
+            return False
+    # sitelinks come at the end of the item
+    sitelinks_start = None
+    for sitelinks_start in SITELINKS_RE.finditer(line):
+        pass
+    if sitelinks_start is None:
+        return True
+    titles = [s[:-4] for s in SITELINK_SITE_RE.findall(line, sitelinks_start.end()) if
+              s.endswith('wiki') and s != 'commonswiki' and s != 'specieswiki']
+    if not titles:
+        return False
+    if sites is not None and not sites.intersection(titles):
+        return False
+    return True
+
+def extract_item(item_json, qids=None, sites=None):
+    """Apply filters to a parsed dump item and convert its claims to token IDs (see app/claims.py).
+
+    Returns None if the item is filtered out, otherwise a tuple of
+    (qid, titles, claims_ids, rules_mask, fingerprint) and the number of malformed statements.
+    """
+    qid = item_json.get('id', None)
+    if qids is not None and qid not in qids:
+        return None, 0
+    titles = {l[:-4]:item_json['sitelinks'][l].get('title', None) for l in item_json.get('sitelinks', []) if
+              l.endswith('wiki') and l != 'commonswiki' and l != 'specieswiki'}
+    if not titles:
+        return None, 0
+    if sites is not None and not sites.intersection(titles):
+        return None, 0
+
+    claims_ids, indexerror = CLAIM_ENCODER.encode(item_json.get('claims', {}))
+    return (qid, titles, claims_ids, DEFAULT_RULES.mask_ids(claims_ids), claims_fingerprint(claims_ids)), indexerror
+
+def read_dump_lines(dump_fn=DUMP_FN, shard=None, index_fn=None, after=None, progress=None):
+    """Yield (position, line) for lines of the dump -- either all of them or, if shard is (i, N), just those in the ith of N shards.
+
+    Without a shard, position is the line number. With a shard, it is the [block, offset] position from the bz2 index.
+    If after is a position, reading continues with the line after it.
+    If provided, progress['fraction'] is kept up-to-date with the fraction of the (compressed) dump or shard read so far.
+    """
+    if progress is None:
+        progress = {}
+    if shard is None:
+        with open(dump_fn, 'rb') as raw, bz2.open(raw, 'rt') as fin:
+            size = os.fstat(raw.fileno()).st_size
+            for idx, line in enumerate(fin, start=1):
+                if idx % 10000 == 0:
+                    progress['fraction'] = raw.tell() / size if size else 0
+                if after is None or idx > after:
+                    yield idx, line
+    else:
+        index = load_index(dump_fn, index_fn)
+        first, last = shard_block_range(index['blocks'], *shard)
+        lines = iter_shard_lines(dump_fn, index, *shard, start=after, with_positions=True)
+        if after is not None:
+            next(lines, None)
+        for position, line in lines:
+            progress['fraction'] = min(1, (position[0] - first) / (last - first)) if last > first else 0
+            yield position, line
+
+def loop_through_wd_dump(dump_fn=DUMP_FN, qids=None, sites=None, shard=None, index_fn=None, prefilter=True, stats=None,
+                         progress=None):
+    """Get Wikidata claims for items that match filters.
+
+    If provided, stats is kept up-to-date with the counters and the position of the last line read (see read_dump_lines),
+    and if it already has a position (i.e. from a checkpoint), the loop continues from there.
+    Time spent reading, prefiltering, parsing, and extracting claims is added to the timers (see app/timing.py).
+    """
+    if stats is None:
+        stats = {}
+    items_written = stats.get('kept', 0)
+    indexerror = stats.get('indexerror', 0)
+    skipped_unparsed = stats.get('skipped', 0)
+    idx = stats.get('lines', 0)
     print("Making topic predictions based on {0}".format(dump_fn))
     if qids is not None:
         print("Filtering down to {0} QIDs provided.".format(len(qids)))
@@ -128,64 +508,357 @@ def loop_through_wd_dump(qids=None, sites=None):
         print("Site filter: {0}".format(sites))
     else:
         print("Processing all Wikidata items with any wiki sitelinks.")
-    with bz2.open(dump_fn, 'rt') as fin:
-        for idx, line in enumerate(fin, start=1):
-            try:
-                item_json = json.loads(line[:-2])
-            except Exception:
-                try:
-                    item_json = json.loads(line)
-                except Exception:
-                    print("Error:", idx, line)
-                    continue
-            if idx % 100000 == 0:
-                print("{0} lines processed. {1} kept. {2} index errors".format(idx, items_written, indexerror))
+    laps = LapTimer()
+    for position, line in read_dump_lines(dump_fn, shard, index_fn, after=stats.get('position'), progress=progress):
+        laps.lap('read')
+        idx += 1
+        stats.update(lines=idx, position=position, kept=items_written, indexerror=indexerror, skipped=skipped_unparsed)
+        if idx % 1000 == 0:
+            laps.flush()
+        if prefilter:
+            passed = passes_prefilter(line, qids, sites)
+            laps.lap('prefilter')
+            if not passed:
+                skipped_unparsed += 1
+                continue
+        item_json = parse_dump_line(line)
+        laps.lap('decode')
+        if item_json is None:
+            print("Error:", idx, line)
+            continue
+
+        item, errors = extract_item(item_json, qids, sites)
+        laps.lap('extract')
+        indexerror += errors
+        stats['indexerror'] = indexerror
+        if item is not None:
+            items_written += 1
+            stats['kept'] = items_written
+            yield item
+            laps.restart()
+    laps.flush()
+    print("Finished: {0} lines processed. {1} kept. {2} index errors. {3} skipped without parsing.".format(
+        idx, items_written, indexerror, skipped_unparsed))
+
+
+# Incremental mode: rather than re-processing the whole dump, copy a previous output and only replace the rows
+# of items that changed. Changed items whose claims fingerprint matches the previous row keep their predictions.
+
+def read_qid_list(qids_fn):
+    """Set of QIDs from a file with one QID per line, either as plain text or a JSON object with a 'QID'."""
+    qids = set()
+    with open(qids_fn, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if line.startswith('{'):
+                line = json.loads(line).get('QID', '')
+            if line:
+                qids.add(line)
+    return qids
+
+def read_changed_items(dump_fn, changed, qids=None, sites=None):
+    """Extract the changed items from a file in dump format -> ({qid: item}, set of QIDs that were found in the file).
 
-            # filtering
-            qid = item_json.get('id', None)
-            if qids is not None and qid not in qids:
+    Found items that no longer pass the filters are in the second set but not the first.
+    """
+    items = {}
+    found = set()
+    indexerror = 0
+    for _, line in read_dump_lines(dump_fn):
+        # match on the entity ID alone: the prefilter would also skip items that lost their sitelinks,
+        # which then need to be removed by extract_item rather than left unfound
+        match = ENTITY_ID_RE.match(line)
+        if match is not None and match.group(1) not in changed:
+            continue
+        item_json = parse_dump_line(line)
+        if item_json is None or item_json.get('id') not in changed:
+            continue
+        found.add(item_json['id'])
+        item, errors = extract_item(item_json, qids, sites)
+        indexerror += errors
+        if item is not None:
+            items[item[0]] = item
+    print("{0} of {1} changed items found in {2}. {3} index errors.".format(len(found), len(changed), dump_fn, indexerror))
+    return items, found
+
+def update_output(args, model, changed, deleted, qids=None, sites=None, cache=None):
+    """Write a new output that is the previous output with changed items re-scored and deleted items removed.
+
+    Rows stay in the order of the previous output and items that were not in it are added at the end.
+    """
+    if sites is not None:
+        sites = set(sites)
+    changed -= deleted
+    new_items, found = read_changed_items(args.dump_fn, changed, qids, sites)
+    counts = {'copied': 0, 'deleted': 0, 'removed': 0, 'unchanged_claims': 0, 'rescored': 0, 'added': 0}
+    # rows are held back until the batch of items to re-score ahead of them has been scored, to keep the order
+    rows = []
+    to_score = []
+
+    def flush():
+        if to_score:
+            scored = iter(predict_topics(model, to_score, args.threshold, cache))
+            for i in range(len(rows)):
+                if rows[i] is None:
+                    rows[i] = json.dumps(next(scored)) + '\n'
+            to_score.clear()
+        fout.writelines(rows)
+        rows.clear()
+
+    partial_fn = args.output_results + '.partial'
+    with bz2.open(args.previous_output, 'rt') as fin, bz2.open(partial_fn, 'wt') as fout:
+        for line in fin:
+            match = OUTPUT_QID_RE.match(line)
+            qid = match.group(1) if match else json.loads(line)['qid']
+            if qid in deleted:
+                counts['deleted'] += 1
                 continue
-            titles = {l[:-4]:item_json['sitelinks'][l].get('title', None) for l in item_json.get('sitelinks', []) if
-                      l.endswith('wiki') and l != 'commonswiki' and l != 'specieswiki'}
-            if not titles:
+            if qid not in found:
+                rows.append(line)
+                counts['copied'] += 1
+            elif qid not in new_items:
+                # changed so that it no longer passes the filters
+                counts['removed'] += 1
                 continue
-            if sites is not None and not sites.intersection(titles):
+            else:
+                item = new_items.pop(qid)
+                previous = json.loads(line)
+                if previous.get('claims_fingerprint') == item[-1]:
+                    previous['titles'] = item[1]
+                    # rules only depend on the claims too, but rows written before they were recorded do not have them
+                    previous['rules'] = DEFAULT_RULES.names(DEFAULT_RULES.fired([item[3]])[0])
+                    rows.append(json.dumps(previous) + '\n')
+                    counts['unchanged_claims'] += 1
+                else:
+                    rows.append(None)
+                    to_score.append(item)
+                    counts['rescored'] += 1
+            # a partial batch is scored early once rows pile up behind it, so that a sparse set of changes does not
+            # hold most of the previous output in memory
+            max_rows = args.batch_size * (MAX_HELD_BATCHES if to_score else 1)
+            if len(to_score) == args.batch_size or len(rows) >= max_rows:
+                flush()
+        # new items, in the order they appeared in the dump
+        for item in new_items.values():
+            rows.append(None)
+            to_score.append(item)
+            counts['added'] += 1
+            if len(to_score) == args.batch_size:
+                flush()
+        flush()
+    os.replace(partial_fn, args.output_results)
+    print("Finished: {0} rows copied. {1} re-scored. {2} with unchanged claims. {3} added. "
+          "{4} deleted. {5} removed by filters.".format(counts['copied'], counts['rescored'], counts['unchanged_claims'],
+                                                       counts['added'], counts['deleted'], counts['removed']))
+    counts['items'] = counts['copied'] + counts['unchanged_claims'] + counts['rescored'] + counts['added']
+    return counts
+
+
+# Parallel pipeline: decompress (1 process) -> parse + extract claims (--workers processes)
+# -> predict (--predict_workers processes) -> compress + write (main process).
+# Work moves between stages in numbered batches of lines over bounded queues so memory stays flat
+# and the writer can restore the original dump order before writing.
+# Each batch also carries the time its stages took in the other processes, to be added to the writer's timers.
+# A worker that fails sends its traceback to the writer, which stops the pipeline and raises it.
+
+class WorkerError(Exception):
+    pass
+
+
+def _run_worker(target, result_q, *args):
+    """Run a pipeline stage, reporting an exception to the writer rather than dying without a word."""
+    try:
+        target(*args)
+    except BaseException:
+        result_q.put(('error', '{0} (pid {1})'.format(mp.current_process().name, os.getpid()), traceback.format_exc()))
+        raise
+
+
+def _get_result(result_q, procs, poll_interval=5):
+    """Next message from the workers. Raises WorkerError if a worker failed or exited without finishing its work."""
+    while True:
+        try:
+            msg = result_q.get(timeout=poll_interval)
+        except queue.Empty:
+            # e.g., killed for running out of memory, which leaves no chance to report it
+            for p in procs:
+                if p.exitcode not in (None, 0):
+                    raise WorkerError("{0} (pid {1}) exited with code {2}".format(p.name, p.pid, p.exitcode)) from None
+            continue
+        if msg[0] == 'error':
+            raise WorkerError("{0} failed:\n{1}".format(msg[1], msg[2]))
+        return msg
+
+
+def _read_dump(dump_fn, shard, index_fn, line_q, result_q, batch_size, num_parsers, after=None):
+    """Decompress the dump and hand out numbered batches of raw lines along with the position of their last line."""
+    seq = 0
+    batch = []
+    position = None
+    progress = {}
+    laps = LapTimer()
+    for position, line in read_dump_lines(dump_fn, shard, index_fn, after=after, progress=progress):
+        laps.lap('read')
+        batch.append(line)
+        if len(batch) == batch_size:
+            laps.flush()
+            line_q.put((seq, batch, position, progress.get('fraction'), TIMER.snapshot(reset=True)))
+            seq += 1
+            batch = []
+            laps.restart()
+    if batch:
+        laps.flush()
+        line_q.put((seq, batch, position, progress.get('fraction'), TIMER.snapshot(reset=True)))
+        seq += 1
+    for _ in range(num_parsers):
+        line_q.put(None)
+    # let the writer know how many batches to expect
+    result_q.put(('done', seq))
+
+def _parse_worker(line_q, item_q, qids, sites, prefilter):
+    """Parse dump lines and extract claims for the items that pass the filters."""
+    while True:
+        task = line_q.get()
+        if task is None:
+            break
+        seq, lines, position, fraction, timings = task
+        TIMER.merge(timings)
+        items = []
+        errors = 0
+        skipped = 0
+        laps = LapTimer()
+        for line in lines:
+            if prefilter:
+                passed = passes_prefilter(line, qids, sites)
+                laps.lap('prefilter')
+                if not passed:
+                    skipped += 1
+                    continue
+            item_json = parse_dump_line(line)
+            laps.lap('decode')
+            if item_json is None:
                 continue
+            item, indexerror = extract_item(item_json, qids, sites)
+            laps.lap('extract')
+            errors += indexerror
+            if item is not None:
+                items.append(item)
+        laps.flush()
+        item_q.put((seq, position, fraction, len(lines), errors, skipped, items, TIMER.snapshot(reset=True)))
+
+def _predict_worker(model_fn, item_q, result_q, threshold, output_format, score_dtype, with_titles=False, cache=None,
+                    save_cache=False):
+    """Make predictions for batches of extracted items and serialize them (and hash their titles if with_titles).
+
+    Each worker has its own copy of the score cache, which it sends back to be merged when it is done.
+    """
+    model = TopicModel.load(model_fn)
+    while True:
+        task = item_q.get()
+        if task is None:
+            if cache is not None:
+                result_q.put(('cache', cache.export(with_scores=save_cache)))
+            break
+        seq, position, fraction, num_lines, errors, skipped, items, timings = task
+        TIMER.merge(timings)
+        output = None
+        title_keys = None
+        if items:
+            output = encode_batch(model, items, threshold, output_format, score_dtype, cache)
+            if with_titles:
+                title_keys = item_title_keys(items)
+        result_q.put((seq, position, fraction, num_lines, errors, skipped, len(items), output, title_keys,
+                      TIMER.snapshot(reset=True)))
 
-            disamb_list = False
-            has_coords = False
-            human = False
-            man = False
-            claims = item_json.get('claims', {})
-            claim_tuples = []
-            for property in claims:  # each property, such as P31 instance-of
-                included = False
-                for statement in claims[property]:  # each value under that property -- e.g., instance-of might have three different values
-                    try:
-                        if statement['type'] == 'statement' and statement['mainsnak']['datatype'] == 'wikibase-item':
-                            val = statement['mainsnak']['datavalue']['value']['id']
-                            claim_tuples.append((property, val))
-                            included = True
-                            if property == 'P31':
-                                if val in disamb_list_vals:
-                                    disamb_list = True
-                                elif val == 'Q5':
-                                    human = True
-                            elif property == 'P21':
-                                if val in SEX_OR_GENDER_MALE:
-                                    man = True
-                    except Exception:
-                        indexerror += 1
-                if not included:
-                    claim_tuples.append((property,))
-                    if property == 'P625':
-                        has_coords = True
-                    elif property == 'P360':
-                        disamb_list = True
-            if not len(claim_tuples):
-                claim_tuples = [('<NOCLAIM>',)]
-            yield qid, titles, tuple_to_ft_format(claim_tuples), disamb_list, has_coords, human and man
+def run_parallel(args, checkpoint, labels, qids=None, sites=None, shard=None, resume_state=None, titles=None,
+                 cache=None):
+    """Process the dump with a multi-process pipeline -- output is identical in content and order to the sequential run.
+
+    Checkpoints are only taken between batches, once every batch before them has been written.
+    If titles (a TitleIndexWriter) is provided, the predict workers also hash the titles of their items for it.
+    If cache (a ScoreCache) is provided, each predict worker starts with a copy of it and their entries and counters
+    are merged back into it at the end.
+    """
+    num_parsers = args.workers
+    num_predictors = args.predict_workers or max(1, num_parsers // 2)
+    if sites is not None:
+        sites = set(sites)
+    print("Making topic predictions based on {0} with {1} parse and {2} predict workers.".format(
+        args.dump_fn, num_parsers, num_predictors))
+
+    # fork so the (potentially large) QID filter is shared with the workers instead of pickled
+    ctx = mp.get_context('fork')
+    line_q = ctx.Queue(maxsize=num_parsers * 2)
+    item_q = ctx.Queue(maxsize=num_predictors * 2)
+    result_q = ctx.Queue(maxsize=(num_parsers + num_predictors) * 2)
+    stats = dict(resume_state or {})
+    procs = [ctx.Process(target=_run_worker, name='reader',
+                         args=(_read_dump, result_q, args.dump_fn, shard, args.dump_index, line_q, result_q,
+                               args.batch_size, num_parsers, stats.get('position')))]
+    procs.extend([ctx.Process(target=_run_worker, name='parser-{0}'.format(i),
+                              args=(_parse_worker, result_q, line_q, item_q, qids, sites, not args.no_prefilter))
+                  for i in range(num_parsers)])
+    procs.extend([ctx.Process(target=_run_worker, name='predictor-{0}'.format(i),
+                              args=(_predict_worker, result_q, args.fasttext_model, item_q, result_q, args.threshold,
+                                    args.output_format, args.score_dtype, titles is not None, cache,
+                                    bool(args.score_cache)))
+                  for i in range(num_predictors)])
+    for p in procs:
+        p.start()
+
+    lines_processed = stats.get('lines', 0)
+    items_processed = stats.get('kept', 0)
+    indexerror = stats.get('indexerror', 0)
+    skipped_unparsed = stats.get('skipped', 0)
+    total_batches = None
+    next_seq = 0
+    pending = {}
+    reporter = ProgressReporter(interval=args.report_interval, done=items_processed)
+    try:
+        with open_output(args, checkpoint, labels, resume_state) as out:
+            while total_batches is None or next_seq < total_batches:
+                msg = _get_result(result_q, procs)
+                if msg[0] == 'done':
+                    total_batches = msg[1]
+                    continue
+                pending[msg[0]] = msg[1:]
+                # write out any batches that are now in order
+                while next_seq in pending:
+                    position, fraction, num_lines, errors, skipped, num_items, output, title_keys, timings = pending.pop(next_seq)
+                    TIMER.merge(timings)
+                    if output is not None:
+                        with stage('compress'):
+                            out.write(output)
+                    if title_keys is not None:
+                        titles.add(*title_keys)
+                    next_seq += 1
+                    lines_processed += num_lines
+                    items_processed += num_items
+                    indexerror += errors
+                    skipped_unparsed += skipped
+                    reporter.update(items_processed, fraction, extra='from {0} lines'.format(lines_processed))
+                    if checkpoint.due():
+                        state = {'lines': lines_processed, 'position': position, 'kept': items_processed,
+                                 'indexerror': indexerror, 'skipped': skipped_unparsed, 'written': items_processed}
+                        if titles is not None:
+                            state['title_entries'] = titles.sync()
+                        out.save(state)
+        for _ in range(num_predictors):
+            item_q.put(None)
+        if cache is not None:
+            for _ in range(num_predictors):
+                cache.merge(_get_result(result_q, procs)[1])
+    except BaseException:
+        for p in procs:
+            p.terminate()
+        raise
+    for p in procs:
+        p.join()
+    reporter.update(items_processed, 1, extra='from {0} lines'.format(lines_processed), force=True)
+    print("Finished: {0} lines processed. {1} kept. {2} index errors. {3} skipped without parsing.".format(
+        lines_processed, items_processed, indexerror, skipped_unparsed))
+    return {'lines': lines_processed, 'items': items_processed}
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# the app's modules and the bulk scripts are imported the same way they import each other
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(TESTS_DIR, os.pardir, 'app'))
+sys.path.append(os.path.join(TESTS_DIR, os.pardir, 'bulk'))
+
+from inference import TopicModel
+
+LABELS = ['__label__Geography.Europe', '__label__STEM.Biology', '__label__Culture.Biography.Women']
+
+
+class FixedModel:
+    """Stands in for a fastText model: every item gets the same probabilities."""
+
+    def get_labels(self):
+        return LABELS
+
+    def predict(self, texts, k=-1):
+        return [LABELS] * len(texts), [[0.9, 0.6, 0.1]] * len(texts)
+
+
+@pytest.fixture
+def model():
+    return TopicModel(FixedModel())
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import app as topic_app
+from conftest import FixedModel
+from wiki_client import UpstreamBusy
+
+
+@pytest.fixture
+def create_app(monkeypatch, tmp_path):
+    """create_app with the stand-in model and no topic store or title index."""
+    monkeypatch.setattr(topic_app.TopicModel, 'load', classmethod(lambda cls, model_path: cls(FixedModel())))
+
+    def create(config=None):
+        return topic_app.create_app(dict({'TOPIC_STORE_ROOT': str(tmp_path / 'topic_store'),
+                                          'TITLE_INDEX': str(tmp_path / 'title_index')}, **(config or {})))
+    return create
+
+
+def test_settings_can_be_overridden_from_the_environment(monkeypatch, create_app):
+    for setting in ('EXPLAIN_NUM_SAMPLES', 'MAX_BATCH_ITEMS', 'API_BATCH_SIZE'):
+        assert setting in topic_app.DEFAULT_CONFIG
+    monkeypatch.setenv('FLASK_EXPLAIN_NUM_SAMPLES', '100')
+    monkeypatch.setenv('FLASK_MAX_BATCH_ITEMS', '2')
+    monkeypatch.setenv('FLASK_API_BATCH_SIZE', '10')
+    app = create_app()
+    assert (app.config['EXPLAIN_NUM_SAMPLES'], app.config['MAX_BATCH_ITEMS'], app.config['API_BATCH_SIZE']) == (100, 2, 10)
+
+    resp = app.test_client().post('/api/v1/wikidata/topics', json={'qids': ['Q1', 'Q2', 'Q3']})
+    assert resp.status_code == 400
+    assert resp.get_json() == {'Error': "Error: at most 2 QIDs + titles per request."}
+
+
+@pytest.mark.parametrize('title', [{'lang': 5, 'title': 'x'}, {'lang': 'en', 'title': 5}, {'lang': None, 'title': 'x'}])
+def test_batch_titles_of_the_wrong_type_are_rejected(create_app, title):
+    resp = create_app().test_client().post('/api/v1/wikidata/topics', json={'titles': [title]})
+    assert resp.status_code == 400
+    assert resp.get_json()['Error'].startswith("Error: titles must look like")
+
+
+class FailingSession:
+    def get(self, **params):
+        raise UpstreamBusy("too many requests in flight")
+
+
+def test_batch_titles_report_upstream_failures(monkeypatch, create_app):
+    monkeypatch.setattr(topic_app.AppState, 'wiki_session', lambda self, lang: FailingSession())
+    resp = create_app().test_client().post('/api/v1/wikidata/topics',
+                                           json={'titles': [{'lang': 'en', 'title': 'Douglas Adams'}]})
+    assert resp.status_code == 200
+    assert json.loads(resp.get_data(as_text=True)) == {
+        'qid': None, 'Error': "API call failed for en.wikipedia: Douglas Adams", 'lang': 'en', 'title': 'Douglas Adams'}
@@ -0,0 +1,26 @@
+import os
+
+from cache import SQLiteCache
+
+
+def test_sqlite_connection_is_opened_on_first_use(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.db'))
+    assert cache._conn is None
+    cache.set('Q42', {'name': 'Douglas Adams'})
+    assert cache.get('Q42') == {'name': 'Douglas Adams'}
+
+
+def test_sqlite_forked_process_opens_its_own_connection(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.db'))
+    cache.set('Q1', 1)
+    parent_conn = cache.conn
+    pid = os.fork()
+    if pid == 0:
+        # exit codes report back to the parent: 0 if the child read and wrote with a connection of its own
+        ok = cache.get('Q1') == 1 and cache.conn is not parent_conn
+        cache.set('Q2', 2)
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert cache.conn is parent_conn
+    assert cache.get('Q2') == 2
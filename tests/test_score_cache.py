@@ -0,0 +1,70 @@
+import numpy as np
+
+from claims import ClaimEncoder, fingerprint, ids_to_str
+from score_cache import ScoreCache
+from wikidata_ids_to_topics_api import label_qids
+
+
+def item_statement(prop, value):
+    """A statement with an item value, as wbgetentities and the JSON dumps have it."""
+    return {'mainsnak': {'snaktype': 'value', 'property': prop, 'datatype': 'wikibase-item',
+                         'datavalue': {'value': {'entity-type': 'item', 'numeric-id': int(value[1:]), 'id': value},
+                                       'type': 'wikibase-entityid'}},
+            'type': 'statement', 'id': '{0}$1'.format(prop), 'rank': 'normal'}
+
+
+def string_statement(prop, value):
+    return {'mainsnak': {'snaktype': 'value', 'property': prop, 'datatype': 'string',
+                         'datavalue': {'value': value, 'type': 'string'}},
+            'type': 'statement', 'id': '{0}$2'.format(prop), 'rank': 'normal'}
+
+
+def entity(qid, claims):
+    return {'type': 'item', 'id': qid, 'labels': {}, 'claims': claims}
+
+
+def test_empty_batch_before_anything_cached(model):
+    scores = ScoreCache().predict_ids(model, [], [])
+    assert scores.shape == (0, len(model.labels))
+
+
+def test_repeated_claims_are_scored_once(model):
+    # Q1 and Q2 have the same claims in a different order
+    result = {'entities': {
+        'Q1': entity('Q1', {'P31': [item_statement('P31', 'Q5')], 'P21': [item_statement('P21', 'Q6581072')]}),
+        'Q2': entity('Q2', {'P21': [item_statement('P21', 'Q6581072')], 'P31': [item_statement('P31', 'Q5')]}),
+        'Q3': entity('Q3', {'P31': [item_statement('P31', 'Q5')], 'P1477': [string_statement('P1477', 'Ada')]})}}
+    encoded = {qid: ClaimEncoder().encode(e['claims']) for qid, e in result['entities'].items()}
+    assert ids_to_str(encoded['Q1'][0]) == 'P31 Q5 P21 Q6581072'
+    assert ids_to_str(encoded['Q3'][0]) == 'P31 Q5 P1477'
+    assert [malformed for _, malformed in encoded.values()] == [0, 0, 0]
+    assert fingerprint(encoded['Q1'][0]) == fingerprint(encoded['Q2'][0]) != fingerprint(encoded['Q3'][0])
+
+    items = [{'QID': 'Q1'}, {'QID': 'Q2'}, {'QID': 'Q3'}]
+    cache = ScoreCache()
+    label_qids(items, result, model, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 2)
+    uncached = [{'QID': 'Q1'}, {'QID': 'Q2'}, {'QID': 'Q3'}]
+    label_qids(uncached, result, model)
+    assert items == uncached
+
+
+def test_label_qids_all_missing_batch(model):
+    items = [{'QID': 'Q1'}, {'QID': 'Q2'}]
+    result = {'entities': {'Q1': {'id': 'Q1', 'missing': ''}, 'Q2': {'id': 'Q2', 'missing': ''}}}
+    label_qids(items, result, model, cache=ScoreCache())
+    assert items == [{'QID': 'Q1'}, {'QID': 'Q2'}]
+
+
+def test_entries_merged_without_scores_are_not_served(model):
+    claims_ids = [ClaimEncoder().encode({'P31': [item_statement('P31', 'Q5')]})[0]]
+    fingerprints = [fingerprint(ids) for ids in claims_ids]
+    worker = ScoreCache()
+    worker.predict_ids(model, claims_ids * 2, fingerprints * 2)
+
+    merged = ScoreCache()
+    merged.merge(worker.export(with_scores=False))
+    assert len(merged) == 0
+    assert merged.stats()['repeated_claim_sets'] == 1
+    np.testing.assert_array_equal(merged.predict_ids(model, claims_ids, fingerprints), model.predict_ids(claims_ids))
+    assert (merged.hits, merged.misses) == (1, 2)